@@ -7,8 +7,14 @@ import numpy as np
 import random
 import time
 import os
+import threading
 import logging
 from datetime import datetime
+from Tracer import Tracer
+from Metrics import Metrics
+from FileWatcher import FileWatcher
+from SpectrumFiles import SpectrumFiles
+from SpectrumStore import SpectrumStore
 
 # Set up logging
 logging.basicConfig(
@@ -18,6 +24,8 @@ logging.basicConfig(
 )
 
 RESULTS_FILE = r'C:\Users\9KKFWL2\Documents\Interfacing_Tests\Results\XRD.ascii'
+RESULTS_SETTLE_TIME = 0.5       # Time (s) the results file must stay unchanged before it is read
+LABLIMS_DIR = 'C:/ProgramData/Bruker AXS/LabLims/'
 
 # Diffractometer class from Nathan's code: https://github.com/njszym/AdaptiveXRD
 # Copied only the relevant part to control the XRD, since the full code imports many machine learning libraries
@@ -27,6 +35,13 @@ class Diffractometer:
     Main class used to interface with different
     types of diffractometers.
     """
+    # Adaptive precision: a Low scan of the full range, then High scans only over the windows around its peaks
+    ADAPTIVE_PEAK_SIGMA = 5             # Peaks rise this many noise standard deviations above the background
+    ADAPTIVE_SMOOTHING = 5              # Points averaged to smooth the Low scan before looking for peaks
+    ADAPTIVE_BACKGROUND_WIDTH = 2.0     # Width (deg) of the rolling median that estimates the background
+    ADAPTIVE_WINDOW_MARGIN = 0.5        # Angle (deg) scanned at High precision on each side of a peak region
+    ADAPTIVE_MIN_GAP = 1.0              # Windows closer than this (deg) are scanned together
+    ADAPTIVE_EXPECTED_COVERAGE = 0.25   # Fraction of the range expected to be scanned at High precision, for estimates
 
     def __init__(self, instrument_name, results_dir=r'C:\Users\9KKFWL2\Documents\Interfacing_Tests\Results'):
         self.instrument_name = instrument_name
@@ -40,11 +55,26 @@ class Diffractometer:
         known_instruments = ['Bruker', 'Aeris', 'Post Hoc']
         assert self.instrument_name in known_instruments, 'Instrument is not known'
 
+    @staticmethod
+    def estimate_scan_time(min_angle, max_angle, prec, init_step=0.02, init_time=0.1, final_step=0.01, final_time=0.2):
+        """
+        Expected measurement time (s) of a scan, with the same parameters as execute_scan. Adaptive scans
+        are assumed to scan ADAPTIVE_EXPECTED_COVERAGE of the range at High precision.
+        """
+        if prec == 'Adaptive':
+            return (Diffractometer.estimate_scan_time(min_angle, max_angle, 'Low', init_step, init_time) +
+                    Diffractometer.ADAPTIVE_EXPECTED_COVERAGE *
+                    Diffractometer.estimate_scan_time(min_angle, max_angle, 'High', final_step=final_step, final_time=final_time))
+        step_size, time_per_step = (final_step, final_time) if prec == 'High' else (init_step, init_time)
+        return time_per_step*((max_angle + 0.1) - (min_angle - 0.1))/step_size
+
+    @Tracer.traced(category='xrd')
     def execute_scan(self, min_angle, max_angle, prec, temp, spec_fname, init_step=0.02, init_time=0.1, final_step=0.01, final_time=0.2):
 
         # High precision = slow scan
         # Low precision = fast scan
         assert prec in ['Low', 'High'], 'Precision must be High or Low, not %s' % prec
+        scan_start_time = time.time()
 
         # To avoid tolerance issues
         min_angle -= 0.1
@@ -87,7 +117,7 @@ class Diffractometer:
                 f.write('%s;%s;%s;%s;' % (min_angle, max_angle, step_size, time_per_step))
 
             # Scan script and exp jobfile must be written beforehand!
-            jobname = 'C:/ProgramData/Bruker AXS/LabLims/Job.xml'
+            jobname = LABLIMS_DIR + 'Job.xml'
             with open(jobname, 'w+') as f:
                 f.write('<?xml version="1.0"?>\n')
                 f.write('<MeasurementJob>\n')
@@ -98,20 +128,14 @@ class Diffractometer:
                 f.write('  <ScriptFile>FullScanScript.cs</ScriptFile>\n')
                 f.write('</MeasurementJob>\n')
 
-            # Wait until results file is detected
-            done, failed = False, False
-            start_time = time.time()
+            # Wait until results file is detected, then until the diffractometer has finished writing it
             timeout = expec_time + tolerance
-            while not done:
-                time.sleep(5) # Check folder once every 5 seconds
+            failed = not FileWatcher.wait_for(self.results_dir, lambda names: len(names) > 0, timeout, expected_time=expec_time)
+            if not failed:
                 result_files = os.listdir(self.results_dir)
-                if len(result_files) > 0:
-                    assert len(result_files) == 1, 'Too many result files'
-                    fname = result_files[0]
-                    done = True
-                elapsed_time = time.time() - start_time
-                if elapsed_time > timeout:
-                    done, failed = True, True
+                assert len(result_files) == 1, 'Too many result files'
+                fname = result_files[0]
+                failed = not FileWatcher.wait_for_complete(os.path.join(self.results_dir, fname), RESULTS_SETTLE_TIME, timeout)
 
             # If measurement failed, abort scan
             if failed:
@@ -119,26 +143,122 @@ class Diffractometer:
                 return [None], [None]
 
             # If scan was successful: load xy values
-            x, y = [], []
-            with open(RESULTS_FILE) as f:
-                for line in f.readlines()[3:]:
-                    x.append(float(line.split(';')[2]))
-                    y.append(float(line.split(';')[-1]))
-            x = np.array(x)
-            y = np.array(y)
+            x, y = SpectrumFiles.read_results(RESULTS_FILE)
 
             # Clean up results folder
             os.remove(RESULTS_FILE)
 
+            Metrics.scan_seconds.observe(time.time() - scan_start_time, precision=prec)
+            return x, y
+
+    @staticmethod
+    def wait_for_job_finished(timeout=3600):
+        #We need to wait for the Bruker to move the Job.xml to finished, 
+        #otherwise it will just move our new file and the new job will never be executed
+
+        # Wait until the timeout is reached or 'Job.xml' is no longer in the directory
+        # If the timeout was reached without moving the file, throw an error
+        if not FileWatcher.wait_for(LABLIMS_DIR, lambda names: 'Job.xml' not in names, timeout):
+            logging.error("Timeout reached. Job.xml was not moved to finished in time.")
+            raise TimeoutError("Timeout reached while waiting for Job.xml to be moved to finished.")
+
+    @Tracer.traced(category='xrd')
+    def execute_adaptive_scan(self, min_angle, max_angle, temp, spec_fname, init_step=0.02, init_time=0.1, final_step=0.01, final_time=0.2):
+        """
+        Scans coarse to fine: a Low precision scan of the full range, then High precision scans of the
+        windows around the peaks found in it (see find_peak_windows), merged into one spectrum.
+
+        The High counts are scaled by init_time/final_time, so the merged spectrum is in the counts per
+        step of the Low scan. If a High scan fails, the Low points of its window are kept.
+
+        Returns:
+            tuple: x and y of the merged spectrum, sorted by angle, or [None], [None] if the Low scan failed.
+        """
+        x, y = self.execute_scan(min_angle, max_angle, 'Low', temp, spec_fname, init_step, init_time, final_step, final_time)
+        if x[0] is None:
             return x, y
 
+        windows = self.find_peak_windows(x, y, min_angle, max_angle)
+        logging.info(f"Adaptive scan at {temp}C: High precision over {[(round(lo, 2), round(hi, 2)) for lo, hi in windows]}")
+
+        keep = np.ones(len(x), dtype=bool)
+        x_parts, y_parts = [], []
+        for lo, hi in windows:
+            self.wait_for_job_finished()        # Each scan is a new job, see AISHExperiment.run_sequence
+            x_high, y_high = self.execute_scan(lo, hi, 'High', temp, spec_fname, init_step, init_time, final_step, final_time)
+            if x_high[0] is None:
+                logging.warning(f"Adaptive scan at {temp}C: High scan of {lo:.2f}-{hi:.2f} failed, keeping the Low scan there")
+                continue
+            keep &= (x < x_high.min()) | (x > x_high.max())
+            x_parts.append(x_high)
+            y_parts.append(y_high * init_time / final_time)
+
+        x = np.concatenate([x[keep]] + x_parts)
+        y = np.concatenate([y[keep]] + y_parts)
+        order = np.argsort(x, kind='stable')
+        return x[order], y[order]
+
+    @staticmethod
+    def find_peak_windows(x, y, min_angle=None, max_angle=None):
+        """
+        Finds the angle ranges of the peaks of a scan, vectorized over all its points.
+
+        The scan is smoothed over ADAPTIVE_SMOOTHING points, and its background is estimated by a rolling
+        median over ADAPTIVE_BACKGROUND_WIDTH. Points more than ADAPTIVE_PEAK_SIGMA noise standard
+        deviations above it are peaks. The peak regions are widened by ADAPTIVE_WINDOW_MARGIN, and regions
+        less than ADAPTIVE_MIN_GAP apart are joined.
+
+        Args:
+            x (array): Angles of the scan, in increasing order with a constant step.
+            y (array): Counts of the scan.
+            min_angle, max_angle (float): Range the windows are clipped to, the range of x if None.
+
+        Returns:
+            list of tuple: (start, end) angles of each window, in increasing order.
+        """
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        if len(x) < 2:
+            return []
+        step = (x[-1] - x[0]) / (len(x) - 1)
+        min_angle = x[0] if min_angle is None else min_angle
+        max_angle = x[-1] if max_angle is None else max_angle
+
+        # Moving averages pad with the edge values, so the ends of the scan do not look like a drop in counts
+        smoothing = min(Diffractometer.ADAPTIVE_SMOOTHING, len(y)) | 1
+        smooth = np.convolve(np.pad(y, smoothing // 2, mode='edge'), np.ones(smoothing) / smoothing, mode='valid')
+
+        # Rolling median of the smoothed scan, the peaks are much narrower than its width so they do not lift it
+        width = max(int(round(Diffractometer.ADAPTIVE_BACKGROUND_WIDTH / step)), 1) | 1
+        padded = np.pad(smooth, width // 2, mode='edge')
+        background = np.median(np.lib.stride_tricks.sliding_window_view(padded, width), axis=1)
+
+        # Robust noise of the smoothed scan, from the median absolute deviation of the raw points around it
+        noise = 1.4826 * np.median(np.abs(y - smooth)) / np.sqrt(smoothing)
+        peaks = smooth - background > Diffractometer.ADAPTIVE_PEAK_SIGMA * max(noise, 1e-12)
+
+        # Widen the peak regions by the margin, then find where each run of peak points starts and ends
+        margin = int(np.ceil(Diffractometer.ADAPTIVE_WINDOW_MARGIN / step))
+        peaks = np.convolve(peaks, np.ones(2*margin + 1))[margin:margin + len(peaks)] > 0
+        edges = np.flatnonzero(np.diff(np.concatenate([[0], peaks.astype(np.int8), [0]])))
+        starts, ends = edges[::2], edges[1::2] - 1
+        if len(starts) == 0:
+            return []
+
+        joined = x[starts[1:]] - x[ends[:-1]] < Diffractometer.ADAPTIVE_MIN_GAP
+        starts = starts[np.concatenate([[True], ~joined])]
+        ends = ends[np.concatenate([~joined, [True]])]
+        return [(max(float(x[start]), min_angle), min(float(x[end]), max_angle)) for start, end in zip(starts, ends)]
+
 # Creates an object to control the XRD, each object represents an AISH experiment
 class AISHExperiment:
     _SAVE_DIR = './AISH_results'
     _MAX_TEMP = 1100
+    _RAMP_RATE = 60         # Furnace ramp rate (C/min), used for time estimates
     
     def __init__(self, name, sample_num, min_angle, max_angle, precision, temperatures):
+        self.name = name
         self.results_dir = f"{self._SAVE_DIR}/{name}"
+        self.spectrum_store = SpectrumStore(f"{self.results_dir}/spectra.aish")     # Every scan, next to its .xy file
         self.sample_num = sample_num
         
         self.min_angle = min_angle
@@ -154,20 +274,25 @@ class AISHExperiment:
         self.progress = {'cur_step': 0, 'total_steps': len(temperatures), 'cur_temp': 25}
 
         self.ABORT = False
+        self.cooling_down = threading.Event()       # Set once the last scan, at 25C, starts
 
 
+    @Tracer.traced(category='xrd')
     def run_sequence(self):
         for idx, temp in enumerate(self.temperatures):
             if not self.ABORT:
                 #Update the progress
                 self.progress['cur_step'] = idx
                 self.progress['cur_temp'] = temp
+                if idx == len(self.temperatures) - 1:
+                    self.cooling_down.set()
                 logging.info(f"Executing scan at {temp}C, min 2theta: {self.min_angle}, max 2theta: {self.max_angle}")
                 
                 self._single_scan(temp)
             else:
                 logging.error("Experiment aborted")
                 self.progress['cur_temp'] = 25
+                self.cooling_down.set()
 
                 #Run the XRD scan, blocking call, run to 25C to cool down
                 self._single_scan(25)
@@ -175,23 +300,14 @@ class AISHExperiment:
                 logging.info("XRD experiment ABORT complete")
                 return
 
-            #We need to wait for the Bruker to move the Job.xml to finished, 
-            #otherwise it will just move our new file and the new job will never be executed
-            # Set the timeout in seconds
-            timeout = 3600
-            start_time = time.time()
-
-            # Wait until the timeout is reached or 'Job.xml' is no longer in the directory
-            while time.time() - start_time < timeout and 'Job.xml' in os.listdir('C:/ProgramData/Bruker AXS/LabLims/'):
-                time.sleep(0.5)
-
-            # If the timeout was reached without moving the file, throw an error
-            if 'Job.xml' in os.listdir('C:/ProgramData/Bruker AXS/LabLims/'):
-                logging.error("Timeout reached. Job.xml was not moved to finished in time.")
-                raise TimeoutError("Timeout reached while waiting for Job.xml to be moved to finished.")
+            self._wait_for_job_finished()
 
         logging.info("XRD experiment complete")
 
+    @Tracer.traced(category='xrd')
+    def _wait_for_job_finished(self):
+        Diffractometer.wait_for_job_finished()
+
     def _single_scan(self, temp):
         existing_file = None
         precision = self.precision
@@ -202,7 +318,10 @@ class AISHExperiment:
         # Run initial scan
         min_angle = self.min_angle
         max_angle = self.max_angle
-        x, y = diffrac.execute_scan(min_angle, max_angle, precision, temp, None)
+        if precision == 'Adaptive':
+            x, y = diffrac.execute_adaptive_scan(min_angle, max_angle, temp, None)
+        else:
+            x, y = diffrac.execute_scan(min_angle, max_angle, precision, temp, None)
 
         # Write data
         # Check if the Spectra directory exists, if not, create it
@@ -210,13 +329,42 @@ class AISHExperiment:
             os.makedirs(self.results_dir)
 
         spectrum_fname = f'{datetime.now().strftime("%y%m%d-%H%M%S")}_temp_{temp}.xy'
-        with open(f'{self.results_dir}/{spectrum_fname}', 'w+') as f:
-            for (xval, yval) in zip(x, y):
-                f.write('%s %s\n' % (xval, yval))
+        SpectrumFiles.write_xy(f'{self.results_dir}/{spectrum_fname}', x, y)
+        if x[0] is None:
+            # A failed scan has no spectrum to store, its .xy file is kept as the record of the failure
+            logging.warning(f"Scan at {temp}C failed, not added to {self.spectrum_store.path}")
+        else:
+            self.spectrum_store.append(x, y, temperature=temp, precision=precision, min_angle=min_angle, max_angle=max_angle,
+                                       experiment=self.name, sample_num=self.sample_num, xy_name=spectrum_fname)
 
         abs_saved_filepath = os.path.abspath(f'{self.results_dir}/{spectrum_fname}')
         logging.info(f"Saved data of scan for {temp}C to {abs_saved_filepath}")
 
+    @classmethod
+    def estimate_time(cls, min_angle, max_angle, precision, temperatures, handling_time=0):
+        """
+        Predicts the duration of an experiment: one scan per temperature plus the cool-down scan at 25C,
+        the furnace ramps between them, and the time to load and unload the sample.
+
+        Args:
+            handling_time (float): Time (s) to load and unload the sample, see AISHLoader.estimate_cycle_time.
+
+        Returns:
+            dict: Times in minutes: totalTime, scanTime (per scan), totalScanTime, rampTime and handlingTime.
+        """
+        temperatures = [min(temp, cls._MAX_TEMP) for temp in temperatures] + [25]
+
+        scan_time = Diffractometer.estimate_scan_time(min_angle, max_angle, precision) / 60
+        total_scan_time = scan_time * len(temperatures)
+        ramp_time = sum(abs(b - a) for a, b in zip([25] + temperatures[:-1], temperatures)) / cls._RAMP_RATE
+        handling_time = handling_time / 60
+
+        return {'totalTime': total_scan_time + ramp_time + handling_time,
+                'scanTime': scan_time,
+                'totalScanTime': total_scan_time,
+                'rampTime': ramp_time,
+                'handlingTime': handling_time}
+
     def get_progress(self):
         return {'progress': self.progress,
                 'xrd_params': {'sample_num': self.sample_num,
@@ -1,7 +1,10 @@
 from Ender3 import Ender3
 from ArduinoHardware import ArduinoHardware
 from StateTracker import StateTracker
-from AISH_utils import ErrorChecker, CommunicationError, StateError
+from Procedures import ProcedurePlan
+from HomingPolicy import HomingPolicy
+from AISH_utils import ErrorChecker, CommunicationError, StateError, HardwareState
+from Metrics import Metrics
 import time
 import logging
 
@@ -11,8 +14,6 @@ logging.basicConfig(
     datefmt='%y-%m-%d %H:%M:%S'
 )
 
-#TODO: Add self homing intermittently to ensure that the system is in a known state
-
 class AISHLoader(StateTracker):
     
     def __init__(self, PORT_ENDER, PORT_ARDUINO):
@@ -26,9 +27,15 @@ class AISHLoader(StateTracker):
         logging.info(f"AISHLoader - Connecting to Arduino on port: {PORT_ARDUINO}")
         self.arduino = ArduinoHardware(PORT_ARDUINO)
 
+        # Decides when home_if_needed homes the hardware, both were just homed on connecting
+        self.homing_policy = HomingPolicy(self.ender3, self.arduino.linear_rail)
+
         # State variable to keep track of whether a sample is loaded or not
         self.SAMPLE_LOADED = None     
 
+        # Compile and validate the procedure plans before anything moves, they are cached for the later runs
+        ProcedurePlan.compile_all()
+
         #Override the get_state method from the StateTracker class, put this at the end to override the overrides 
         #from the Ender3 and Arduino classes
         ErrorChecker.set_get_state_callback(self.get_state)
@@ -40,9 +47,33 @@ class AISHLoader(StateTracker):
             'error_halt': ErrorChecker.is_halted,       #Flag to indicate if the system is halted to ask for user confirmation
 
             'ender3': self.ender3.get_state(),
+            'ender3_eta': self.ender3.get_eta(),       #Predicted seconds until the running Ender3 procedure completes
             'arduino': self.arduino.get_state(), #Arduino should return the state of the gripper and linear rail inside
+            'hardware_state': HardwareState.get_state(),    #Known-good hardware state and number of elided commands
+            'homing': self.homing_policy.get_state(),       #Cycles since the last home and why the next one is due
         }
 
+    def get_trackers(self):
+        """
+        Returns every StateTracker of the loader by name, for their state timings and histories.
+        """
+        return {'aish_loader': self, 'ender3': self.ender3, 
+                'gripper': self.arduino.gripper, 'linear_rail': self.arduino.linear_rail}
+
+    @staticmethod
+    def estimate_cycle_time(sample_num):
+        """
+        Predicts the time (s) to load and unload a sample, starting from the Ender3 home position.
+        Ender3 moves use its motion model, the gripper and linear rail use their firmware timings.
+
+        Args:
+            sample_num (int): The number of the sample to be loaded.
+        """
+        # The unload starts where the load ended, the gripper is already open for the first step of the load
+        load_time, position = ProcedurePlan.get('load_sample', sample_num=sample_num).estimate_time((0, 0, 0))
+        unload_time, _ = ProcedurePlan.get('unload_sample', sample_num=sample_num).estimate_time(position)
+        return load_time + unload_time
+
     @ErrorChecker.user_confirm_action()
     def command(self, sample_num, xrd_params):
         """
@@ -83,9 +114,25 @@ class AISHLoader(StateTracker):
         self.ender3.init_homing()
 
     @ErrorChecker.user_confirm_action()
-    def home_all(self):
+    def home_if_needed(self):
+        """
+        Homes all the hardware if the homing policy asks for it, see HomingPolicy.get_home_reason.
+        Call between cycles, instead of homing after every sample.
+        """
+        reason = self.homing_policy.get_home_reason()
+        if reason is None:
+            logging.debug(f"AISHLoader - No homing needed, {self.homing_policy.cycles_since_home} cycles since the last home")
+            return
+        self.home_all(reason)
+
+    @ErrorChecker.user_confirm_action()
+    def home_all(self, reason="requested"):
         """
         Homes the linear rail and initializes the homing process for the Ender 3 printer.
+
+        Args:
+            reason (str): Why the hardware is homed, logged and recorded by the homing policy.
+
         This method performs the following steps:
         1. Checks if movement is allowed. If not, raises a StateError.
         2. Tracks the state as "HOMING".
@@ -104,6 +151,8 @@ class AISHLoader(StateTracker):
             raise StateError('Movement is not allowed')
         
         self._track_state("HOMING")
+        logging.info(f"AISHLoader - Homing all, reason: {reason}")
+        start_time = time.time()
 
         self.arduino.gripper.open()
         self.ender3.init_homing()
@@ -117,11 +166,14 @@ class AISHLoader(StateTracker):
             if user_input.lower() != 'y':
                 raise Exception("User stopped the process.")
             attempt += 1
+            result = self.arduino.linear_rail.home()
 
-        if attempt > max_attempts:
+        if result == False:
             raise Exception("Max attempts reached. Homing failed.")
         
         print("Homing successful")
+        Metrics.procedure_seconds.observe(time.time() - start_time, procedure='home')
+        self.homing_policy.record_home(reason)
 
     @ErrorChecker.user_confirm_action()
     def load_sample(self, sample_num):
@@ -144,26 +196,8 @@ class AISHLoader(StateTracker):
         if self.SAMPLE_LOADED is not None:
             raise Exception('StateError: Sample already loaded')
         
-        # Execute the procedure to load a sample
-        #(1) Move 3D printer to sample in sample buffer
-        self.arduino.gripper.open()
-        self.ender3.move_to_sample(sample_num)
-
-        #(2) Grab Sample with Gripper
-        self.arduino.gripper.close()
-
-        #(3) Move 3D printer to sample stage
-        self.ender3.move_to_stage()
-
-        #(4) Release sample with Gripper
-        self.arduino.gripper.open()
-
-        #(5) Return 3D printer to home, elevate sample stage into furnace
-        self.ender3.move_to_rest()
-        # time.sleep(5)
-
-        #(6) Move stage up into furnace
-        self.arduino.linear_rail.move_up()
+        # Execute the procedure to load a sample, see PROCEDURES in Procedures.py for its steps
+        ProcedurePlan.get('load_sample', sample_num=sample_num).run(self)
 
         self.SAMPLE_LOADED = sample_num
     
@@ -185,26 +219,51 @@ class AISHLoader(StateTracker):
         if self.SAMPLE_LOADED is None:
             raise StateError('No sample loaded')
         
-        #(1) Remove sample stage from furnace
-        self.arduino.linear_rail.move_down()
-        # time.sleep(5)
+        # Execute the procedure to return the sample to its position, see PROCEDURES in Procedures.py for its steps
+        ProcedurePlan.get('unload_sample', sample_num=self.SAMPLE_LOADED).run(self)
 
-        #(2) Move 3D printer to stage
-        self.arduino.gripper.open()
-        self.ender3.move_to_stage()
+        # We can leave the gripper open at the sample position
+        self.SAMPLE_LOADED = None
+        self.homing_policy.record_cycle()
 
-        #(3) Grab Sample with Gripper
-        self.arduino.gripper.close()
-        self.ender3.move_to_rest()
+    @ErrorChecker.user_confirm_action()
+    def run_procedure(self, name, **params):
+        """
+        Runs a procedure that does not involve the stage, e.g. 'shuffle' or 'buffer_audit', see PROCEDURES in Procedures.py.
 
-        #(4) Move 3D printer to Sample position (where it was originally stored)
-        self.ender3.move_to_sample(self.SAMPLE_LOADED)
+        Args:
+            name (str): Name of the procedure.
+            **params: Values of its parameters, e.g. from_sample=0, to_sample=5.
 
-        #(5) Release sample with Gripper
-        self.arduino.gripper.open()
+        Raises:
+            StateError: If movement is not allowed, or a sample is loaded and the procedure uses the gripper.
+        """
+        if self.ALLOW_MOVEMENT == False:
+            raise StateError('Movement is not allowed')
 
-        # We can leave the gripper open at the sample position
-        self.SAMPLE_LOADED = None
+        if self.SAMPLE_LOADED is not None:
+            raise StateError(f'Sample {self.SAMPLE_LOADED} is loaded, unload it before running {name}')
+
+        self._track_state(name.upper())
+        ProcedurePlan.get(name, **params).run(self)
+
+    @ErrorChecker.user_confirm_action()
+    def preposition_for_unload(self):
+        """
+        Moves the Ender3 beside the stage while the sample is in the furnace, so unload_sample starts with
+        only the linear rail moving. The gripper is clear of the rail there.
+
+        Raises:
+            StateError: If movement is not allowed or no sample is loaded.
+        """
+        if self.ALLOW_MOVEMENT == False:
+            raise StateError('Movement is not allowed')
+
+        if self.SAMPLE_LOADED is None:
+            raise StateError('No sample loaded')
+
+        self._track_state("PREPOSITION_UNLOAD")
+        self.ender3.move_near_stage()
 
     @ErrorChecker.user_confirm_action()
     def eject_sample_buffer(self, buffer_to_eject):
@@ -230,6 +289,7 @@ class AISHLoader(StateTracker):
         else:
             self._track_state("LOAD_BUFFER")
             self.ALLOW_MOVEMENT = True
+            HardwareState.invalidate()      # The hardware may have been touched while the buffer was out
             self.ender3.move_to_rest()
             
 if __name__ == "__main__":
@@ -1,5 +1,9 @@
 from functools import wraps
+import threading
 import logging
+from StateTracker import StateTracker
+from Tracer import Tracer
+from Metrics import Metrics
 
 
 logging.basicConfig(
@@ -20,10 +24,61 @@ class CommunicationError(Exception):
         self.message = message
         super().__init__(self.message)
 
+class HardwareState:
+    # Known-good physical state of the hardware, shared by the Gripper, LinearRail and Ender3. A component is only
+    # in `known` while its state can be trusted, so commands that cannot change it are elided (skipped). Everything
+    # is forgotten after a CommunicationError or manual intervention, the next commands then run unconditionally.
+    known = {}
+    elided_commands = 0     # Number of commands skipped since startup
+    _lock = threading.Lock()
+
+    @staticmethod
+    def set(component, state):
+        with HardwareState._lock:
+            HardwareState.known[component] = state
+
+    @staticmethod
+    def invalidate(component=None):
+        """
+        Forgets the state of a component, or of every component if None.
+        """
+        with HardwareState._lock:
+            if component is None:
+                HardwareState.known.clear()
+            else:
+                HardwareState.known.pop(component, None)
+
+    @staticmethod
+    def elide(component, state, command):
+        """
+        Checks if a command that brings a component to `state` can be skipped, and counts it if so.
+
+        Returns:
+            bool: True if the component is known to already be in `state`.
+        """
+        with HardwareState._lock:
+            if HardwareState.known.get(component) != state:
+                return False
+        HardwareState.record_elided(command)
+        return True
+
+    @staticmethod
+    def record_elided(command):
+        with HardwareState._lock:
+            HardwareState.elided_commands += 1
+        logging.debug(f"HardwareState - Elided: {command}")
+
+    @staticmethod
+    def get_state():
+        with HardwareState._lock:
+            return {'known': dict(HardwareState.known), 'elided_commands': HardwareState.elided_commands}
+
 class ErrorChecker:
     # Class variable to keep track of whether the system is halted and asking for user confirmation
     is_halted = False  
     get_state = lambda: None
+    communication_errors = 0    # Number of CommunicationErrors since startup, each counted once however deep it is caught, see HomingPolicy
+    _prompt_lock = threading.Lock()     # One operator prompt at a time, actions of a procedure run on several threads
 
     @staticmethod
     def set_get_state_callback(new_get_state):
@@ -48,7 +103,8 @@ class ErrorChecker:
 
         Returns:
             function: A wrapper that catches `CommunicationError`, logs details, and 
-                    asks for user confirmation.
+                    asks for user confirmation. It returns the value of the wrapped function,
+                    True if the user confirmed the action, or None after a `StateError`.
         """
 
         # If get_state is not provided, use the default get_state method
@@ -57,20 +113,38 @@ class ErrorChecker:
             get_state = ErrorChecker.get_state
 
         def decorator(func):
+            span_name = func.__qualname__
+
             @wraps(func)
             def wrapper(*args, **kwargs):
+                # The state a method of a StateTracker starts is ended when it returns, with its outcome
+                tracker = args[0] if args and isinstance(args[0], StateTracker) else None
+                last_record = tracker._last_record() if tracker is not None else None
+                outcome = 'failed'
+                result = None
                 try:
-                    func(*args, **kwargs)
+                    with Tracer.span(span_name, 'procedure'):
+                        result = func(*args, **kwargs)
+                    outcome = 'ok'
                 except CommunicationError as e:
                     logging.error(f"Communication Error: {e}")
                     is_halted = True    # Set the halt flag to True
-
-                    state_info = get_state()
-                    logging.info(f"Current state: {state_info}")
-
-                    user_input = input("Did the action complete successfully? (y/n): ").strip().lower()
+                    if not getattr(e, 'counted', False):
+                        # Count it once, at the innermost method it passes through
+                        e.counted = True
+                        ErrorChecker.communication_errors += 1
+                        Metrics.communication_errors.inc(device=type(args[0]).__name__ if args else func.__module__)
+                    HardwareState.invalidate()      # The hardware may be anywhere after a communication error
+
+                    with ErrorChecker._prompt_lock:
+                        state_info = get_state()
+                        logging.info(f"Current state: {state_info}")
+
+                        user_input = input("Did the action complete successfully? (y/n): ").strip().lower()
                     if user_input == 'y':
                         logging.info("User confirmed the action completed.")
+                        outcome = 'ok'
+                        result = True
                     else:
                         logging.error("Action did not complete successfully. Raising exception and exiting.")
                         raise e
@@ -80,10 +154,11 @@ class ErrorChecker:
                     logging.exception(f"Error not related to communication, so uncaught:")
                     raise e
                 finally:
-                    # Write cleanup code here
-                    pass
+                    if tracker is not None:
+                        tracker._finish_state(outcome, since=last_record)
 
                 is_halted = False       # We have confirmed the action, so reset the halt flag
+                return result
             return wrapper
         return decorator
 
@@ -0,0 +1,108 @@
+# Runs the steps of an AISHLoader procedure as a dependency graph of actions
+# Each action belongs to a device (the Ender3 or the Arduino, each on its own serial link). Actions of different
+# devices run in parallel as soon as the actions they depend on have completed, actions of the same device never
+# overlap. The dependencies encode the safety orderings, e.g. the gripper must be open before it descends onto
+# a sample, so everything not ordered by them is free to overlap.
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import time
+import logging
+from Tracer import Tracer
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+# A single step of a procedure: function(*args) runs on `device` once every action named in `after` has completed
+Action = namedtuple('Action', ['name', 'device', 'function', 'args', 'after'])
+
+class ActionGraph:
+
+    def __init__(self, name):
+        """
+        Args:
+            name (str): Name of the procedure, used in the log.
+        """
+        self.name = name
+        self.actions = {}       # Actions by name, in the order they were added
+
+    def add(self, name, device, function, *args, after=()):
+        """
+        Adds an action to the graph. Dependencies must be added before the actions that depend on them,
+        so the graph can not contain a cycle.
+
+        Args:
+            name (str): Unique name of the action.
+            device (str): Device the action runs on, actions of the same device run one at a time.
+            function (callable): Called with *args to run the action.
+            after (iterable of str): Names of the actions that must complete before this one starts.
+
+        Returns:
+            ActionGraph: self, so actions can be chained.
+
+        Raises:
+            ValueError: If the name is already used or a dependency has not been added.
+        """
+        if name in self.actions:
+            raise ValueError(f"ActionGraph - Duplicate action in {self.name}: {name}")
+        unknown = [dependency for dependency in after if dependency not in self.actions]
+        if unknown:
+            raise ValueError(f"ActionGraph - Action {name} of {self.name} depends on unknown actions: {unknown}")
+
+        self.actions[name] = Action(name, device, function, args, tuple(after))
+        return self
+
+    def run(self):
+        """
+        Runs all actions, each as soon as its dependencies have completed and its device is free. Ready
+        actions start in the order they were added. If an action raises, no further actions are started,
+        the running ones are waited for and the exception is re-raised.
+
+        Returns:
+            dict: Return value of each action, by name.
+        """
+        devices = {action.device for action in self.actions.values()}
+        pending = dict(self.actions)
+        running = {}            # Future -> Action
+        busy_devices = set()
+        results = {}
+        error = None
+
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=max(len(devices), 1), thread_name_prefix=f"ActionGraph-{self.name}") as executor:
+            while pending or running:
+                if error is None:
+                    for action in list(pending.values()):
+                        if action.device in busy_devices or any(dependency not in results for dependency in action.after):
+                            continue
+                        logging.debug(f"ActionGraph - {self.name}: starting {action.name} on {action.device}")
+                        running[executor.submit(self._run_action, action)] = action
+                        busy_devices.add(action.device)
+                        del pending[action.name]
+
+                if not running:
+                    break       # An action failed, nothing left to wait for
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    action = running.pop(future)
+                    busy_devices.discard(action.device)
+                    try:
+                        results[action.name] = future.result()
+                    except Exception as e:
+                        logging.error(f"ActionGraph - {self.name}: {action.name} failed: {e}")
+                        error = error or e
+
+        if error is not None:
+            logging.error(f"ActionGraph - {self.name}: not started: {list(pending)}")
+            raise error
+        logging.debug(f"ActionGraph - {self.name} completed in {time.time() - start_time:.3f}s")
+        return results
+
+    def _run_action(self, action):
+        # Runs on a worker thread, so the span of the action starts a new tree on the row of that thread
+        with Tracer.span(f"{self.name}.{action.name}", 'action', device=action.device):
+            return action.function(*action.args)
@@ -1,14 +1,17 @@
 # Handles commmunication with the Arduino to control hardware
-# Uses pyFirmata to communicate reliably
+# Uses the Firmata sysex protocol (FirmataClient) to communicate reliably
 # Hardware components connected to Arduino:
 # - Gripper: For grabbing the samples
 # - Linear Rail: For raising the sample stage
 
-import pyfirmata
+from FirmataClient import FirmataClient
 import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from StateTracker import StateTracker
 import logging
-from AISH_utils import CommunicationError, ErrorChecker
+from AISH_utils import CommunicationError, StateError, ErrorChecker, HardwareState
+from Tracer import Tracer
+from Metrics import Metrics
 
 logging.basicConfig(
     level=logging.DEBUG,
@@ -16,7 +19,7 @@ logging.basicConfig(
     datefmt='%y-%m-%d %H:%M:%S'
 )
 
-# Define pyfirmata commands
+# Define Firmata sysex commands
 GRIPPER_OPEN = 0x10
 GRIPPER_CLOSE = 0x11
 GRIPPER_STATE = 0x12
@@ -26,6 +29,13 @@ LINRAIL_UP = 0x20
 LINRAIL_DOWN = 0x21
 LINRAIL_COUNT = 0x22
 LINRAIL_HOME = 0x23
+LINRAIL_PROGRESS = 0x24     # Sent by the Arduino during a rail move
+
+MACRO = 0x30                # Runs a list of the gripper/rail commands above in one round trip
+MACRO_MAX_STEPS = 8
+MACRO_STEP_OK = 0xFF        # Status of each step in the macro acknowledgement
+MACRO_STEP_FAILED = 0x00
+MACRO_STEP_SKIPPED = 0x01   # Not run because an earlier step failed
 
 TEST_ECHO = 0x01
 TEST_RESPONSE = 0x02
@@ -34,11 +44,7 @@ class ArduinoHardware:
     def __init__(self, PORT) -> None:
         try:
             # Create a new board instance at the specified port
-            self.board = pyfirmata.Arduino(PORT)
-
-            # Start iterator to avoid buffer overflow
-            it = pyfirmata.util.Iterator(self.board)
-            it.start()
+            self.board = FirmataClient(PORT)
             logging.info(f"Arduino - Connected on port: {PORT}")
         except:
             raise Exception("Failed to connect to Arduino")
@@ -46,6 +52,8 @@ class ArduinoHardware:
         # Attach the callback functions to the test commands
         self.board.add_cmd_handler(TEST_RESPONSE, self._default_callback)
         self.board.add_cmd_handler(TEST_ECHO, self._default_callback)
+        self.board.add_cmd_handler(MACRO, self._macro_callback)
+        self._macro_request = None      # Future of the pending macro, resolved with the statuses and count
 
         # Initialize the hardware components
         self.gripper = self.Gripper(self.board)
@@ -54,15 +62,124 @@ class ArduinoHardware:
         # Set the callback function for the CommunicationErrorChecker
         ErrorChecker.set_get_state_callback(self.get_state)
 
-        self.gripper.open()  # Release the gripper on initialization
-        self.linear_rail.home() # Home the linear rail on initialization
+        # Release the gripper and home the linear rail on initialization, in one round trip
+        self.macro().gripper_open().rail_home().run()
 
     def get_state(self):
         return {
             'gripper': self.gripper.get_state(),
-            'linear_rail': self.linear_rail.get_state()
+            'linear_rail': self.linear_rail.get_state(),
+            'linear_rail_progress': self.linear_rail.progress
         }
 
+    def close(self):
+        self.board.close()
+
+    def macro(self):
+        """
+        Starts building a macro: gripper and rail commands run on the Arduino one after the other, with a single
+        acknowledgement for all of them.
+
+        Example:
+            arduino.macro().rail_down().gripper_open().run()
+        """
+        return ArduinoHardware.Macro(self)
+
+    @ErrorChecker.user_confirm_action()
+    def run_macro(self, steps):
+        """
+        Runs a list of gripper/rail commands on the Arduino in one round trip.
+
+        Steps that cannot change the known HardwareState are elided before sending. The count guards of
+        LinearRail.move_up and move_down are applied to every rail step, from the count it is expected to start at.
+
+        Args:
+            steps (list of int): Commands of the steps: GRIPPER_OPEN, GRIPPER_CLOSE, LINRAIL_UP, LINRAIL_DOWN or LINRAIL_HOME.
+
+        Returns:
+            list of bool: Success of each step that was sent, all True (an empty list if every step was elided).
+
+        Raises:
+            ValueError: If a step is not a macro command or there are more than MACRO_MAX_STEPS steps.
+            CommunicationError: If the macro stalls or is not acknowledged in time, a rail step is refused by
+                                the count guards, the Arduino refuses the macro because the rail is busy, or a
+                                step fails. The procedure running the macro must not go on in those cases, a
+                                StateError would only be logged by ErrorChecker.
+        """
+        for step in steps:
+            if step not in self.MACRO_STEPS:
+                raise ValueError(f"Arduino - {hex(step)} is not a macro step")
+        if len(steps) > MACRO_MAX_STEPS:
+            raise ValueError(f"Arduino - Macros have at most {MACRO_MAX_STEPS} steps, got {len(steps)}")
+
+        # Elide against the state each step leaves behind. Homing is never elided, it is how the rail state is re-established
+        expected = HardwareState.get_state()['known']
+        sent_steps = []
+        for step in steps:
+            component, target = self.MACRO_STEPS[step][:2]
+            if step != LINRAIL_HOME and expected.get(component) == target:
+                HardwareState.record_elided(f"Arduino - macro step {hex(step)}")
+                continue
+            expected[component] = target
+            sent_steps.append(step)
+        steps = sent_steps
+        if not steps:
+            return []
+
+        # The rail position may be unknown (e.g. after a CommunicationError) so moves are not elided, the count
+        # guards keep a move from driving the rail into the end stop
+        if LINRAIL_UP in steps or LINRAIL_DOWN in steps:
+            count = self.linear_rail.get_count()
+            for step in steps:
+                if step == LINRAIL_HOME:
+                    count = 0
+                elif step in (LINRAIL_UP, LINRAIL_DOWN):
+                    direction = 'UP' if step == LINRAIL_UP else 'DOWN'
+                    refusal = self.linear_rail._refuse_move(direction, count)
+                    if refusal is not None:
+                        raise CommunicationError(f"Arduino - Macro {[hex(step) for step in steps]} not sent: {refusal}")
+                    count += self.linear_rail.RAIL_TRAVEL_STEPS if direction == 'UP' else -self.linear_rail.RAIL_TRAVEL_STEPS
+
+        timeout = 0
+        for step in steps:
+            component, _, state, step_timeout = self.MACRO_STEPS[step]
+            getattr(self, component)._track_state(state)
+            HardwareState.invalidate(component)         # Unknown until the macro is acknowledged
+            timeout += step_timeout
+
+        self._macro_request = Future()
+        self.linear_rail._last_advance_time = None
+        self.board.send_sysex(MACRO, steps)
+        reply = self.linear_rail._wait_for_move(self._macro_request, timeout, "Arduino - Macro failed")
+
+        if len(reply) != len(steps) + 2:
+            for step in reversed(steps):
+                getattr(self, self.MACRO_STEPS[step][0])._finish_state('failed')
+            raise CommunicationError(f"Arduino - Macro {[hex(step) for step in steps]} refused, the rail is busy")
+        self.linear_rail._update_count([MACRO_STEP_OK] + reply[-2:])
+
+        results = []
+        for step, status in zip(steps, reply):
+            component, target, _, _ = self.MACRO_STEPS[step]
+            if status == MACRO_STEP_OK:
+                HardwareState.set(component, target)
+            else:
+                logging.error(f"Arduino - Macro step {hex(step)} {'skipped' if status == MACRO_STEP_SKIPPED else 'failed'}")
+            results.append(status == MACRO_STEP_OK)
+
+        # Each component is timed over the whole macro, under the state of its last step
+        for step, success in reversed(list(zip(steps, results))):
+            getattr(self, self.MACRO_STEPS[step][0])._finish_state('ok' if success else 'failed')
+
+        logging.info(f"Arduino - Macro {[hex(step) for step in steps]} done: {results}, count: {self.linear_rail._linrail_count}")
+        if not all(results):
+            raise CommunicationError(f"Arduino - Macro {[hex(step) for step in steps]} did not complete: {results}")
+        return results
+
+    def _macro_callback(self, *data):
+        conv_data, data = ArduinoHardware._unpack_sysex(*data)
+        ArduinoHardware._resolve_reply(self._macro_request, conv_data)
+
     # Default callback function for handling SysEx messages. Parses the data and converts it to a list of bytes
     def _default_callback(self, *data):
         conv_data, data = ArduinoHardware._unpack_sysex(*data)
@@ -70,21 +187,88 @@ class ArduinoHardware:
         logging.debug("\tTEST SYSEX - Received SysEx message:", [d for d in data])
         logging.debug(f"\tTEST SYSEX - Converted data: {[bin(d) for d in conv_data]} = {conv_data}")
     
+    @staticmethod
+    @Tracer.traced(category='serial')
+    def _wait_for_reply(request, timeout, error_message):
+        """
+        Blocks until the reply to a sysex command arrives and returns its value.
+
+        Args:
+            request (Future): Future of the command, resolved by the callback of the reply.
+            timeout (float): Max time (s) to wait for the reply.
+            error_message (str): Message of the CommunicationError raised on timeout.
+
+        Raises:
+            CommunicationError: If the reply does not arrive within timeout.
+        """
+        start_time = time.time()
+        try:
+            reply = request.result(timeout=timeout)
+        except FutureTimeoutError:
+            raise CommunicationError(error_message)
+        Metrics.sysex_roundtrip_seconds.observe(time.time() - start_time, wait='reply')
+        return reply
+
+    @staticmethod
+    def _resolve_reply(request, value):
+        # Called from the callbacks, replies without a waiting request (or duplicates) are ignored
+        if request is not None and not request.done():
+            request.set_result(value)
+
     @staticmethod
     def _unpack_sysex(*data):
-        conv_data = []
-        for d in range(0, len(data), 2):
-            conv_data.append(data[d] + (data[d+1] << 7))
-        return conv_data, data
+        return FirmataClient.unpack_7bit(data), data
     
 
+    class Macro:
+        def __init__(self, arduino) -> None:
+            self.arduino = arduino
+            self.steps = []
+
+        def gripper_open(self):
+            self.steps.append(GRIPPER_OPEN)
+            return self
+
+        def gripper_close(self):
+            self.steps.append(GRIPPER_CLOSE)
+            return self
+
+        def rail_up(self):
+            self.steps.append(LINRAIL_UP)
+            return self
+
+        def rail_down(self):
+            self.steps.append(LINRAIL_DOWN)
+            return self
+
+        def rail_home(self):
+            self.steps.append(LINRAIL_HOME)
+            return self
+
+        def run(self):
+            return self.arduino.run_macro(self.steps)
+
     class LinearRail(StateTracker):
 
         MOVE_TIMEOUT = 30
         HOME_TIMEOUT = 10
         CHECK_TIMEOUT = 1
+        STALL_TIMEOUT = 1           # Max time (s) without the count advancing during a move, progress is reported every 100 ms
         RAIL_STEPS_PER_REV = 400
 
+        # Speed profile of the moves up and down, from the firmware: RAIL_TRAVELREVS revolutions after a 500 ms enable
+        # delay, accelerating from RAIL_START_SPEED to RAIL_MAX_SPEED and decelerating back (steps/s and steps/s^2)
+        RAIL_TRAVEL_STEPS = 63*RAIL_STEPS_PER_REV
+        RAIL_COUNT_MARGIN = RAIL_STEPS_PER_REV      # Moves may end at most this far (steps) past the bottom (0) or the top
+        RAIL_START_SPEED = 800
+        RAIL_MAX_SPEED = 1e6/(2*300)            # The speed of the blocking moves, RAIL_PULSEWIDTH is 300 us
+        RAIL_ACCELERATION = 5000
+        RAIL_ENABLE_DELAY = 0.5
+
+        # Expected duration of a full move up or down: both ramps, then cruising over the remaining steps
+        MOVE_DURATION = (RAIL_ENABLE_DELAY + 2*(RAIL_MAX_SPEED - RAIL_START_SPEED)/RAIL_ACCELERATION
+                         + (RAIL_TRAVEL_STEPS - (RAIL_MAX_SPEED**2 - RAIL_START_SPEED**2)/RAIL_ACCELERATION)/RAIL_MAX_SPEED)
+
         def __init__(self, board) -> None:
             super().__init__()      # Initialize the StateTracker class
             
@@ -95,105 +279,229 @@ class ArduinoHardware:
             self.board.add_cmd_handler(LINRAIL_DOWN, self._linrail_move_callback)
             self.board.add_cmd_handler(LINRAIL_COUNT, self._linrail_count_callback)
             self.board.add_cmd_handler(LINRAIL_HOME, self._linrail_home_callback)
+            self.board.add_cmd_handler(LINRAIL_PROGRESS, self._linrail_progress_callback)
             
-            self._linrail_count = None              # Stores the count of the linear rail
-            self._linrail_home_success = None       # Stores the success of the homing operation
-            self._linrail_move_success = None       # Stores the success of the move operation
+            self._linrail_count = None              # Last count reported by the rail (move/home acks, progress or count checks), None if unknown
+            self._count_request = None              # Future of the pending count check, resolved with the count
+            self._home_request = None               # Future of the pending homing, resolved with its success
+            self._move_request = None               # Future of the pending move, resolved with its success
+
+            # Progress of the last move: {'direction', 'count', 'fraction', 'moving'}, None before the first move
+            self.progress = None
+            self._progress_callbacks = []
+            self._move_start_count = None           # Count when the running move started
+            self._last_advance_time = None          # Time the count last advanced during the running move, None until progress is reported
 
             # Set the callback function for the CommunicationErrorChecker
             ErrorChecker.set_get_state_callback(self.get_state)
         
         @ErrorChecker.user_confirm_action()
         def move_up(self):
+            if HardwareState.elide('linear_rail', 'UP', "Linear Rail - move up"):
+                return True
             self._track_state("MOVE_UP")
             #First check if it is already at the top
-            count = self.check_count()
-            if count >= (74*self.RAIL_STEPS_PER_REV) - 10*self.RAIL_STEPS_PER_REV:
-                logging.error("Linear Rail - Already at the top, cannot move up")
-                self.check_count()  #Run to output the count
+            count = self.get_count()
+            refusal = self._refuse_move('UP', count)
+            if refusal is not None:
+                logging.error(f"Linear Rail - {refusal}")
                 return False
 
-            self._linrail_move_success = None
+            HardwareState.invalidate('linear_rail')     # Unknown until the move is acknowledged
+            self._start_move("UP", count)
             self.board.send_sysex(LINRAIL_UP, [])       # Send the move up command
             
             # Wait for the move to complete, or timeout 
-            start_time = time.time()
-            while not self._linrail_move_success and time.time() - start_time < self.MOVE_TIMEOUT:
-                time.sleep(0.1)
-            
-            if self._linrail_move_success is None:
-                raise CommunicationError("Linear Rail - Timeout, Move up failed")
+            move_success = self._wait_for_move(self._move_request, self.MOVE_TIMEOUT, "Linear Rail - Move up failed")
+            if move_success:
+                HardwareState.set('linear_rail', 'UP')
             
-            logging.info("Arduino - Linear Rail - Moved up")
-            self.check_count()  #Run to output the count
+            logging.info(f"Arduino - Linear Rail - Moved up, count: {self._linrail_count}")
 
-            return self._linrail_move_success            
+            return move_success            
 
         @ErrorChecker.user_confirm_action()
         def move_down(self):
+            if HardwareState.elide('linear_rail', 'DOWN', "Linear Rail - move down"):
+                return True
             self._track_state("MOVE_DOWN")
             #First check if it is already at the bottom
-            count = self.check_count()
-            if count <= 0:
-                logging.error("Linear Rail - Already at the bottom, cannot move down")
-                self.check_count()  #Run to output the count
+            count = self.get_count()
+            refusal = self._refuse_move('DOWN', count)
+            if refusal is not None:
+                logging.error(f"Linear Rail - {refusal}")
                 return False
 
-            self._linrail_move_success = None
+            HardwareState.invalidate('linear_rail')     # Unknown until the move is acknowledged
+            self._start_move("DOWN", count)
             self.board.send_sysex(LINRAIL_DOWN, [])     # Send the move down command
 
             # Wait for the move to complete, or timeout             
-            start_time = time.time()
-            while not self._linrail_move_success and time.time() - start_time < self.MOVE_TIMEOUT:
-                time.sleep(0.1)
+            move_success = self._wait_for_move(self._move_request, self.MOVE_TIMEOUT, "Linear Rail - Move down failed")
+            if move_success:
+                HardwareState.set('linear_rail', 'DOWN')
             
-            if self._linrail_move_success is None:
-                raise CommunicationError("Linear Rail - Timeout, Move down failed")
-            
-            logging.info("Arduino - Linear Rail - Moved down")
-            self.check_count()  #Run to output the count
+            logging.info(f"Arduino - Linear Rail - Moved down, count: {self._linrail_count}")
 
-            return self._linrail_move_success
+            return move_success
 
         @ErrorChecker.user_confirm_action()
         def home(self):
             self._track_state("HOME")
-            self._linrail_home_success = None
+            HardwareState.invalidate('linear_rail')     # Unknown until homing is acknowledged
+            self._home_request = Future()
             self.board.send_sysex(LINRAIL_HOME, [])
 
             # Wait for the homing to complete, or timeout
-            start_time = time.time()
-            while self._linrail_home_success is None and time.time() - start_time < self.HOME_TIMEOUT:
-                time.sleep(0.1)
+            home_success = self._wait_for_ack(self._home_request, self.HOME_TIMEOUT, "Linear Rail - Timeout, Homing failed")
+            if home_success:
+                HardwareState.set('linear_rail', 'DOWN')    # Homed on the limit switch at the bottom
             
-            if self._linrail_home_success is None:
-                raise CommunicationError("Linear Rail - Timeout, Homing failed")
-            
-            logging.info(f"Arduino - Linear Rail - Homing successful {self._linrail_home_success}")
-            return self._linrail_home_success
+            logging.info(f"Arduino - Linear Rail - Homing successful {home_success}, count: {self._linrail_count}")
+            return home_success
+
+        def _refuse_move(self, direction, count):
+            """
+            Count guards of the rail moves, the same as startRailMove in the firmware: a move of RAIL_TRAVEL_STEPS
+            must end within RAIL_COUNT_MARGIN of the bottom (count 0) or the top, so it can not drive the rail
+            into an end stop. A rail that is not at the other end (e.g. after an interrupted move) must be homed.
+
+            Returns:
+                str: Why a move in direction ('UP' or 'DOWN') starting at count is refused, None if it is allowed.
+            """
+            end = count + (self.RAIL_TRAVEL_STEPS if direction == 'UP' else -self.RAIL_TRAVEL_STEPS)
+            if direction == 'DOWN' and end < -self.RAIL_COUNT_MARGIN:
+                return f"Not at the top, cannot move down (count {count}, would end at {end})"
+            if direction == 'UP' and end > self.RAIL_TRAVEL_STEPS + self.RAIL_COUNT_MARGIN:
+                return f"Not at the bottom, cannot move up (count {count}, would end at {end})"
+            return None
+
+        def get_count(self):
+            """
+            Returns the step count of the rail, from the last move/home acknowledgement if it is known.
+            Only asks the Arduino (check_count) when it is not, e.g. after a timeout.
+            """
+            if self._linrail_count is None:
+                return self.check_count()
+            return self._linrail_count
 
         def check_count(self):
-            self._linrail_count = None
+            """
+            Asks the Arduino for the step count of the rail. Moves keep the count up to date, so this is
+            only needed to verify it.
+            """
+            self._count_request = Future()
             self.board.send_sysex(LINRAIL_COUNT, [])
             
             # Wait for the count to be received, or timeout
-            start_time = time.time()
-            while self._linrail_count is None and time.time() - start_time < self.CHECK_TIMEOUT:
-                time.sleep(0.1)
-            
-            if self._linrail_count is None:
-                raise CommunicationError("Linear Rail - Timeout, Count check failed")
+            self._wait_for_ack(self._count_request, self.CHECK_TIMEOUT, "Linear Rail - Timeout, Count check failed")
             
             logging.info(f"Arduino - Linear Rail - Count: {self._linrail_count}")
 
             return self._linrail_count
+
+        def get_count_error(self):
+            """
+            Returns how far (steps) the last reported count is from the count of the known rail position: 0 at
+            the bottom, RAIL_TRAVEL_STEPS at the top. None if the position or the count is unknown.
+            """
+            expected = {'DOWN': 0, 'UP': self.RAIL_TRAVEL_STEPS}.get(HardwareState.known.get('linear_rail'))
+            if expected is None or self._linrail_count is None:
+                return None
+            return abs(self._linrail_count - expected)
+
+        def add_progress_callback(self, callback):
+            """
+            Registers a function called with the progress dict on every progress report and at the end of each move.
+            It runs on the Firmata reader thread, so it must return quickly.
+            """
+            self._progress_callbacks.append(callback)
+
+        def _start_move(self, direction, count):
+            self._move_request = Future()
+            self._move_start_count = count
+            self._last_advance_time = None
+            self._set_progress(direction, count, moving=True)
+
+        @Tracer.traced(category='serial')
+        def _wait_for_move(self, request, timeout, error_message):
+            """
+            Waits for the acknowledgement of a move (or a macro with moves), failing early if a move stalls.
+
+            While the Arduino reports a move in progress, the count must advance at least every STALL_TIMEOUT.
+            Firmware that does not report progress is only bounded by the timeout.
+
+            Raises:
+                CommunicationError: If a move stalls or the request is not acknowledged within timeout.
+            """
+            start_time = time.time()
+            while True:
+                try:
+                    reply = request.result(timeout=self.STALL_TIMEOUT/2)
+                    Metrics.sysex_roundtrip_seconds.observe(time.time() - start_time, wait='move')
+                    return reply
+                except FutureTimeoutError:
+                    pass
+
+                now = time.time()
+                if self._last_advance_time is not None and now - self._last_advance_time > self.STALL_TIMEOUT:
+                    error_message += f", stalled at count {self._linrail_count}"
+                elif now - start_time > timeout:
+                    error_message += ", timeout"
+                else:
+                    continue
+
+                self._linrail_count = None      # The rail may have moved without the count being reported
+                if self.progress is not None:
+                    self._set_progress(self.progress['direction'], None, moving=False)
+                raise CommunicationError(error_message)
+
+        def _set_progress(self, direction, count, moving):
+            fraction = None
+            if count is not None and self._move_start_count is not None:
+                fraction = min(max(abs(count - self._move_start_count) / self.RAIL_TRAVEL_STEPS, 0), 1)
+            self.progress = {'direction': direction, 'count': count, 'fraction': fraction, 'moving': moving}
+            for callback in self._progress_callbacks:
+                callback(self.progress)
+
+        def _wait_for_ack(self, request, timeout, error_message):
+            # The rail may have moved without the count being reported, so it is unknown after a timeout
+            try:
+                return ArduinoHardware._wait_for_reply(request, timeout, error_message)
+            except CommunicationError:
+                self._linrail_count = None
+                raise
+
+        def _update_count(self, conv_data):
+            # Move and home acks are [status, count MSB, count LSB], firmware without the count only sends the status
+            if len(conv_data) >= 3:
+                self._linrail_count = int.from_bytes(bytes(conv_data[1:3]), byteorder='big', signed=True)
+            else:
+                self._linrail_count = None
         
         def _linrail_move_callback(self, *data):
             conv_data, data = ArduinoHardware._unpack_sysex(*data)
-            if conv_data[0] == 0xFF:
-                self._linrail_move_success = True
-            else:
-                self._linrail_move_success = False
+            self._update_count(conv_data)
+            if self.progress is not None and self.progress['moving']:
+                self._set_progress(self.progress['direction'], self._linrail_count, moving=False)
+            ArduinoHardware._resolve_reply(self._move_request, conv_data[0] == 0xFF)
+
+        def _linrail_progress_callback(self, *data):
+            # [command of the move, count MSB, count LSB, moving], every 100 ms during a move. Moves run by a
+            # macro are not acknowledged on their own, their last report has moving = 0
+            conv_data, data = ArduinoHardware._unpack_sysex(*data)
+            previous_count = self._linrail_count
+            self._update_count(conv_data)
+            moving = len(conv_data) < 4 or bool(conv_data[3])
+            direction = "UP" if conv_data[0] == LINRAIL_UP else "DOWN"
+
+            if self.progress is None or not self.progress['moving']:
+                self._move_start_count = previous_count     # First report of a move started by a macro
+            if not moving:
+                self._last_advance_time = None
+            elif self._last_advance_time is None or self._linrail_count != previous_count:
+                self._last_advance_time = time.time()
+            self._set_progress(direction, self._linrail_count, moving=moving)
         
         def _linrail_count_callback(self, *data):
             conv_data, data = ArduinoHardware._unpack_sysex(*data)
@@ -205,6 +513,7 @@ class ArduinoHardware:
             # The total count is a 16-bit value, so we need to combine the two bytes
             self._linrail_count = int.from_bytes(bytes([conv_data[0], conv_data[1]]), byteorder='big', signed=True)
             # print(f"\tCount: {self._linrail_count}")
+            ArduinoHardware._resolve_reply(self._count_request, self._linrail_count)
         
         def _linrail_home_callback(self, *data):
             conv_data, data = ArduinoHardware._unpack_sysex(*data)
@@ -212,16 +521,17 @@ class ArduinoHardware:
             # print("\tReceived SysEx message:", [d for d in data])
             # print(f"\tConverted data: {[bin(d) for d in conv_data]} = {conv_data}")
             
-            if conv_data[0] == 0xFF:
-                self._linrail_home_success = True
-            else:
-                self._linrail_home_success = False
+            self._update_count(conv_data)
+            ArduinoHardware._resolve_reply(self._home_request, conv_data[0] == 0xFF)
 
     class Gripper(StateTracker):
 
         MOVE_TIMEOUT = 3
         CHECK_TIMEOUT = 1
 
+        # Expected duration of an open or close, from the firmware: the servo sweeps 45 degrees at SERVO_SPEED_DELAY (ms) per degree
+        MOVE_DURATION = 46 * 15e-3
+
         def __init__(self, board) -> None:
             super().__init__()      # Initialize the StateTracker class
 
@@ -233,61 +543,58 @@ class ArduinoHardware:
             self.board.add_cmd_handler(GRIPPER_STATE, self._gripper_state_callback)
             self.board.add_cmd_handler(GRIPPER_STATE_ANGLE, self._gripper_angle_callback)
             
-            self._gripper_is_grabbed = None;    # Stores the state of the gripper
-            self._gripper_servo_angle = None;   # Stores the angle of the servo
-            self._gripper_move_success = None;  # Stores the success of the grab operation
+            self._gripper_is_grabbed = None;    # Stores the last state of the gripper
+            self._gripper_servo_angle = None;   # Stores the last angle of the servo
+            self._move_request = None;          # Future of the pending open/close, resolved with its success
+            self._state_request = None;         # Future of the pending state check, resolved with the state
+            self._angle_request = None;         # Future of the pending angle check, resolved with the angle
 
             # Set the callback function for the CommunicationErrorChecker
             ErrorChecker.set_get_state_callback(self.get_state)
         
         @ErrorChecker.user_confirm_action()
         def close(self):
+            if HardwareState.elide('gripper', 'CLOSED', "Gripper - close"):
+                return True
             self._track_state("MOVE_CLOSE")
-            self._gripper_move_success = None
+            HardwareState.invalidate('gripper')         # Unknown until the move is acknowledged
+            self._move_request = Future()
             self.board.send_sysex(GRIPPER_CLOSE, [])
             
             # Wait for the grab to complete, or timeout
-            start_time = time.time()
-            while not self._gripper_move_success and time.time() - start_time < self.MOVE_TIMEOUT:
-                time.sleep(0.1)
-            
-            if self._gripper_move_success is None:
-                raise CommunicationError("Gripper - Timeout, close failed")
+            move_success = ArduinoHardware._wait_for_reply(self._move_request, self.MOVE_TIMEOUT, "Gripper - Timeout, close failed")
+            if move_success:
+                HardwareState.set('gripper', 'CLOSED')
             
             logging.debug("Arduino - Gripper - Closed")
             
-            return self._gripper_move_success
+            return move_success
         
         @ErrorChecker.user_confirm_action()
         def open(self):
+            if HardwareState.elide('gripper', 'OPEN', "Gripper - open"):
+                return True
             self._track_state("MOVE_OPEN")
-            self._gripper_move_success = None
+            HardwareState.invalidate('gripper')         # Unknown until the move is acknowledged
+            self._move_request = Future()
             self.board.send_sysex(GRIPPER_OPEN, [])
             
             # Wait for the release to complete, or timeout
-            start_time = time.time()
-            while not self._gripper_move_success and time.time() - start_time < self.MOVE_TIMEOUT:
-                time.sleep(0.1)
-            
-            if self._gripper_move_success is None:
-                raise CommunicationError("Gripper - Timeout, Release failed")
+            move_success = ArduinoHardware._wait_for_reply(self._move_request, self.MOVE_TIMEOUT, "Gripper - Timeout, Release failed")
+            if move_success:
+                HardwareState.set('gripper', 'OPEN')
             
             logging.debug("Arduino - Gripper - Opened")
 
-            return self._gripper_move_success
+            return move_success
         
         @ErrorChecker.user_confirm_action()
         def check_state(self):
-            self._gripper_is_grabbed = None
+            self._state_request = Future()
             self.board.send_sysex(GRIPPER_STATE, [])
 
             # Wait for the state to be received, or timeout
-            start_time = time.time()
-            while self._gripper_is_grabbed is None and time.time() - start_time < self.CHECK_TIMEOUT:
-                time.sleep(0.1)
-            
-            if self._gripper_is_grabbed is None:
-                raise CommunicationError("Gripper - Timeout, State check failed")
+            ArduinoHardware._wait_for_reply(self._state_request, self.CHECK_TIMEOUT, "Gripper - Timeout, State check failed")
             
             logging.info(f"Arduino - Gripper - is grabbing: {self._gripper_is_grabbed}")
             
@@ -295,26 +602,18 @@ class ArduinoHardware:
         
         @ErrorChecker.user_confirm_action()
         def check_angle(self):
-            self._gripper_servo_angle = None
+            self._angle_request = Future()
             self.board.send_sysex(GRIPPER_STATE_ANGLE, [])
 
             # Wait for the angle to be received, or timeout
-            start_time = time.time()
-            while self._gripper_servo_angle is None and time.time() - start_time < self.CHECK_TIMEOUT:
-                time.sleep(0.1)
-
-            if self._gripper_servo_angle is None:
-                raise CommunicationError("Gripper - Timeout, Angle check failed")
+            ArduinoHardware._wait_for_reply(self._angle_request, self.CHECK_TIMEOUT, "Gripper - Timeout, Angle check failed")
             
             logging.info(f"Arduino - Gripper - Angle: {self._gripper_servo_angle}")
             return self._gripper_servo_angle
         
         def _gripper_move_callback(self, *data):
             conv_data, data = ArduinoHardware._unpack_sysex(*data)
-            if conv_data[0] == 0xFF:
-                self._gripper_move_success = True
-            else:
-                self._gripper_move_success = False
+            ArduinoHardware._resolve_reply(self._move_request, conv_data[0] == 0xFF)
 
         def _gripper_state_callback(self, *data):
             conv_data, data = ArduinoHardware._unpack_sysex(*data)
@@ -322,6 +621,7 @@ class ArduinoHardware:
             # print(f"\tConverted data: {[bin(d) for d in conv_data]} = {conv_data
 
             self._gripper_is_grabbed = bool(conv_data[0])
+            ArduinoHardware._resolve_reply(self._state_request, self._gripper_is_grabbed)
 
         def _gripper_angle_callback(self, *data):
             conv_data, data = ArduinoHardware._unpack_sysex(*data)
@@ -329,8 +629,19 @@ class ArduinoHardware:
             # print(f"\tConverted data: {[bin(d) for d in conv_data]} = {conv_data}")
             
             self._gripper_servo_angle = (conv_data[0])
+            ArduinoHardware._resolve_reply(self._angle_request, self._gripper_servo_angle)
+
+    # Macro steps: command -> (component, HardwareState after the step, tracked state, timeout (s) of the step)
+    MACRO_STEPS = {
+        GRIPPER_OPEN:  ('gripper', 'OPEN', "MOVE_OPEN", Gripper.MOVE_TIMEOUT),
+        GRIPPER_CLOSE: ('gripper', 'CLOSED', "MOVE_CLOSE", Gripper.MOVE_TIMEOUT),
+        LINRAIL_UP:    ('linear_rail', 'UP', "MOVE_UP", LinearRail.MOVE_TIMEOUT),
+        LINRAIL_DOWN:  ('linear_rail', 'DOWN', "MOVE_DOWN", LinearRail.MOVE_TIMEOUT),
+        LINRAIL_HOME:  ('linear_rail', 'DOWN', "HOME", LinearRail.HOME_TIMEOUT),
+    }
 
 if __name__ == "__main__":
     arduino_obj=ArduinoHardware("COM3")
     # arduino_obj.linear_rail.home()
-    arduino_obj.gripper.close()
\ No newline at end of file
+    arduino_obj.gripper.close()
+
@@ -1,9 +1,16 @@
 import serial
 import time
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from StateTracker import StateTracker
+from MotionPlanner import MotionPlanner
+from MotionTimeEstimator import MotionTimeEstimator
 import numpy as np
 import re
-from AISH_utils import CommunicationError, ErrorChecker
+from AISH_utils import CommunicationError, ErrorChecker, HardwareState
+from Tracer import Tracer
+from Metrics import Metrics
 
 import logging
 
@@ -20,6 +27,9 @@ pos_4 = np.array([40.6, 17.4, 5])
 pos_5 = np.array([79.75, 177.0, 15.5]) # Row 2, these are found center positions (have +/-0.3mm tolerance)
 pos_9 = np.array([80.7,17.45,16.5])
 
+# A single linear move of a procedure: target position in Ender3 coordinates and feedrate (mm/min)
+Waypoint = namedtuple('Waypoint', ['x', 'y', 'z', 'speed'])
+
 class Ender3(StateTracker):
     SAMPLE_MIN_Z = 30       #Minimum Z position to avoid collision with the samples
     SAMPLE_POSITIONS = np.append(np.linspace(pos_0, pos_4, num=5), np.linspace(pos_5, pos_9, num=5), axis=0)
@@ -27,15 +37,56 @@ class Ender3(StateTracker):
     STAGE_POSITION = (230.5, 0, 141)        #Position of the stage in Ender3 coordinates (only XZ matters, but insert Y=0)
     STAGE_Z_OFFSET_POS = 151              #Offset z-value position to avoid collision with the stage
 
-    ENDER_LIMITS = [(0, 230), (0, 220), (0, 143)]
-    ENDER_MAX_SPEED = np.array([1000, 1000, 300])
+    ENDER_LIMITS = [(0, 235), (0, 220), (0, 151)]     #X and Z must include the stage position and the Z offset above it
+    MOTION_ESTIMATOR = MotionTimeEstimator()       #Trapezoidal motion model with the stock Ender-3 feedrate, acceleration and jerk limits
+
+    # Collision model of the cell for the motion planner: boxes (lower corner, upper corner) the gripper must stay out of
+    SAMPLE_BUFFER_MARGIN = 15       #XY margin (mm) around the sample positions
+    STAGE_MARGIN_X = 15             #X margin (mm) in front of the stage position
+    STAGE_CLEARANCE = 5             #X clearance (mm) from the stage box while the linear rail moves, see Procedures.py
+    STAGE_STANDOFF_X = STAGE_POSITION[0] - STAGE_MARGIN_X - STAGE_CLEARANCE    #X position beside the stage, clear of the linear rail while it moves
+    PLANNER = MotionPlanner(ENDER_LIMITS, {
+        'sample_buffer': ((SAMPLE_POSITIONS[:, 0].min() - SAMPLE_BUFFER_MARGIN, SAMPLE_POSITIONS[:, 1].min() - SAMPLE_BUFFER_MARGIN, ENDER_LIMITS[2][0] - 1),
+                          (SAMPLE_POSITIONS[:, 0].max() + SAMPLE_BUFFER_MARGIN, SAMPLE_POSITIONS[:, 1].max() + SAMPLE_BUFFER_MARGIN, SAMPLE_MIN_Z - 1)),
+        'stage': ((STAGE_POSITION[0] - STAGE_MARGIN_X, ENDER_LIMITS[1][0] - 1, ENDER_LIMITS[2][0] - 1),
+                  (ENDER_LIMITS[0][1] + 1, ENDER_LIMITS[1][1] + 1, STAGE_Z_OFFSET_POS - 1)),
+        'furnace': ((STAGE_POSITION[0] - STAGE_MARGIN_X, ENDER_LIMITS[1][0] - 1, STAGE_Z_OFFSET_POS + 1),
+                    (ENDER_LIMITS[0][1] + 1, ENDER_LIMITS[1][1] + 1, np.inf)),
+    })
+
+    # State tracked for each motion procedure, formatted with the procedure arguments
+    PROCEDURE_STATES = {
+        'move_above_sample': "MOVE_ABOVE_SAMPLE_{}",
+        'move_to_sample': "MOVE_SAMPLE_{}",
+        'move_above_position': "MOVE_ABOVE_POSITION_{}_{}_{}",
+        'move_to_position': "MOVE_POSITION_{}_{}_{}",
+        'move_near_stage': "MOVE_NEAR_STAGE",
+        'move_to_stage': "MOVE_STAGE",
+        'move_to_rest': "MOVE_REST",
+        'move_eject_bed': "MOVE_EJECT",
+        'move_to_home': "MOVE_HOME",
+    }
+
+    GCODE_WINDOW = 4                # Max number of G-code lines sent without an 'ok' (Marlin's command buffer is 4 lines)
+    SERIAL_READ_TIMEOUT = 0.5       # Timeout of a blocking serial read in the reader thread, bounds how long close() waits
+    POSITION_QUERY_TIMEOUT = 2      # Timeout for an M114 position query, in seconds
+
+    # Policy for checking the dead-reckoned position against M114
+    POSITION_CHECK_AFTER_HOMING = True      # Query the position once homing is complete
+    POSITION_CHECK_EVERY_N_MOVES = 20       # Query after this many moves since the last check (0 to disable)
+    POSITION_DRIFT_TOLERANCE = 0.05         # Max distance (mm) between tracked and reported position before warning
+    SYNC_TIMEOUT_FACTOR = 1.5       # A sync times out after this multiple of the predicted motion time...
+    SYNC_TIMEOUT_MARGIN = 3         # ...plus this margin, in seconds
+    RESYNC_TIMEOUT = 60             # Max time (s) for the lines still queued on the Ender3 to complete after a timeout
+    POSITION_TOLERANCE = 0.001      # Positions closer than this (mm) are treated as the same point
+    POSITION_REGEX = re.compile(r"X:(-?\d+\.\d+) Y:(-?\d+\.\d+) Z:(-?\d+\.\d+)")
 
     def __init__(self, PORT):
         super().__init__()      # Initialize the StateTracker class
         self.PORT = PORT
 
         try:
-            self.serial = serial.Serial(PORT, 115200)
+            self.serial = serial.Serial(PORT, 115200, timeout=self.SERIAL_READ_TIMEOUT)
         except Exception as e:
             print(e)
             raise Exception("Failed to connect to Ender 3")
@@ -43,8 +94,29 @@ class Ender3(StateTracker):
         logging.info(f"Ender3 - Connected on port: {PORT}")
         self.serial.flushInput(); self.serial.flushOutput()
 
+        self._commands_in_flight = 0        # Number of G-code lines sent that Marlin has not acknowledged with 'ok' yet
+        self._send_times = deque()          # (G-code word, time sent) of the lines in flight, for Metrics.gcode_ack_seconds
+        self._pending_motion_time = 0       # Predicted time (s) to execute the moves streamed since the last sync
+        self._procedure_end_time = None     # Predicted time.time() at which the running procedure ends
+        self._ack_condition = threading.Condition()     # Notified by the reader thread on every 'ok'
+        self._link_synced = True            # False after a timeout, until the lines still on the Ender3 are accounted for
+        self._sync_token = 0                # Number of the last resync, echoed back by the Ender3
+        self._sync_request = None           # Future of the running resync, resolved by the reader thread
+        self._position_requests = deque()   # Futures of M114 queries, resolved in order by the reader thread
+
+        # Dead-reckoning: current_position follows the commanded moves and is only checked against M114 by policy
+        self._moves_since_position_check = 0
+        self._position_suspect = True       # Position is unknown until the first M114
+        self.last_position_drift = 0        # Distance (mm) between tracked and reported position at the last check
+        self.position_drift_since_home = 0  # Sum of the drift (mm) corrected at the checks since the last homing
+
+        # Start the reader thread, it frames the serial stream into lines and dispatches them
+        self._reader_stop = threading.Event()
+        self._reader_thread = threading.Thread(target=self._reader_loop, name="Ender3-reader", daemon=True)
+        self._reader_thread.start()
+
         # Set units to mm, set positioning to absolute mode
-        self.serial.write(str.encode("G21 G90\r\n")) 
+        self._send_gcode("G21 G90")
         
         self.current_position = np.array([0, 0, 0])
         self._update_current_position()     #Get the current position of the Ender3
@@ -61,15 +133,17 @@ class Ender3(StateTracker):
         Parameters:
         sample_num (int): The index of the sample position to move to.
         """
-        self._track_state(f"MOVE_SAMPLE_{sample_num}")
-        sample_pos = self.SAMPLE_POSITIONS[sample_num]
+        self.run_procedures(('move_to_sample', sample_num))
 
-        #Move to above the sample position first
-        self._move_to(self.current_position[0]  , self.current_position[1]  , self.SAMPLE_MIN_Z, 1200) #Move only Z first
-        self._move_to(sample_pos[0]             , sample_pos[1]             , self.SAMPLE_MIN_Z, 4000) #Move above the sample position
+    def move_above_sample(self, sample_num):
+        """
+        Moves the machine above the specified sample position at SAMPLE_MIN_Z, without descending onto it.
+        move_to_sample then only has to lower the gripper.
 
-        #Now we can move down to the sample position and grab the sample
-        self._move_to(*sample_pos, 1000)
+        Parameters:
+        sample_num (int): The index of the sample position to move above.
+        """
+        self.run_procedures(('move_above_sample', sample_num))
 
     def move_to_stage(self):
         """
@@ -81,16 +155,15 @@ class Ender3(StateTracker):
         Raises:
             Any exceptions raised by the _move_to or _track_state methods.
         """
-        self._track_state("MOVE_STAGE")
-
-        #First move Z to avoid collision with stage, also enables pickup
-        self._move_to(self.current_position[0], self.current_position[1], self.STAGE_Z_OFFSET_POS, 3000)
-
-        #Then move X to stage position
-        self._move_to(self.STAGE_POSITION[0], self.current_position[1], self.STAGE_Z_OFFSET_POS, 3000)
+        self.run_procedures('move_to_stage')
 
-        #Then move Z to stage position to place down the sample
-        self._move_to(self.STAGE_POSITION[0], self.current_position[1], self.STAGE_POSITION[2], 1000)
+    def move_near_stage(self):
+        """
+        Moves the machine beside the stage, at the height of the Z offset and short of the stage in X. 
+        The gripper is clear of the linear rail there, so this can run while the stage moves, and 
+        move_to_stage then only has to move X and lower the gripper.
+        """
+        self.run_procedures('move_near_stage')
 
     def move_to_rest(self):
         """
@@ -107,16 +180,7 @@ class Ender3(StateTracker):
         Raises:
             Any exceptions raised by the _move_to method.
         """
-        self._track_state("MOVE_REST")
-
-        # Move Z back up to avoid collision with the stage
-        self._move_to(self.current_position[0], self.current_position[1], self.STAGE_Z_OFFSET_POS, 1000)
-
-        # Move X backwards, gripper out of the way of everything
-        self._move_to(0, self.current_position[1], self.STAGE_Z_OFFSET_POS, 4000)
-        
-        #Move down to avoid collision with the furnace if we home the Ender3 next
-        self._move_to(0, self.current_position[1], self.STAGE_Z_OFFSET_POS-30, 4000)    
+        self.run_procedures('move_to_rest')
 
     # Moves the bed to the eject position, for loading/unloading the samples
     def move_eject_bed(self):
@@ -126,23 +190,240 @@ class Ender3(StateTracker):
         This method updates the state to "MOVE_EJECT" and moves the bed to the 
         maximum Y position while keeping the current X and Z positions unchanged.
         """
-        self._track_state("MOVE_EJECT")
-        self._move_to(self.current_position[0]  , self.current_position[1]  , self.SAMPLE_MIN_Z)     #First move Z up to avoid collision with the bed
-        self._move_to(0                         , self.current_position[1]  , self.SAMPLE_MIN_Z)     #Move bed to the eject position
-        self._move_to(0                         , self.ENDER_LIMITS[1][1]         , self.SAMPLE_MIN_Z, 4000)     #Move bed to the eject position
+        self.run_procedures('move_eject_bed')
 
     def move_to_home(self):
         """
         Moves the machine to its home position.
         """
-        self._track_state("MOVE_HOME")
+        self.run_procedures('move_to_home')
 
-        #Move Z up to avoid collision with the bed
-        self._move_to(self.current_position[0], self.current_position[1], self.SAMPLE_MIN_Z)
+    def run_procedures(self, *procedures):
+        """
+        Runs a sequence of motion procedures as a single batch of moves.
+
+        The segments of all procedures are compiled together (see compile_segments), so zero-length
+        moves and intermediate waypoints that do not change the path are dropped. The PLANNER then 
+        replaces axis-sequenced runs with straight moves where they clear the cell, and checks the path
+        against ENDER_LIMITS. The result is streamed and synced once at the end.
+
+        Args:
+            *procedures: Procedure names, e.g. 'move_to_rest', or tuples of a name and its 
+                         arguments, e.g. ('move_to_sample', 3). Names are keys of PROCEDURE_STATES.
+
+        Example:
+            ender3.run_procedures('move_to_rest', ('move_to_sample', 3))
+        """
+        if self._position_suspect:
+            # Plan from the reported position, the tracked one can not be trusted (e.g. after a timeout)
+            self._update_current_position()
+        states, planned_segments = self._build_path(self.current_position, procedures)
+
+        # Procedures compiled into one path are timed together, under the state of the last one
+        for state in states:
+            self._track_state(state)
+        if not planned_segments:
+            HardwareState.record_elided(f"Ender3 - {', '.join(states)}")
+            self._finish_state('elided')
+            return
+
+        self._procedure_end_time = time.time() + self.MOTION_ESTIMATOR.path_time(self.current_position, planned_segments)
+        outcome = 'failed'
+        try:
+            for waypoint in planned_segments:
+                self._move_to(*waypoint, wait=False)
+            self._finish_motion()
+            outcome = 'ok'
+        finally:
+            self._procedure_end_time = None
+            self._finish_state(outcome)
+
+    def get_eta(self):
+        """
+        Returns the predicted time (s) until the running procedure completes, or None if no procedure is running.
+        """
+        if self._procedure_end_time is None:
+            return None
+        return max(self._procedure_end_time - time.time(), 0)
 
-        #Now move bed out of the way
-        self._move_to(0, self.current_position[1], self.current_position[2])
-        self._move_to(0, 0, 0)
+    @classmethod
+    def estimate_procedures_time(cls, start, *procedures):
+        """
+        Predicts how long a sequence of procedures takes, without moving the Ender3.
+
+        Args:
+            start (array-like): Position (x, y, z) the procedures start from.
+            *procedures: Procedures in the same form as for run_procedures.
+
+        Returns:
+            tuple: Predicted duration (s) and the position (x, y, z) the procedures end at.
+        """
+        start = np.asarray(start, dtype=float)
+        _, planned_segments = cls._build_path(start, procedures)
+        end = np.array(planned_segments[-1][:3], dtype=float) if planned_segments else start
+        return cls.MOTION_ESTIMATOR.path_time(start, planned_segments), end
+
+    @classmethod
+    def stage_clearance(cls, start, *procedures):
+        """
+        Distance in X from the path of a sequence of procedures to the stage box, which the linear rail moves
+        the stage through. The box spans the whole Y and Z travel, so the straight moves of the path come
+        closest to it at their ends.
+
+        Args:
+            start (array-like): Position (x, y, z) the procedures start from.
+            *procedures: Procedures in the same form as for run_procedures.
+
+        Returns:
+            float: Smallest distance (mm) to the stage box, negative if the path enters it.
+        """
+        _, planned_segments = cls._build_path(np.asarray(start, dtype=float), procedures)
+        stage_x = cls.PLANNER.box_lo[cls.PLANNER.obstacle_names.index('stage')][0]
+        return stage_x - max([start[0]] + [waypoint.x for waypoint in planned_segments])
+
+    @classmethod
+    def _build_path(cls, start, procedures):
+        """
+        Builds the segments of a sequence of procedures, then compiles and plans them into the path to stream.
+
+        Returns:
+            tuple: The state of each procedure and the planned list of Waypoint.
+        """
+        states = []
+        segments = []
+        position = start
+        for procedure in procedures:
+            name, args = (procedure, ()) if isinstance(procedure, str) else (procedure[0], tuple(procedure[1:]))
+            states.append(cls.PROCEDURE_STATES[name].format(*args))
+
+            procedure_segments = getattr(cls, f"_segments_{name}")(position, *args)
+            if procedure_segments:
+                position = np.array(procedure_segments[-1][:3], dtype=float)
+            segments += procedure_segments
+
+        compiled_segments = cls.compile_segments(start, segments)
+        planned_segments = cls.PLANNER.plan(start, compiled_segments)
+        cls.PLANNER.check(start, planned_segments)
+        logging.debug(f"Ender3 - Compiled {len(segments)} segments into {len(planned_segments)}")
+        return states, planned_segments
+
+    @classmethod
+    def compile_segments(cls, start, segments):
+        """
+        Reduces a list of waypoints to the shortest equivalent list.
+
+        - Waypoints equal to the previous position (zero-length moves) are removed.
+        - A waypoint B between A and C is removed when A, B and C are collinear: the move A->C 
+          stays inside the path A->B->C, so it cannot reach anywhere the original path did not.
+          The merged move uses the slower of the two feedrates.
+
+        Args:
+            start (array-like): Position (x, y, z) the path starts from.
+            segments (list of Waypoint): Waypoints in the order they would be visited.
+
+        Returns:
+            list of Waypoint: The reduced path.
+        """
+        compiled = []
+        for waypoint in segments:
+            while waypoint is not None:
+                previous = np.array(compiled[-1][:3] if compiled else start, dtype=float)
+                step = np.array(waypoint[:3], dtype=float) - previous
+                if np.linalg.norm(step) < cls.POSITION_TOLERANCE:
+                    waypoint = None     # Zero-length move
+                    break
+
+                # Merge with the last waypoint if it lies on the straight line from the one before it to this one
+                if not compiled:
+                    break
+                before = np.array(compiled[-2][:3] if len(compiled) > 1 else start, dtype=float)
+                if np.linalg.norm(np.cross(previous - before, step)) >= cls.POSITION_TOLERANCE * np.linalg.norm(previous - before):
+                    break
+                waypoint = waypoint._replace(speed=min(waypoint.speed, compiled.pop().speed))
+
+            if waypoint is not None:
+                compiled.append(waypoint)
+        return compiled
+
+    @classmethod
+    def _segments_move_to_sample(cls, start, sample_num):
+        return cls._segments_move_to_position(start, *cls.SAMPLE_POSITIONS[sample_num])
+
+    @classmethod
+    def _segments_move_above_sample(cls, start, sample_num):
+        # The approach of move_to_sample, without the final descent
+        return cls._segments_move_to_sample(start, sample_num)[:-1]
+
+    @classmethod
+    def _segments_move_to_position(cls, start, x, y, z):
+        # A sample position given by its coordinates, e.g. one being calibrated
+        return [
+            #Move to above the sample position first
+            Waypoint(start[0]       , start[1]       , cls.SAMPLE_MIN_Z, 1200),    #Move only Z first
+            Waypoint(x              , y              , cls.SAMPLE_MIN_Z, 4000),    #Move above the sample position
+
+            #Now we can move down to the sample position and grab the sample
+            Waypoint(x, y, z, 1000),
+        ]
+
+    @classmethod
+    def _segments_move_above_position(cls, start, x, y, z):
+        return cls._segments_move_to_position(start, x, y, z)[:-1]
+
+    @classmethod
+    def _segments_move_to_stage(cls, start):
+        return [
+            #First move Z to avoid collision with stage, also enables pickup
+            Waypoint(start[0], start[1], cls.STAGE_Z_OFFSET_POS, 3000),
+
+            #Then move X to stage position
+            Waypoint(cls.STAGE_POSITION[0], start[1], cls.STAGE_Z_OFFSET_POS, 3000),
+
+            #Then move Z to stage position to place down the sample
+            Waypoint(cls.STAGE_POSITION[0], start[1], cls.STAGE_POSITION[2], 1000),
+        ]
+
+    @classmethod
+    def _segments_move_near_stage(cls, start):
+        return [
+            #Move Z up to the stage offset first, like move_to_stage
+            Waypoint(start[0], start[1], cls.STAGE_Z_OFFSET_POS, 3000),
+
+            #Then move X up to the standoff, short of the stage
+            Waypoint(cls.STAGE_STANDOFF_X, start[1], cls.STAGE_Z_OFFSET_POS, 3000),
+        ]
+
+    @classmethod
+    def _segments_move_to_rest(cls, start):
+        return [
+            # Move Z back up to avoid collision with the stage
+            Waypoint(start[0], start[1], cls.STAGE_Z_OFFSET_POS, 1000),
+
+            # Move X backwards, gripper out of the way of everything
+            Waypoint(0, start[1], cls.STAGE_Z_OFFSET_POS, 4000),
+
+            #Move down to avoid collision with the furnace if we home the Ender3 next
+            Waypoint(0, start[1], cls.STAGE_Z_OFFSET_POS-30, 4000),
+        ]
+
+    @classmethod
+    def _segments_move_eject_bed(cls, start):
+        return [
+            Waypoint(start[0], start[1]             , cls.SAMPLE_MIN_Z, 2000),    #First move Z up to avoid collision with the bed
+            Waypoint(0       , start[1]             , cls.SAMPLE_MIN_Z, 2000),    #Move bed to the eject position
+            Waypoint(0       , cls.ENDER_LIMITS[1][1], cls.SAMPLE_MIN_Z, 4000),    #Move bed to the eject position
+        ]
+
+    @classmethod
+    def _segments_move_to_home(cls, start):
+        return [
+            #Move Z up to avoid collision with the bed
+            Waypoint(start[0], start[1], cls.SAMPLE_MIN_Z, 2000),
+
+            #Now move bed out of the way
+            Waypoint(0, start[1], cls.SAMPLE_MIN_Z, 2000),
+            Waypoint(0, 0, 0, 2000),
+        ]
 
     def init_homing(self): 
         """
@@ -155,73 +436,261 @@ class Ender3(StateTracker):
         logging.info("Ender3 - Initiating homing routine")
         self._track_state("MOVE_HOME")
 
-        # Update current_position (XYZ)
-        self._update_current_position()
+        # Update current_position (XYZ), only needed if the tracked position cannot be trusted
+        if self._position_suspect:
+            self._update_current_position()
         #Move Z up to avoid collision with the bed
         self._move_to(self.current_position[0], self.current_position[1], self.current_position[2]+self.SAMPLE_MIN_Z)
         
         # (1) Gcode to move to HOME, do homing routine
-        self.serial.write(str.encode("G28\r\n"))
+        self._send_gcode("G28")
         self._wait_for_response(60)
 
-        # (2) Update current_position (XYZ)
-        self._update_current_position()
+        # (2) Update current_position (XYZ), the home position is set by the firmware
+        if self.POSITION_CHECK_AFTER_HOMING:
+            self._position_suspect = True       # Homing moves are not tracked, so a difference is not drift
+            self._update_current_position()
+        else:
+            self.current_position = np.array([0, 0, 0], dtype=float)
+        self.position_drift_since_home = 0
+        self._finish_state()
         
         logging.info("Ender3 - Homing routine complete")
     
     @ErrorChecker.user_confirm_action()
-    def _move_to(self, x, y, z, speed=2000):
-        #Calculate the distance to move, time to set the timeout
-        distances = np.array( [(x - self.current_position[0]), (y - self.current_position[1]), (z - self.current_position[2])] )
-        MAX_TIMEOUT = max( np.abs(distances)/self.ENDER_MAX_SPEED *60 ) + 10
-        # print(f"Distance: {distances}, Time: {MAX_TIMEOUT}")
+    def _move_to(self, x, y, z, speed=2000, wait=True):
+        """
+        Streams a linear move to (x, y, z) at the given feedrate (mm/min).
+
+        With wait=False the move is only queued on the Ender3, so consecutive segments of a procedure
+        run back to back; call _finish_motion() at the end of the procedure to wait for them.
+        """
+        #Predict the time of the move with the commanded feedrate, accumulate it to set the timeout
+        self._pending_motion_time += self.MOTION_ESTIMATOR.path_time(self.current_position, [(x, y, z, speed)])
 
         logging.debug(f"Ender3 - Starting move from {self.current_position} to ({x:.3f}, {y:.3f}, {z:.3f})")
-        self.serial.write(str.encode(f"G01 X{x} Y{y} Z{z} F{speed}\r\n"))   # Gcode to move to XYZ
-        #Wait for the move to complete
-        self._wait_for_response(MAX_TIMEOUT)
+        self._send_gcode(f"G01 X{x} Y{y} Z{z} F{speed}")   # Gcode to move to XYZ
 
-        #Update the current position
+        #Track the commanded position, following segments are planned from here
         self.current_position = np.array([x, y, z], dtype=float)
-        self._update_current_position()
+        self._moves_since_position_check += 1
 
-        logging.debug(f"Ender3 - Moved to: ({x:.3f}, {y:.3f}, {z:.3f})")
+        if wait:
+            self._finish_motion()
+            logging.debug(f"Ender3 - Moved to: ({x:.3f}, {y:.3f}, {z:.3f})")
 
     @ErrorChecker.user_confirm_action()
-    def _update_current_position(self):
-        # Gcode to get current position
-        self.serial.write(str.encode("M114\n"))
-        time.sleep(0.1)
-        
-        response = self.serial.read_all().decode('utf-8').strip()
+    def _finish_motion(self):
+        """
+        Syncs with the Ender3 at the end of a procedure: waits until every streamed move has been 
+        executed, then checks the tracked position against M114 if the policy asks for it.
+        """
+        self._wait_for_response(self._sync_timeout())
+        self._pending_motion_time = 0
 
-        # Parse the response and update the current position
-        match = re.search(r"X:(\d+\.\d+) Y:(\d+\.\d+) Z:(\d+\.\d+)", response)
+        if self._position_check_due():
+            self._update_current_position()
 
-        if match:
-            x, y, z = match.groups()
-            measured_position = np.array([float(x), float(y), float(z)], dtype=float)
+    def _position_check_due(self):
+        """
+        Returns True if the dead-reckoned position should be checked with M114: when drift is 
+        suspected (after an error or manual intervention), or every POSITION_CHECK_EVERY_N_MOVES moves.
+        """
+        if self._position_suspect:
+            return True
+        return self.POSITION_CHECK_EVERY_N_MOVES > 0 and self._moves_since_position_check >= self.POSITION_CHECK_EVERY_N_MOVES
 
-            if np.linalg.norm( measured_position - self.current_position ) > 0.001:
-                logging.debug(f"Ender3 - Position updated from {self.current_position} to {measured_position}")
+    def mark_position_suspect(self):
+        """
+        Flags the tracked position as unreliable (e.g. the gantry was moved by hand), 
+        so the next sync checks it against M114.
+        """
+        self._position_suspect = True
 
-            self.current_position = measured_position
+    @property
+    def _position_suspect(self):
+        # The trust in the tracked position is kept in the HardwareState, so errors anywhere invalidate it
+        return HardwareState.known.get('ender3') != 'POSITION_KNOWN'
+
+    @_position_suspect.setter
+    def _position_suspect(self, suspect):
+        if suspect:
+            HardwareState.invalidate('ender3')
         else:
+            HardwareState.set('ender3', 'POSITION_KNOWN')
+
+    @ErrorChecker.user_confirm_action()
+    def _update_current_position(self):
+        # Gcode to get current position, the reader thread resolves the future with the parsed response
+        position_request = Future()
+        self._position_requests.append(position_request)
+        self._send_gcode("M114")
+
+        try:
+            measured_position = position_request.result(timeout=self.POSITION_QUERY_TIMEOUT)
+        except FutureTimeoutError:
+            self._discard_position_request(position_request)
+            self._lose_sync()       # The M114 or its 'ok' may still come, or be lost
             raise CommunicationError("Ender3 - No response to update current position")
 
+        self.last_position_drift = np.linalg.norm( measured_position - self.current_position )
+        if not self._position_suspect:
+            self.position_drift_since_home += self.last_position_drift
+        if self.last_position_drift > self.POSITION_DRIFT_TOLERANCE and not self._position_suspect:
+            logging.warning(f"Ender3 - Position drifted {self.last_position_drift:.3f}mm: tracked {self.current_position}, reported {measured_position}")
+        elif self.last_position_drift > 0.001:
+            logging.debug(f"Ender3 - Position updated from {self.current_position} to {measured_position}")
+
+        self.current_position = measured_position
+        self._moves_since_position_check = 0
+        self._position_suspect = False
+
+    @Tracer.traced(category='serial')
     def _wait_for_response(self, MAX_TIMEOUT=20):
-        self.serial.write(str.encode("M400\n")) #Command to wait until movement is complete before moving to next command
-        self.serial.write(str.encode("M114\n")) #Command to get current position, this will only return when the move command is complete
-
-        #Keep checking the serial port every 0.5s until the move is complete and M114 returns the current position
-        start_time = time.time()
-        while time.time()-start_time < MAX_TIMEOUT:
-            response = self.serial.read_all().decode('utf-8').strip()
-            if "X" in response and "Y" in response and "Z" in response:
+        #M400 waits until movement is complete, so its 'ok' is only sent once all queued moves are done
+        self._send_gcode("M400")
+        self._wait_for_acks(MAX_TIMEOUT)
+
+    def _sync_timeout(self):
+        """
+        Timeout (s) for the moves streamed since the last sync, from their predicted time.
+        """
+        return self._pending_motion_time*self.SYNC_TIMEOUT_FACTOR + self.SYNC_TIMEOUT_MARGIN
+
+    def _send_gcode(self, command):
+        """
+        Writes one G-code line to the Ender3 without waiting for it to execute.
+
+        Marlin answers every line with 'ok' once it has room for the next one, so up to GCODE_WINDOW 
+        lines are kept in flight. When the window is full, this blocks until an 'ok' frees a slot.
+
+        Raises:
+            CommunicationError: If no 'ok' is received within the expected motion time, or the link
+                                can not be resynchronized after an earlier timeout.
+        """
+        if not self._link_synced:
+            self._resync()
+
+        timeout = self._sync_timeout()
+        with self._ack_condition:
+            if not self._ack_condition.wait_for(lambda: self._commands_in_flight < self.GCODE_WINDOW, timeout):
+                self._lose_sync()
+                raise CommunicationError(f"Ender3 - Timed out waiting for 'ok' before sending: {command}")
+
+            # Count the line before writing it, so an 'ok' can never arrive for an uncounted line
+            self._commands_in_flight += 1
+            self._send_times.append((command.split(" ", 1)[0], time.time()))
+            self.serial.write(str.encode(f"{command}\n"))
+
+    def _wait_for_acks(self, MAX_TIMEOUT):
+        """
+        Blocks until every G-code line in flight has been acknowledged with 'ok'.
+
+        Raises:
+            CommunicationError: If the acknowledgements do not arrive within MAX_TIMEOUT seconds.
+        """
+        with self._ack_condition:
+            if not self._ack_condition.wait_for(lambda: self._commands_in_flight == 0, MAX_TIMEOUT):
+                self._lose_sync()
+                raise CommunicationError("Ender3 - Wait command timed out")
+
+    def _lose_sync(self):
+        # After a timeout the lines in flight may still be queued on the Ender3 (e.g. a slow move), or lost. Their
+        # late 'ok's would be counted against new lines and overfill the window, and an M400 could return before
+        # the earlier motion is done, so nothing is sent until _resync has accounted for them
+        self._link_synced = False
+        self._position_suspect = True
+
+    def _resync(self):
+        """
+        Resynchronizes the sending window after a timeout: M400 waits for every queued move, then M118 echoes
+        a token that is unique to this resync. Marlin processes the lines in order, so once the token comes
+        back every earlier line has been answered, and only the 'ok' of the M118 itself is still due.
+
+        Raises:
+            CommunicationError: If the token does not come back within RESYNC_TIMEOUT.
+        """
+        self._sync_token += 1
+        token = f"AISH_SYNC_{self._sync_token}"
+        sync_request = self._sync_request = Future()
+        logging.warning(f"Ender3 - Resynchronizing after a timeout, {self._commands_in_flight} lines unaccounted for")
+        with self._ack_condition:
+            # Written outside of the window, it is unknown until the token comes back
+            self.serial.write(str.encode(f"M400\nM118 {token}\n"))
+        try:
+            sync_request.result(timeout=self.RESYNC_TIMEOUT)
+        except FutureTimeoutError:
+            raise CommunicationError(f"Ender3 - No response to resynchronize ({token})")
+        finally:
+            self._sync_request = None
+        logging.info(f"Ender3 - Resynchronized ({token})")
+
+    def _discard_position_request(self, position_request):
+        try:
+            self._position_requests.remove(position_request)
+        except ValueError:
+            pass    # Already resolved by the reader thread
+
+    def _reader_loop(self):
+        """
+        Runs in the reader thread: blocks on the serial port, frames the byte stream into lines 
+        (responses can arrive split across reads) and dispatches every complete line.
+        """
+        buffer = b""
+        while not self._reader_stop.is_set():
+            try:
+                chunk = self.serial.read(self.serial.in_waiting or 1)
+            except Exception as e:
+                if not self._reader_stop.is_set():
+                    logging.error(f"Ender3 - Serial read failed, reader thread stopped: {e}")
                 return
-            time.sleep(0.5)
-        
-        raise CommunicationError("Ender3 - Wait command timed out")
+
+            buffer += chunk
+            while b"\n" in buffer:
+                raw_line, buffer = buffer.split(b"\n", 1)
+                line = raw_line.decode('utf-8', errors='ignore').strip()
+                if line:
+                    self._dispatch_line(line)
+
+    def _dispatch_line(self, line):
+        """
+        Routes a response line from Marlin: the token of a resync resets the sending window, 'ok' frees a slot of it, 
+        'X:.. Y:.. Z:..' resolves the oldest pending position query, and 'echo:'/'Error:' go to the log.
+        """
+        sync_request = self._sync_request
+        if sync_request is not None and line == f"AISH_SYNC_{self._sync_token}":
+            with self._ack_condition:
+                # Every line before the M118 has been answered, its own 'ok' follows
+                self._commands_in_flight = 1
+                self._send_times.clear()
+                self._link_synced = True
+                self._ack_condition.notify_all()
+            sync_request.set_result(True)
+        elif line.startswith("ok"):
+            with self._ack_condition:
+                self._commands_in_flight = max(self._commands_in_flight - 1, 0)
+                sent = self._send_times.popleft() if self._send_times else None
+                self._ack_condition.notify_all()
+            if sent is not None:
+                Metrics.gcode_ack_seconds.observe(time.time() - sent[1], command=sent[0])
+        elif line.startswith("Error:"):
+            logging.error(f"Ender3 - {line}")
+        elif line.startswith("echo:"):
+            logging.debug(f"Ender3 - {line}")
+        else:
+            match = self.POSITION_REGEX.search(line)
+            if match and self._position_requests:
+                # Unsolicited reports (e.g. after G28) are ignored when no query is waiting
+                position_request = self._position_requests.popleft()
+                position_request.set_result(np.array([float(v) for v in match.groups()], dtype=float))
+
+    def close(self):
+        """
+        Stops the reader thread and closes the serial connection.
+        """
+        self._reader_stop.set()
+        self._reader_thread.join(timeout=2*self.SERIAL_READ_TIMEOUT)
+        self.serial.close()
     
 
 if __name__ == "__main__":
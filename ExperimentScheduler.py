@@ -0,0 +1,214 @@
+# Runs the queued AISH experiments one after another, pipelining the sample handling between them
+# The scheduler holds the next queued experiment, so it goes straight from the unload of one sample to the pickup
+# of the next, homing only when the HomingPolicy of the loader asks for it. While the cool-down scan of an
+# experiment runs, the gantry is moved beside the stage, so the unload starts with only the linear rail moving.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import logging
+from AISH_utils import StateError
+from Tracer import Tracer
+from Metrics import Metrics
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+class ExperimentScheduler:
+    PREPOSITION_DURING_HEATING = False      # Pre-position as soon as the sample is in the furnace, instead of at the cool-down scan
+    PREPOSITION_POLL_INTERVAL = 1           # Interval (s) to check if the experiment failed while waiting for the cool-down scan
+
+    def __init__(self, aish_loader):
+        """
+        Args:
+            aish_loader (AISHLoader): Loader that handles the samples, None to run the experiments without
+                                      hardware (website test mode).
+        """
+        self.aish_loader = aish_loader
+        self.queue = deque()            # (item id, experiment) waiting to run, the first one is next
+        self.current = None             # Experiment being run, None when idle
+        self.current_id = None          # Item id of the current experiment
+        self.stage = None               # Step of the current experiment: LOADING, RUNNING, UNLOADING
+        self.completed = 0              # Number of experiments completed since startup
+        self.failed = None              # Experiment that failed and dropped the queue, until the operator clears it
+        self.last_error = None          # Error it failed with
+        self.dropped_ids = []           # Item ids of the queued experiments the failure dropped, for the client to take back
+        self._submitted = 0             # Number of experiments submitted, numbers the items without an id
+
+        # Throughput of the current run of the queue, from the first load until the queue runs dry
+        self._run_start_time = None
+        self._run_end_time = None
+        self._run_completed = 0
+
+        self._lock = threading.Lock()
+        self._running = False           # True while the worker is draining the queue
+        self._worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ExperimentScheduler")
+        self._xrd = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ExperimentScheduler-xrd")
+
+        Metrics.samples_per_hour.set_function(self.get_samples_per_hour)
+
+    def submit(self, experiment, item_id=None):
+        """
+        Queues an experiment, it starts right away if the scheduler is idle.
+
+        Args:
+            experiment (AISHExperiment): Experiment to run.
+            item_id (str): Id of the item of the client, which follows it through get_state. Numbered if None.
+
+        Returns:
+            str: Item id of the experiment.
+
+        Raises:
+            StateError: If an experiment failed and the operator has not cleared the failure, see clear_failure.
+        """
+        with self._lock:
+            if self.failed is not None:
+                raise StateError(f"{self.failed} failed ({self.last_error}), clear the failure before queuing {experiment.name}")
+            self._submitted += 1
+            item_id = str(item_id) if item_id is not None else f"{experiment.name}-{self._submitted}"
+            self.queue.append((item_id, experiment))
+            logging.info(f"ExperimentScheduler - Queued {experiment.name} (sample {experiment.sample_num}), {len(self.queue)} waiting")
+            if not self._running:
+                self._running = True
+                self._run_start_time, self._run_end_time, self._run_completed = time.time(), None, 0
+                self._worker.submit(self._run_queue)
+        return item_id
+
+    def withdraw(self):
+        """
+        Takes back the queued experiments that have not started, e.g. when the client pauses its queue.
+
+        Returns:
+            list of str: Item ids of the withdrawn experiments, in queue order.
+        """
+        with self._lock:
+            item_ids = [item_id for item_id, _ in self.queue]
+            self.queue.clear()
+        if item_ids:
+            logging.info(f"ExperimentScheduler - Withdrew {len(item_ids)} queued experiments")
+        return item_ids
+
+    def abort(self):
+        """
+        Aborts the current experiment and withdraws the queued ones. The current sample is still unloaded.
+
+        Returns:
+            list of str: Item ids of the withdrawn experiments, in queue order.
+        """
+        item_ids = self.withdraw()
+        with self._lock:
+            current = self.current
+        if current is not None:
+            current.abort()
+        return item_ids
+
+    def clear_failure(self):
+        """
+        Accepts experiments again after a failure, once the operator has checked the hardware and the samples.
+        """
+        with self._lock:
+            if self.failed is not None:
+                logging.info(f"ExperimentScheduler - Failure of {self.failed} cleared")
+            self.failed, self.last_error, self.dropped_ids = None, None, []
+
+    def get_samples_per_hour(self):
+        """
+        Returns the throughput of the current (or last) run of the queue, None before the first sample completes.
+        """
+        with self._lock:
+            if not self._run_completed:
+                return None
+            elapsed = (self._run_end_time or time.time()) - self._run_start_time
+            return 3600 * self._run_completed / elapsed
+
+    def get_state(self):
+        with self._lock:
+            current = self.current
+            state = {'running': current.name if current is not None else None,
+                     'running_id': self.current_id,
+                     'stage': self.stage,
+                     'queued': [experiment.name for _, experiment in self.queue],
+                     'queued_ids': [item_id for item_id, _ in self.queue],
+                     'dropped_ids': list(self.dropped_ids),
+                     'completed': self.completed,
+                     'failed': self.failed,
+                     'last_error': self.last_error}
+        state['samples_per_hour'] = self.get_samples_per_hour()
+        return state
+
+    def _run_queue(self):
+        while True:
+            with self._lock:
+                if not self.queue:
+                    # Done in the same lock as the check, so submit starts a new worker for anything queued after it
+                    self._running = False
+                    self._run_end_time = time.time()
+                    if self._run_completed:
+                        logging.info(f"ExperimentScheduler - Queue done, {self._run_completed} samples at "
+                                     f"{3600 * self._run_completed / (self._run_end_time - self._run_start_time):.2f} samples/hour")
+                    return
+                self.current_id, experiment = self.queue.popleft()
+                self.current = experiment
+
+            try:
+                with Tracer.span("cycle", 'cycle', sample=experiment.sample_num, experiment=experiment.name):
+                    self._run_experiment(experiment)
+            except Exception as e:
+                logging.error(f"ExperimentScheduler - {experiment.name} failed, dropping the queue: {e}")
+                # In one step, so a client never sees the queue empty without the failure and sends the next item
+                with self._lock:
+                    self.dropped_ids = [item_id for item_id, _ in self.queue]
+                    self.queue.clear()
+                    self.failed, self.last_error = experiment.name, str(e) or type(e).__name__
+                    self.current, self.current_id, self.stage = None, None, None
+            else:
+                with self._lock:
+                    self.completed += 1
+                    self._run_completed += 1
+                Metrics.samples_completed.inc()
+            finally:
+                with self._lock:
+                    self.current, self.current_id, self.stage = None, None, None
+
+    def _run_experiment(self, experiment):
+        """
+        Loads the sample, runs the XRD sequence while pre-positioning the gantry for the unload, and
+        unloads the sample. The gantry is left at the sample position, the next load starts from there
+        unless the homing policy asks for a home.
+
+        Raises:
+            StateError: If the sample was not loaded or unloaded.
+        """
+        loader = self.aish_loader
+
+        self.stage = "LOADING"
+        logging.info(f"ExperimentScheduler - Loading sample {experiment.sample_num} for {experiment.name}")
+        if loader is not None:
+            loader.load_sample(experiment.sample_num)
+            if loader.SAMPLE_LOADED != experiment.sample_num:
+                raise StateError(f"Sample {experiment.sample_num} was not loaded")
+
+        self.stage = "RUNNING"
+        logging.info(f"ExperimentScheduler - Running XRD of {experiment.name}")
+        sequence = self._xrd.submit(experiment.run_sequence)
+
+        # Pre-position for the unload while the XRD runs, unless it fails first
+        if loader is not None:
+            if not self.PREPOSITION_DURING_HEATING:
+                while not experiment.cooling_down.wait(self.PREPOSITION_POLL_INTERVAL) and not sequence.done():
+                    pass
+            if not sequence.done():
+                loader.preposition_for_unload()
+        sequence.result()
+
+        self.stage = "UNLOADING"
+        logging.info(f"ExperimentScheduler - Unloading sample {experiment.sample_num}")
+        if loader is not None:
+            loader.unload_sample()
+            if loader.SAMPLE_LOADED is not None:
+                raise StateError(f"Sample {experiment.sample_num} was not unloaded")
+            loader.home_if_needed()
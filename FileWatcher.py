@@ -0,0 +1,168 @@
+# Waits for changes in a directory without polling it on a fixed interval
+# The XRD hands over its results by files: the Job.xml of a scan disappears from the LabLims directory once
+# the diffractometer picks it up, and the results file appears in the results directory once the scan is done.
+# Waiting for those is event-driven where the OS supports it, with inotify on Linux and change notifications
+# on Windows (both through ctypes), and wakes up as soon as the directory changes. Elsewhere, or if the watch
+# cannot be set up (e.g. some network shares), the directory is polled with an interval that backs off.
+#
+#   FileWatcher.wait_for(results_dir, lambda names: len(names) > 0, timeout=3600)
+
+import ctypes
+import ctypes.util
+import select
+import sys
+import os
+import time
+import logging
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+class _InotifyWatch:
+    # inotify_init1 flags and the events that change the list of files in a directory, see inotify(7)
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    EVENTS = 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | 0x400 | 0x800  # CLOSE_WRITE, MOVED_FROM/TO, CREATE, DELETE, DELETE/MOVE_SELF
+
+    _libc = None
+
+    def __init__(self, directory):
+        if _InotifyWatch._libc is None:
+            _InotifyWatch._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        libc = _InotifyWatch._libc
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory), self.EVENTS) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f"inotify_add_watch failed for {directory}")
+
+    def wait(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if ready:
+            # Drain the queued events, the caller re-checks the directory itself
+            try:
+                while os.read(self.fd, 65536):
+                    pass
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        os.close(self.fd)
+
+class _WindowsWatch:
+    FILE_NOTIFY_CHANGE_FILE_NAME = 0x1
+    FILE_NOTIFY_CHANGE_SIZE = 0x8
+    INVALID_HANDLE_VALUE = ctypes.c_void_p(-1).value
+
+    def __init__(self, directory):
+        kernel32 = self.kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+        kernel32.FindFirstChangeNotificationW.restype = ctypes.c_void_p
+        kernel32.FindFirstChangeNotificationW.argtypes = [ctypes.c_wchar_p, ctypes.c_int, ctypes.c_uint32]
+        kernel32.FindNextChangeNotification.argtypes = [ctypes.c_void_p]
+        kernel32.FindCloseChangeNotification.argtypes = [ctypes.c_void_p]
+        kernel32.WaitForSingleObject.argtypes = [ctypes.c_void_p, ctypes.c_uint32]
+        kernel32.WaitForSingleObject.restype = ctypes.c_uint32
+
+        self.handle = kernel32.FindFirstChangeNotificationW(os.path.abspath(directory), False,
+                                                            self.FILE_NOTIFY_CHANGE_FILE_NAME | self.FILE_NOTIFY_CHANGE_SIZE)
+        if self.handle in (None, self.INVALID_HANDLE_VALUE):
+            raise OSError(ctypes.get_last_error(), f"FindFirstChangeNotification failed for {directory}")
+
+    def wait(self, timeout):
+        # WAIT_OBJECT_0 (0) when the directory changed, the notification is then re-armed for the next wait
+        if self.kernel32.WaitForSingleObject(self.handle, int(timeout * 1000)) == 0:
+            self.kernel32.FindNextChangeNotification(self.handle)
+
+    def close(self):
+        self.kernel32.FindCloseChangeNotification(self.handle)
+
+class _PollWatch:
+    def __init__(self, directory, expected_time=None):
+        self.interval = FileWatcher.MIN_POLL_INTERVAL
+        self.quiet_until = time.monotonic() + expected_time if expected_time else None
+
+    def wait(self, timeout):
+        # Until the expected time nothing is expected to change, then polls fast and backs off again
+        now = time.monotonic()
+        if self.quiet_until is not None and now < self.quiet_until:
+            time.sleep(min(self.quiet_until - now, timeout))
+            return
+        time.sleep(min(self.interval, timeout))
+        self.interval = min(self.interval * FileWatcher.POLL_BACKOFF, FileWatcher.MAX_POLL_INTERVAL)
+
+    def close(self):
+        pass
+
+class FileWatcher:
+    MIN_POLL_INTERVAL = 0.05    # First poll interval (s) without events, doubled after every poll ...
+    POLL_BACKOFF = 2
+    MAX_POLL_INTERVAL = 5       # ... up to this, as often as the directory was polled before
+    MAX_EVENT_WAIT = 60         # Max time (s) between checks with events, in case a change was not notified
+
+    @staticmethod
+    def wait_for(directory, condition, timeout, expected_time=None):
+        """
+        Blocks until the files in a directory satisfy a condition, checking it every time the directory changes.
+
+        Args:
+            directory (str): Directory to watch.
+            condition (function): Called with the list of file names in the directory, returns True when done.
+            timeout (float): Max time (s) to wait.
+            expected_time (float): When polling, how long (s) the change is expected to take at least, so
+                                   the directory is not polled before.
+
+        Returns:
+            bool: True if the condition was met, False on timeout.
+        """
+        deadline = time.monotonic() + timeout
+        # The watch is set up before the first check, so a change right after it is not missed
+        watch = FileWatcher._open_watch(directory, expected_time)
+        try:
+            while True:
+                if condition(os.listdir(directory)):
+                    return True
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                watch.wait(min(remaining, FileWatcher.MAX_EVENT_WAIT))
+        finally:
+            watch.close()
+
+    @staticmethod
+    def wait_for_complete(path, settle_time, timeout):
+        """
+        Blocks until a file stops changing, i.e. its size and modification time stay the same for
+        settle_time. A new file is created before its writer has finished writing it.
+
+        Returns:
+            bool: True if the file settled, False on timeout or if it was removed.
+        """
+        deadline = time.monotonic() + timeout
+        last, settled_since = None, time.monotonic()
+        while time.monotonic() < deadline:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                return False
+            if (stat.st_size, stat.st_mtime_ns) != last:
+                last, settled_since = (stat.st_size, stat.st_mtime_ns), time.monotonic()
+            elif time.monotonic() - settled_since >= settle_time:
+                return True
+            time.sleep(settle_time / 5)
+        return False
+
+    @staticmethod
+    def _open_watch(directory, expected_time=None):
+        try:
+            if sys.platform.startswith('linux'):
+                return _InotifyWatch(directory)
+            if sys.platform == 'win32':
+                return _WindowsWatch(directory)
+        except (OSError, AttributeError) as e:
+            logging.warning(f"FileWatcher - Can not watch {directory}, polling it instead: {e}")
+        return _PollWatch(directory, expected_time)
@@ -0,0 +1,168 @@
+# Minimal Firmata client for the sysex protocol of the AISHLoader Arduino
+# Replaces pyFirmata, which only runs on Python <= 3.10. Only what ArduinoHardware uses is implemented:
+# sending sysex commands and dispatching sysex replies to handlers, with the same add_cmd_handler/send_sysex
+# interface as pyfirmata.Arduino. Replies are read by a thread blocking on the serial port, not by polling.
+
+import serial
+import threading
+import time
+import logging
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+# Firmata protocol bytes
+START_SYSEX = 0xF0
+END_SYSEX = 0xF7
+REPORT_VERSION = 0xF9
+REPORT_FIRMWARE = 0x79
+
+class FirmataClient:
+    BAUDRATE = 57600            # Firmata.begin(57600) in the firmware
+    SERIAL_READ_TIMEOUT = 0.5   # Max time (s) a read blocks, only bounds how long close() takes
+    READY_TIMEOUT = 5           # Max time (s) to wait for the board to report its version after opening the port
+
+    def __init__(self, PORT, baudrate=BAUDRATE, ready_timeout=READY_TIMEOUT) -> None:
+        """
+        Opens the serial port and waits until the board reports its Firmata version. Opening the port resets
+        most Arduinos, and the firmware reports its version once it has started.
+
+        Args:
+            PORT (str): Serial port of the Arduino.
+            baudrate (int): Baud rate of the firmware.
+            ready_timeout (float): Max time (s) to wait for the version report.
+        """
+        self.serial = serial.Serial(PORT, baudrate, timeout=self.SERIAL_READ_TIMEOUT)
+
+        self.firmata_version = None         # (major, minor) of the Firmata protocol
+        self.firmware = None                # (name, major, minor) of the firmware
+        self._handlers = {REPORT_FIRMWARE: self._firmware_callback}
+        self._write_lock = threading.Lock()
+        self._ready = threading.Event()
+
+        self._sysex = None                  # Data of the sysex message being received, None outside of one
+        self._message = None                # Bytes of the non-sysex message being received
+
+        self._running = True
+        self._reader = threading.Thread(target=self._reader_loop, name="FirmataClient-reader", daemon=True)
+        self._reader.start()
+
+        # Boards that do not reset when the port opens only report their version when asked, so ask every
+        # second. A board still in its bootloader ignores the query and reports once the firmware starts
+        deadline = time.time() + ready_timeout
+        self._write(bytes([REPORT_VERSION]))
+        while not self._ready.wait(min(1, max(deadline - time.time(), 0))):
+            if time.time() >= deadline:
+                logging.warning(f"FirmataClient - No version reported on {PORT}, continuing anyway")
+                break
+            self._write(bytes([REPORT_VERSION]))
+
+    def add_cmd_handler(self, command, handler):
+        """
+        Registers the handler of a sysex command, called with the raw 7-bit data bytes of each reply.
+        Handlers run on the reader thread.
+        """
+        self._handlers[command] = handler
+
+    def send_sysex(self, command, data=[]):
+        """
+        Sends a sysex command.
+
+        Args:
+            command (int): Sysex command byte (0x00-0x7F).
+            data (list of int): 7-bit data bytes, see pack_7bit.
+
+        Raises:
+            ValueError: If the command or a data byte does not fit in 7 bits.
+        """
+        message = bytes([START_SYSEX, command, *data, END_SYSEX])
+        if any(byte > 0x7F for byte in message[1:-1]):
+            raise ValueError(f"FirmataClient - Sysex bytes must be 7-bit: {[hex(byte) for byte in message[1:-1]]}")
+        self._write(message)
+
+    def close(self):
+        self._running = False
+        self._reader.join()
+        self.serial.close()
+
+    @staticmethod
+    def pack_7bit(values):
+        """
+        Splits bytes into (LSB, MSB) pairs of 7 bits, the encoding of Firmata.sendSysex.
+        """
+        values = bytes(values)
+        return [byte for value in values for byte in (value & 0x7F, value >> 7)]
+
+    @staticmethod
+    def unpack_7bit(data):
+        """
+        Joins (LSB, MSB) pairs of 7 bits back into bytes, the inverse of pack_7bit.
+        """
+        return [lsb | (msb << 7) for lsb, msb in zip(data[0::2], data[1::2])]
+
+    def _write(self, message):
+        with self._write_lock:
+            self.serial.write(message)
+
+    def _reader_loop(self):
+        while self._running:
+            try:
+                chunk = self.serial.read(self.serial.in_waiting or 1)
+            except (serial.SerialException, OSError, TypeError) as e:
+                # TypeError: pyserial reads from a closed port on some platforms
+                if self._running:
+                    logging.error(f"FirmataClient - Serial read failed: {e}")
+                return
+            if chunk:
+                self._parse(chunk)
+
+    def _parse(self, chunk):
+        for byte in chunk:
+            if self._sysex is not None:
+                if byte == END_SYSEX:
+                    self._dispatch_sysex(self._sysex)
+                    self._sysex = None
+                elif byte & 0x80:
+                    # A command byte can not be part of a sysex message, the end was lost
+                    logging.warning(f"FirmataClient - Incomplete sysex message dropped: {list(self._sysex)}")
+                    self._sysex = None
+                    self._parse(bytes([byte]))
+                else:
+                    self._sysex.append(byte)
+            elif byte == START_SYSEX:
+                self._sysex = bytearray()
+            elif byte & 0x80:
+                # Other Firmata messages are a command byte and two data bytes
+                self._message = bytearray([byte])
+            elif self._message is not None:
+                self._message.append(byte)
+                if len(self._message) == 3:
+                    if self._message[0] == REPORT_VERSION:
+                        self.firmata_version = (self._message[1], self._message[2])
+                        self._ready.set()
+                    self._message = None
+
+    def _dispatch_sysex(self, message):
+        if len(message) == 0:
+            return
+        command, data = message[0], list(message[1:])
+        handler = self._handlers.get(command)
+        if handler is None:
+            logging.debug(f"FirmataClient - Unhandled sysex {hex(command)}: {data}")
+            return
+        try:
+            handler(*data)
+        except Exception as e:
+            # Keep the reader alive, a waiting request will time out instead
+            logging.error(f"FirmataClient - Handler of sysex {hex(command)} failed: {e}")
+
+    def _firmware_callback(self, *data):
+        # Major and minor version bytes, then the file name of the firmware as 7-bit pairs
+        if len(data) >= 2:
+            name = bytes(FirmataClient.unpack_7bit(data[2:])).decode('utf-8', errors='ignore')
+            self.firmware = (name, data[0], data[1])
+            logging.info(f"FirmataClient - Firmware {name} {data[0]}.{data[1]}")
+        self._ready.set()
@@ -0,0 +1,87 @@
+# Decides when the AISHLoader hardware needs homing, instead of homing after every sample
+# Homing the Ender3 (G28) and the linear rail adds tens of seconds to a cycle, and is only needed when the tracked
+# positions may be off: every EVERY_N_CYCLES cycles as a safeguard, when the Ender3 position checks (M114) found
+# too much drift, when the rail count does not match its position, after a CommunicationError, or on request.
+
+from collections import deque
+import time
+import logging
+from AISH_utils import ErrorChecker, HardwareState
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+class HomingPolicy:
+    EVERY_N_CYCLES = 10             # Home after this many cycles without homing (0 to disable)
+    MAX_POSITION_DRIFT = 0.5        # Max drift (mm) of the Ender3 corrected by position checks since the last home
+    MAX_RAIL_COUNT_ERROR = 400      # Max difference (steps) between the rail count and its position, one revolution
+
+    def __init__(self, ender3, linear_rail, every_n_cycles=EVERY_N_CYCLES, max_position_drift=MAX_POSITION_DRIFT,
+                 max_rail_count_error=MAX_RAIL_COUNT_ERROR):
+        """
+        Args:
+            ender3 (Ender3): Its position_drift_since_home is checked.
+            linear_rail (ArduinoHardware.LinearRail): Its get_count_error is checked.
+            every_n_cycles (int): Home after this many cycles, 1 homes after every cycle, 0 never by count.
+            max_position_drift (float): Drift (mm) of the Ender3 that triggers a home.
+            max_rail_count_error (int): Rail count error (steps) that triggers a home.
+        """
+        self.ender3 = ender3
+        self.linear_rail = linear_rail
+        self.every_n_cycles = every_n_cycles
+        self.max_position_drift = max_position_drift
+        self.max_rail_count_error = max_rail_count_error
+
+        self.cycles_since_home = 0
+        self.history = deque(maxlen=100)        # (time, reason) of the last homes
+        self._requested = None                  # Reason of a pending request, see request
+        self._communication_errors = ErrorChecker.communication_errors     # Count at the last home
+
+    def record_cycle(self):
+        """
+        Counts a completed load/unload cycle.
+        """
+        self.cycles_since_home += 1
+
+    def request(self, reason="requested"):
+        """
+        Asks for a home before the next cycle, e.g. after the hardware was touched by hand.
+        """
+        self._requested = reason
+
+    def get_home_reason(self):
+        """
+        Returns why the hardware should be homed now, or None if it does not need to be.
+        """
+        if self._requested is not None:
+            return self._requested
+        if ErrorChecker.communication_errors > self._communication_errors:
+            return "communication error"
+        if self.every_n_cycles and self.cycles_since_home >= self.every_n_cycles:
+            return f"{self.cycles_since_home} cycles since the last home"
+        if self.ender3.position_drift_since_home > self.max_position_drift:
+            return f"Ender3 drifted {self.ender3.position_drift_since_home:.3f}mm"
+        if HardwareState.known.get('linear_rail') is None:
+            return "linear rail position unknown"
+        count_error = self.linear_rail.get_count_error()
+        if count_error is not None and count_error > self.max_rail_count_error:
+            return f"linear rail count off by {count_error} steps"
+        return None
+
+    def record_home(self, reason):
+        """
+        Resets the triggers after the hardware was homed.
+        """
+        logging.info(f"HomingPolicy - Homed after {self.cycles_since_home} cycles, reason: {reason}")
+        self.history.append((time.time(), reason))
+        self.cycles_since_home = 0
+        self._requested = None
+        self._communication_errors = ErrorChecker.communication_errors
+
+    def get_state(self):
+        return {'cycles_since_home': self.cycles_since_home,
+                'pending_reason': self.get_home_reason(),
+                'last_home': self.history[-1] if self.history else None}
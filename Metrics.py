@@ -0,0 +1,170 @@
+# Runtime metrics of the AISHLoader, served by app.py at /api/metrics in the Prometheus text exposition format
+# Counters and histograms are updated where the events happen: the Arduino sysex replies, the Ender3 'ok'
+# acknowledgements, the procedures, the CommunicationErrors and the XRD scans. An update is a dict lookup and
+# an addition under a lock, and the exposition text is only built when /api/metrics is scraped.
+#
+#   Metrics.procedure_seconds.observe(6.5, procedure='load_sample')
+#   with Metrics.scan_seconds.time(precision='Low'):
+#       ...
+#   print(Metrics.render())
+
+from bisect import bisect_left
+import threading
+import time
+
+class _Metric:
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        """
+        Args:
+            name (str): Metric name, e.g. 'aish_procedure_seconds'.
+            documentation (str): HELP text of the metric.
+            labelnames (tuple of str): Names of the labels, every update gives a value for each of them.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}       # Tuple of label values -> value of the metric
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"Metrics - {self.name} has labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+        return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+    def collect(self):
+        """
+        Returns the lines of the metric in the text exposition format.
+        """
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.extend(self._format_samples(key, value))
+        return lines
+
+    def _format_samples(self, key, value):
+        return [f"{self.name}{self._format_labels(key)} {value}"]
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """
+        Reads the value from function() on every scrape instead, for a value already kept elsewhere.
+        A None result leaves the gauge out of the exposition.
+        """
+        self._function = function
+
+    def collect(self):
+        if self._function is not None:
+            value = self._function()
+            with self._lock:
+                self._values = {} if value is None else {(): value}
+        return super().collect()
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+    # Upper bounds (s) of the buckets, from serial round trips (ms) to scans (hours)
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100,
+                       250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # Count of each bucket (the last one is +Inf), then the sum of the values
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """
+        Returns a context manager that observes how long the code it wraps takes, unless it raises.
+        """
+        return _Timer(self, labels)
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.TYPE}"]
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else repr(float(bound))
+                lines.append(f"{self.name}_bucket{self._format_labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._format_labels(key)} {counts[-1]}")
+            lines.append(f"{self.name}_count{self._format_labels(key)} {cumulative}")
+        return lines
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+class Metrics:
+    sysex_roundtrip_seconds = Histogram('aish_sysex_roundtrip_seconds',
+                                        "Time from an Arduino sysex command to its reply, 'move' waits include the rail travel",
+                                        ['wait'])
+    gcode_ack_seconds = Histogram('aish_gcode_ack_seconds',
+                                  "Time from writing a G-code line to the Ender3 until its 'ok', M400 includes the queued motion",
+                                  ['command'])
+    procedure_seconds = Histogram('aish_procedure_seconds', "Duration of the completed AISHLoader procedures", ['procedure'])
+    communication_errors = Counter('aish_communication_errors_total', "CommunicationErrors caught, by device", ['device'])
+    scan_seconds = Histogram('aish_scan_seconds', "Duration of the completed XRD scans", ['precision'])
+    samples_completed = Counter('aish_samples_completed_total', "Experiments completed by the ExperimentScheduler")
+    samples_per_hour = Gauge('aish_samples_per_hour', "Throughput of the current (or last) run of the experiment queue")
+
+    @staticmethod
+    def all():
+        return [value for value in vars(Metrics).values() if isinstance(value, _Metric)]
+
+    @staticmethod
+    def render():
+        """
+        Returns every metric in the Prometheus text exposition format (version 0.0.4).
+        """
+        return "\n".join(line for metric in Metrics.all() for line in metric.collect()) + "\n"
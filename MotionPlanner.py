@@ -0,0 +1,166 @@
+# Collision-aware path shortening for the Ender3
+# The cell (sample buffer, stage, furnace) is modelled as axis-aligned boxes. The axis-sequenced paths
+# of the Ender3 procedures are shortened with straight (diagonal or combined) moves, but only where a
+# vectorized segment-vs-box test proves the straight move clears every box.
+
+import numpy as np
+import logging
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+class MotionPlanner:
+    TOLERANCE = 1e-6        # Distances (mm) below this are treated as zero
+
+    def __init__(self, limits, obstacles):
+        """
+        Args:
+            limits (list of tuple): (min, max) travel of the X, Y and Z axes.
+            obstacles (dict): Maps a name to the (lower corner, upper corner) of a box the gripper
+                              must stay out of. A box may only be entered or left by a vertical move,
+                              which is how samples are picked from the buffer and placed on the stage.
+        """
+        self.limits = np.array(limits, dtype=float)
+        self.obstacle_names = list(obstacles)
+        self.box_lo = np.array([obstacles[name][0] for name in self.obstacle_names], dtype=float)
+        self.box_hi = np.array([obstacles[name][1] for name in self.obstacle_names], dtype=float)
+
+    def plan(self, start, waypoints):
+        """
+        Shortens a path by replacing runs of waypoints with a single straight move wherever it is clear.
+
+        Starting from the current point, the farthest waypoint that can be reached in a straight line
+        is taken next. The original segments are kept where no shortcut is clear. The shortcut keeps the
+        feedrate of every axis at or below the fastest the replaced segments commanded for it.
+
+        Args:
+            start (array-like): Position (x, y, z) the path starts from.
+            waypoints (list of Waypoint): The path to shorten.
+
+        Returns:
+            list of Waypoint: The planned path, ending at the same point.
+
+        Raises:
+            ValueError: If any waypoint is outside of the axis limits.
+        """
+        self.validate(waypoints)
+        if len(waypoints) < 2:
+            return list(waypoints)
+
+        points = np.vstack([np.asarray(start, dtype=float)] + [np.array(waypoint[:3], dtype=float) for waypoint in waypoints])
+
+        planned = []
+        i = 0
+        while i < len(waypoints):
+            # Test every straight move from point i to a later point at once, take the farthest clear one
+            candidates = np.arange(len(points) - 1, i + 1, -1)
+            clear = self.segments_clear(np.repeat(points[i][None], len(candidates), axis=0), points[candidates])
+            j = candidates[np.argmax(clear)] if clear.any() else i + 1
+
+            if j == i + 1:
+                planned.append(waypoints[i])
+            else:
+                planned.append(waypoints[j - 1]._replace(speed=self._shortcut_speed(points[i], waypoints[i:j])))
+            i = j
+
+        if len(planned) < len(waypoints):
+            logging.debug(f"MotionPlanner - Shortened path from {len(waypoints)} to {len(planned)} segments")
+        return planned
+
+    def validate(self, waypoints):
+        """
+        Checks that every waypoint is inside the axis limits. Straight moves between waypoints then
+        stay inside them too.
+
+        Raises:
+            ValueError: If a waypoint is outside of the axis limits.
+        """
+        if len(waypoints) == 0:
+            return
+        points = np.array([waypoint[:3] for waypoint in waypoints], dtype=float)
+        outside = (points < self.limits[:, 0] - self.TOLERANCE) | (points > self.limits[:, 1] + self.TOLERANCE)
+        if outside.any():
+            row = np.argmax(outside.any(axis=1))
+            raise ValueError(f"MotionPlanner - Waypoint {points[row]} is outside of the limits {self.limits.tolist()}")
+
+    def check(self, start, waypoints):
+        """
+        Checks that a path stays inside the axis limits and that every move of it clears the boxes.
+
+        Raises:
+            ValueError: If a waypoint is outside of the axis limits, or a move goes through a box.
+        """
+        self.validate(waypoints)
+        if len(waypoints) == 0:
+            return
+        points = np.vstack([np.asarray(start, dtype=float)] + [np.array(waypoint[:3], dtype=float) for waypoint in waypoints])
+        hits = self._segment_hits(points[:-1], points[1:])
+        if hits.any():
+            row, box = np.argwhere(hits)[0]
+            raise ValueError(f"MotionPlanner - Move from {points[row]} to {points[row + 1]} goes through the {self.obstacle_names[box]}")
+
+    def segments_clear(self, starts, ends):
+        """
+        Vectorized segment-vs-box test (slab method) of N segments against every box.
+
+        A segment is clear if it does not overlap any box with a positive length, touching a face is
+        allowed. A vertical segment may cross a box if one of its ends is inside it (pick or place).
+
+        Args:
+            starts (np.ndarray): (N, 3) start points.
+            ends (np.ndarray): (N, 3) end points.
+
+        Returns:
+            np.ndarray: (N,) boolean array, True for segments that are clear.
+        """
+        return ~self._segment_hits(starts, ends).any(axis=1)
+
+    def _segment_hits(self, starts, ends):
+        # (N, M) boolean array, True where segment n goes through box m, see segments_clear
+        starts, ends = np.asarray(starts, dtype=float), np.asarray(ends, dtype=float)
+        direction = ends - starts                                       # (N, 3)
+        lo, hi = self.box_lo[None], self.box_hi[None]                   # (1, M, 3)
+        origin = starts[:, None]                                        # (N, 1, 3)
+
+        # Parameter t (0 at start, 1 at end) where the segment crosses the two planes of each slab
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_lo = (lo - origin) / direction[:, None]
+            t_hi = (hi - origin) / direction[:, None]
+        t_near, t_far = np.minimum(t_lo, t_hi), np.maximum(t_lo, t_hi)
+
+        # On axes without motion the segment is either always or never within the slab
+        static = (np.abs(direction) < self.TOLERANCE)[:, None]         # (N, 1, 3)
+        within = (origin > lo) & (origin < hi)                          # (N, M, 3)
+        t_near = np.where(static, np.where(within, -np.inf, np.inf), t_near)
+        t_far = np.where(static, np.where(within, np.inf, -np.inf), t_far)
+
+        enter = np.maximum(t_near.max(axis=2), 0)
+        leave = np.minimum(t_far.min(axis=2), 1)
+        hits = leave - enter > self.TOLERANCE                           # (N, M)
+
+        # Vertical moves into or out of a box are how samples are picked and placed
+        vertical = (np.abs(direction[:, :2]) < self.TOLERANCE).all(axis=1)[:, None]
+        start_inside = ((origin > lo) & (origin < hi)).all(axis=2)
+        end_inside = ((ends[:, None] > lo) & (ends[:, None] < hi)).all(axis=2)
+        allowed = vertical & (start_inside | end_inside)
+
+        return hits & ~allowed
+
+    def _shortcut_speed(self, start, waypoints):
+        """
+        Feedrate (mm/min) for a straight move replacing the given waypoints, chosen so that no axis
+        moves faster than the fastest the replaced segments moved it.
+        """
+        axis_speed = np.zeros(3)
+        previous = np.asarray(start, dtype=float)
+        for waypoint in waypoints:
+            step = np.array(waypoint[:3], dtype=float) - previous
+            axis_speed = np.maximum(axis_speed, waypoint.speed * np.abs(step) / np.linalg.norm(step))
+            previous = np.array(waypoint[:3], dtype=float)
+
+        displacement = previous - np.asarray(start, dtype=float)
+        moving = np.abs(displacement) > self.TOLERANCE
+        return float(np.min(axis_speed[moving] * np.linalg.norm(displacement) / np.abs(displacement[moving])))
@@ -0,0 +1,68 @@
+# Predicts how long the Ender3 takes to execute a path of linear moves
+# Each move follows Marlin's trapezoidal velocity profile: it starts at the jerk-limited speed, accelerates
+# to the commanded feedrate (clamped to the axis limits), cruises, and decelerates to the jerk-limited speed.
+
+import numpy as np
+
+class MotionTimeEstimator:
+
+    def __init__(self, max_feedrate=(500, 500, 5), max_acceleration=(500, 500, 100), acceleration=500, jerk=(10, 10, 0.3)):
+        """
+        The defaults are the stock Ender-3 Marlin settings.
+
+        Args:
+            max_feedrate (tuple): Max speed of the X, Y and Z axes (mm/s), DEFAULT_MAX_FEEDRATE.
+            max_acceleration (tuple): Max acceleration of the X, Y and Z axes (mm/s^2), DEFAULT_MAX_ACCELERATION.
+            acceleration (float): Acceleration used for moves (mm/s^2), DEFAULT_ACCELERATION.
+            jerk (tuple): Max instant speed change of the X, Y and Z axes (mm/s), DEFAULT_[XYZ]JERK.
+        """
+        self.max_feedrate = np.array(max_feedrate, dtype=float)
+        self.max_acceleration = np.array(max_acceleration, dtype=float)
+        self.acceleration = float(acceleration)
+        self.jerk = np.array(jerk, dtype=float)
+
+    def segment_times(self, start, waypoints):
+        """
+        Predicts the duration of each move of a path, vectorized over all moves.
+
+        Args:
+            start (array-like): Position (x, y, z) the path starts from.
+            waypoints (list): Waypoints (x, y, z, speed) with the feedrate in mm/min, as sent with G01.
+
+        Returns:
+            np.ndarray: Duration (s) of each move.
+        """
+        if len(waypoints) == 0:
+            return np.zeros(0)
+
+        targets = np.array([waypoint[:4] for waypoint in waypoints], dtype=float)
+        points = np.vstack([np.asarray(start, dtype=float)[None], targets[:, :3]])
+        steps = np.abs(np.diff(points, axis=0))                     # (N, 3)
+        length = np.linalg.norm(steps, axis=1)                      # (N,)
+        moving = length > 0
+
+        # Ratio of the path speed to each axis speed, the axis limits are scaled by it
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.where(steps > 0, length[:, None] / steps, np.inf)
+
+        speed = np.minimum(targets[:, 3] / 60, (self.max_feedrate * ratio).min(axis=1))
+        accel = np.minimum(self.acceleration, (self.max_acceleration * ratio).min(axis=1))
+        edge_speed = np.minimum(speed, (self.jerk * ratio).min(axis=1))    # Speed at the start and end of the move
+
+        # Trapezoid: accelerate from edge_speed to speed, cruise, decelerate back to edge_speed
+        ramp_distance = (speed**2 - edge_speed**2) / accel
+        cruise = ramp_distance <= length
+        with np.errstate(divide='ignore', invalid='ignore'):
+            trapezoid_time = 2 * (speed - edge_speed) / accel + (length - ramp_distance) / speed
+
+            # Triangle: the move is too short to reach the feedrate
+            peak_speed = np.sqrt(accel * length + edge_speed**2)
+            triangle_time = 2 * (peak_speed - edge_speed) / accel
+
+        return np.where(moving, np.where(cruise, trapezoid_time, triangle_time), 0)
+
+    def path_time(self, start, waypoints):
+        """
+        Predicts the duration (s) of a whole path.
+        """
+        return float(self.segment_times(start, waypoints).sum())
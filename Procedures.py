@@ -0,0 +1,319 @@
+# Declarative definitions of the AISHLoader procedures, compiled into validated action plans
+# A procedure is a list of steps. Each step runs one or more commands on a device, once the steps it comes after
+# have completed: Ender3 motion procedures (run as a single path) or Arduino commands (run as a macro if there is
+# more than one). ProcedurePlan compiles a procedure for its parameters into a plan that is validated against
+# the Ender3 limits, the sample positions, the linear rail and the safety orderings, caches it, and runs it on
+# an AISHLoader through the ActionGraph executor as often as needed.
+
+from collections import namedtuple
+import numpy as np
+import logging
+from ActionGraph import ActionGraph
+from Metrics import Metrics
+from AISH_utils import CommunicationError
+from Ender3 import Ender3
+from ArduinoHardware import ArduinoHardware
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+# A procedure: names of its parameters and its steps, in the order each device runs them
+Procedure = namedtuple('Procedure', ['params', 'steps'])
+
+# A step: commands (name, *args) run on `device` ('ender3' or 'arduino') once the steps named in `after` completed
+Step = namedtuple('Step', ['name', 'device', 'commands', 'after'], defaults=[()])
+
+# An argument of a command that is replaced by the value of a procedure parameter
+Param = namedtuple('Param', ['name'])
+
+# Arduino commands: the method running a single command, and its duration from the firmware timings
+ARDUINO_COMMANDS = {
+    'gripper_open': (lambda arduino: arduino.gripper.open, ArduinoHardware.Gripper.MOVE_DURATION),
+    'gripper_close': (lambda arduino: arduino.gripper.close, ArduinoHardware.Gripper.MOVE_DURATION),
+    'rail_up': (lambda arduino: arduino.linear_rail.move_up, ArduinoHardware.LinearRail.MOVE_DURATION),
+    'rail_down': (lambda arduino: arduino.linear_rail.move_down, ArduinoHardware.LinearRail.MOVE_DURATION),
+    'rail_home': (lambda arduino: arduino.linear_rail.home, ArduinoHardware.LinearRail.MOVE_DURATION),
+}
+
+# Commands of different devices that must never run at the same time, so a procedure must order them
+SAFETY_ORDERINGS = [
+    ({'move_to_stage', 'move_to_rest'}, {'rail_up', 'rail_down', 'rail_home'},
+     "the gripper is over the stage while the linear rail moves"),
+    ({'move_to_sample', 'move_to_position', 'move_to_stage'}, {'gripper_open', 'gripper_close'},
+     "the gripper descends onto a sample while it opens or closes"),
+]
+
+# Commands that move the stage through the cell. Ender3 steps that are not ordered with them may run while the
+# stage moves, so their whole path must stay Ender3.STAGE_CLEARANCE (mm) short of the stage box
+RAIL_COMMANDS = {'rail_up', 'rail_down', 'rail_home'}
+
+PROCEDURES = {
+    'load_sample': Procedure(params=('sample_num',), steps=[
+        #(1) Move 3D printer to sample in sample buffer, the gripper opens on the way and before descending
+        Step('open_gripper', 'arduino', [('gripper_open',)]),
+        Step('move_above_sample', 'ender3', [('move_above_sample', Param('sample_num'))]),
+        Step('move_to_sample', 'ender3', [('move_to_sample', Param('sample_num'))], after=('open_gripper', 'move_above_sample')),
+
+        #(2) Grab Sample with Gripper
+        Step('grab_sample', 'arduino', [('gripper_close',)], after=('move_to_sample',)),
+
+        #(3) Move 3D printer to sample stage
+        Step('move_to_stage', 'ender3', [('move_to_stage',)], after=('grab_sample',)),
+
+        #(4) Release sample with Gripper
+        Step('release_sample', 'arduino', [('gripper_open',)], after=('move_to_stage',)),
+
+        #(5) Return 3D printer to rest
+        Step('move_to_rest', 'ender3', [('move_to_rest',)], after=('release_sample',)),
+
+        #(6) Move stage up into furnace, once the gripper is clear of it
+        Step('rail_up', 'arduino', [('rail_up',)], after=('move_to_rest',)),
+    ]),
+
+    'unload_sample': Procedure(params=('sample_num',), steps=[
+        #(1) Remove sample stage from furnace and open the gripper, in one round trip to the Arduino.
+        #    Meanwhile the 3D printer moves beside the stage, clear of the rail
+        Step('rail_down', 'arduino', [('rail_down',), ('gripper_open',)]),
+        Step('move_near_stage', 'ender3', [('move_near_stage',)]),
+
+        #(2) Move 3D printer to stage, once it is out of the furnace
+        Step('move_to_stage', 'ender3', [('move_to_stage',)], after=('rail_down', 'move_near_stage')),
+
+        #(3) Grab Sample with Gripper
+        Step('grab_sample', 'arduino', [('gripper_close',)], after=('move_to_stage',)),
+
+        #(4) Move 3D printer through the rest position to the Sample position (where it was originally stored)
+        Step('move_to_sample', 'ender3', [('move_to_rest',), ('move_to_sample', Param('sample_num'))], after=('grab_sample',)),
+
+        #(5) Release sample with Gripper
+        Step('release_sample', 'arduino', [('gripper_open',)], after=('move_to_sample',)),
+    ]),
+
+    # Moves a sample to another (empty) position of the sample buffer
+    'shuffle': Procedure(params=('from_sample', 'to_sample'), steps=[
+        Step('open_gripper', 'arduino', [('gripper_open',)]),
+        Step('move_above_sample', 'ender3', [('move_above_sample', Param('from_sample'))]),
+        Step('move_to_sample', 'ender3', [('move_to_sample', Param('from_sample'))], after=('open_gripper', 'move_above_sample')),
+        Step('grab_sample', 'arduino', [('gripper_close',)], after=('move_to_sample',)),
+        Step('move_to_target', 'ender3', [('move_to_sample', Param('to_sample'))], after=('grab_sample',)),
+        Step('release_sample', 'arduino', [('gripper_open',)], after=('move_to_target',)),
+    ]),
+
+    # Grabs a sample at a position (x, y, z), lifts it and puts it back, to check that the gripper is centred on it
+    # before the position is used as a sample position (see calibration). SAMPLE_POSITIONS are left unchanged
+    'grip_test': Procedure(params=('x', 'y', 'z'), steps=[
+        Step('open_gripper', 'arduino', [('gripper_open',)]),
+        Step('move_above_position', 'ender3', [('move_above_position', Param('x'), Param('y'), Param('z'))]),
+        Step('move_to_position', 'ender3', [('move_to_position', Param('x'), Param('y'), Param('z'))], after=('open_gripper', 'move_above_position')),
+        Step('grab_sample', 'arduino', [('gripper_close',)], after=('move_to_position',)),
+        Step('lift_sample', 'ender3', [('move_above_position', Param('x'), Param('y'), Param('z'))], after=('grab_sample',)),
+        Step('return_sample', 'ender3', [('move_to_position', Param('x'), Param('y'), Param('z'))], after=('lift_sample',)),
+        Step('release_sample', 'arduino', [('gripper_open',)], after=('return_sample',)),
+    ]),
+
+    # Picks up every sample of the buffer and puts it back, to check that all positions can be reached
+    'buffer_audit': Procedure(params=(), steps=[Step('open_gripper', 'arduino', [('gripper_open',)])] + [
+        step
+        for sample_num in range(len(Ender3.SAMPLE_POSITIONS))
+        for step in [
+            Step(f'move_to_sample_{sample_num}', 'ender3', [('move_to_sample', sample_num)],
+                 after=('open_gripper',) if sample_num == 0 else (f'release_sample_{sample_num - 1}',)),
+            Step(f'grab_sample_{sample_num}', 'arduino', [('gripper_close',)], after=(f'move_to_sample_{sample_num}',)),
+            Step(f'lift_sample_{sample_num}', 'ender3', [('move_above_sample', sample_num)], after=(f'grab_sample_{sample_num}',)),
+            Step(f'return_sample_{sample_num}', 'ender3', [('move_to_sample', sample_num)], after=(f'lift_sample_{sample_num}',)),
+            Step(f'release_sample_{sample_num}', 'arduino', [('gripper_open',)], after=(f'return_sample_{sample_num}',)),
+        ]
+    ]),
+}
+
+class ProcedurePlan:
+    _cache = {}     # Compiled plans by (procedure name, parameter values)
+
+    def __init__(self, name, params, steps):
+        """
+        Use ProcedurePlan.get, it compiles and validates the plan once and caches it.
+
+        Args:
+            name (str): Name of the procedure, a key of PROCEDURES.
+            params (dict): Values of the procedure parameters.
+            steps (list of Step): Steps with the parameters substituted.
+        """
+        self.name = name
+        self.params = params
+        self.steps = steps
+
+    @classmethod
+    def get(cls, name, **params):
+        """
+        Returns the plan of a procedure for the given parameters, compiling it on first use.
+
+        Raises:
+            ValueError: If the procedure is unknown or the plan is invalid.
+        """
+        key = (name, tuple(sorted(params.items())))
+        if key not in cls._cache:
+            cls._cache[key] = cls.compile(name, **params)
+        return cls._cache[key]
+
+    @classmethod
+    def compile_all(cls):
+        """
+        Compiles every procedure at startup, so an invalid definition fails before any hardware moves.
+        Procedures with a single sample parameter are compiled for every sample position, the others
+        for their first position; the remaining plans are compiled on first use.
+
+        Raises:
+            ValueError: If a plan is invalid.
+        """
+        sample_nums = range(len(Ender3.SAMPLE_POSITIONS))
+        for name, procedure in PROCEDURES.items():
+            if len(procedure.params) == 1:
+                for sample_num in sample_nums:
+                    cls.get(name, **{procedure.params[0]: sample_num})
+            else:
+                cls.get(name, **{param: i for i, param in enumerate(procedure.params)})
+        logging.info(f"ProcedurePlan - Compiled {len(cls._cache)} plans of {len(PROCEDURES)} procedures")
+
+    @classmethod
+    def compile(cls, name, **params):
+        """
+        Substitutes the parameters into the steps of a procedure and validates the result:
+        - the parameters match the procedure and the steps, commands and dependencies are known
+        - the steps of each device are ordered by their dependencies, in the order they are listed
+        - the commands of SAFETY_ORDERINGS are ordered by their dependencies
+        - Ender3 steps that may run while the linear rail moves stay STAGE_CLEARANCE short of the stage box
+        - every Ender3 path is inside ENDER_LIMITS, clears the collision boxes of the PLANNER and goes to existing sample positions
+        - the linear rail does not move up twice or down twice
+
+        Raises:
+            ValueError: If the plan is invalid.
+        """
+        if name not in PROCEDURES:
+            raise ValueError(f"ProcedurePlan - Unknown procedure: {name}")
+        procedure = PROCEDURES[name]
+        if set(params) != set(procedure.params):
+            raise ValueError(f"ProcedurePlan - {name} takes the parameters {procedure.params}, got {tuple(params)}")
+
+        steps = [step._replace(commands=[tuple(params[arg.name] if isinstance(arg, Param) else arg for arg in command)
+                                         for command in step.commands])
+                 for step in procedure.steps]
+
+        # The ActionGraph checks the names and dependencies, build one without running it
+        graph = ActionGraph(name)
+        for step in steps:
+            graph.add(step.name, step.device, None, after=step.after)
+
+        ancestors = {}
+        for step in steps:
+            ancestors[step.name] = set(step.after).union(*(ancestors[dependency] for dependency in step.after))
+        ordered = lambda a, b: a.name in ancestors[b.name] or b.name in ancestors[a.name]
+
+        last_step = {}
+        for step in steps:
+            previous = last_step.get(step.device)
+            if previous is not None and previous.name not in ancestors[step.name]:
+                raise ValueError(f"ProcedurePlan - {name}: {step.name} must come after {previous.name}, both run on the {step.device}")
+            last_step[step.device] = step
+
+        for ender_commands, arduino_commands, hazard in SAFETY_ORDERINGS:
+            ender_steps = [step for step in steps if step.device == 'ender3' and ender_commands & {command[0] for command in step.commands}]
+            arduino_steps = [step for step in steps if step.device == 'arduino' and arduino_commands & {command[0] for command in step.commands}]
+            for ender_step in ender_steps:
+                for arduino_step in arduino_steps:
+                    if not ordered(ender_step, arduino_step):
+                        raise ValueError(f"ProcedurePlan - {name}: {ender_step.name} and {arduino_step.name} are not ordered, {hazard}")
+
+        plan = cls(name, params, steps)
+        plan.estimate_time()        # Builds and checks every Ender3 path
+
+        # Each Ender3 path is checked from where the previous one ends, the first from the home position
+        rail_steps = [step for step in steps if step.device == 'arduino' and RAIL_COMMANDS & {command[0] for command in step.commands}]
+        position = np.zeros(3)
+        for step in steps:
+            if step.device != 'ender3':
+                continue
+            overlapping = [rail_step.name for rail_step in rail_steps if not ordered(step, rail_step)]
+            if overlapping:
+                clearance = Ender3.stage_clearance(position, *step.commands)
+                if clearance < Ender3.STAGE_CLEARANCE - Ender3.POSITION_TOLERANCE:
+                    raise ValueError(f"ProcedurePlan - {name}: {step.name} may run while {overlapping} move the stage, but comes "
+                                     f"within {clearance:.2f} mm of the stage box (STAGE_CLEARANCE is {Ender3.STAGE_CLEARANCE} mm)")
+            _, position = Ender3.estimate_procedures_time(position, *step.commands)
+        return plan
+
+    def run(self, aish_loader):
+        """
+        Runs the plan on the hardware of an AISHLoader, see ActionGraph.run.
+        """
+        graph = ActionGraph(self.name.upper())
+        for step in self.steps:
+            graph.add(step.name, step.device, self._bind(aish_loader, step), after=step.after)
+        with Metrics.procedure_seconds.time(procedure=self.name):
+            return graph.run()
+
+    def estimate_time(self, start=(0, 0, 0)):
+        """
+        Predicts how long the plan takes, with the overlap of the executor: each step starts once its
+        dependencies have completed and its device is free.
+
+        Args:
+            start (array-like): Position (x, y, z) of the Ender3 when the plan starts.
+
+        Returns:
+            tuple: Predicted duration (s) and the position (x, y, z) the Ender3 ends at.
+
+        Raises:
+            ValueError: If a path is outside of ENDER_LIMITS or through a collision box, goes to an unknown sample position,
+                        or the linear rail moves the same way twice.
+        """
+        position = np.asarray(start, dtype=float)
+        rail_state = None
+        finish, device_free = {}, {}
+        for step in self.steps:
+            if step.device == 'ender3':
+                for command in step.commands:
+                    if command[0] in ('move_to_sample', 'move_above_sample') and command[1] not in range(len(Ender3.SAMPLE_POSITIONS)):
+                        raise ValueError(f"ProcedurePlan - {self.name}: unknown sample position at {step.name}: {command[1]}")
+                try:
+                    duration, position = Ender3.estimate_procedures_time(position, *step.commands)
+                except (IndexError, KeyError, AttributeError, ValueError) as e:
+                    raise ValueError(f"ProcedurePlan - {self.name} {self.params}: invalid path at {step.name}: {e}")
+            else:
+                unknown = [command[0] for command in step.commands if command[0] not in ARDUINO_COMMANDS]
+                if unknown:
+                    raise ValueError(f"ProcedurePlan - {self.name}: unknown Arduino commands at {step.name}: {unknown}")
+                for command in step.commands:
+                    if command[0] in ('rail_up', 'rail_down'):
+                        if rail_state == command[0]:
+                            raise ValueError(f"ProcedurePlan - {self.name}: {step.name} repeats {command[0]}")
+                        rail_state = command[0]
+                    elif command[0] == 'rail_home':
+                        rail_state = 'rail_down'
+                duration = sum(ARDUINO_COMMANDS[command[0]][1] for command in step.commands)
+
+            begin = max([device_free.get(step.device, 0)] + [finish[dependency] for dependency in step.after])
+            finish[step.name] = device_free[step.device] = begin + duration
+        return max(finish.values(), default=0), position
+
+    @staticmethod
+    def _bind(aish_loader, step):
+        if step.device == 'ender3':
+            return lambda: aish_loader.ender3.run_procedures(*step.commands)
+
+        def run_arduino():
+            # ErrorChecker only logs a StateError and returns None, and a refused rail move returns False, so the
+            # result is checked here: the ActionGraph must not start the steps that come after a failed one
+            if len(step.commands) == 1:
+                result = ARDUINO_COMMANDS[step.commands[0][0]][0](aish_loader.arduino)()
+            else:
+                macro = aish_loader.arduino.macro()
+                for command in step.commands:
+                    getattr(macro, command[0])()
+                result = macro.run()
+            if result is None or result is False or (isinstance(result, list) and not all(result)):
+                raise CommunicationError(f"ProcedurePlan - {step.name} {[command[0] for command in step.commands]} did not complete: {result}")
+            return result
+        return run_arduino
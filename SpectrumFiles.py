@@ -0,0 +1,48 @@
+# Reads and writes the text files of XRD spectra: the XRD.ascii results of the diffractometer and the .xy files
+# saved for every scan. High precision scans over a wide 2theta range have up to millions of points, so both are
+# done in bulk: the results are parsed by NumPy in one pass instead of splitting every line in Python, and the
+# .xy lines are formatted in a single operation. See benchmarks/benchmark_spectrum_files.py.
+
+import numpy as np
+
+class SpectrumFiles:
+    RESULTS_HEADER_LINES = 3    # Lines before the data in XRD.ascii
+    RESULTS_ANGLE_COLUMN = 2    # Column of 2theta in XRD.ascii, the counts are in the last column
+
+    @staticmethod
+    def read_results(path):
+        """
+        Reads the 2theta angles and the counts of an XRD.ascii results file, with ';' separated columns.
+
+        Returns:
+            tuple: x (2theta) and y (counts), as float arrays.
+        """
+        data = np.loadtxt(path, delimiter=';', skiprows=SpectrumFiles.RESULTS_HEADER_LINES,
+                          usecols=(SpectrumFiles.RESULTS_ANGLE_COLUMN, -1), ndmin=2)
+        return data[:, 0], data[:, 1]
+
+    @staticmethod
+    def write_xy(path, x, y):
+        """
+        Writes a spectrum as an .xy file, one 'x y' line per point. The values are written with the
+        shortest repr of each float, so the file is the same as one written line by line with '%s %s'.
+        A failed scan, [None] and [None], is written as a 'None None' line.
+        """
+        if len(x) and x[0] is None:
+            with open(path, 'w+') as f:
+                f.writelines('%s %s\n' % (xval, yval) for (xval, yval) in zip(x, y))
+            return
+        values = np.column_stack([np.asarray(x, dtype=float), np.asarray(y, dtype=float)]).ravel().tolist()
+        with open(path, 'w+') as f:
+            f.write(("%r %r\n" * (len(values) // 2)) % tuple(values))
+
+    @staticmethod
+    def read_xy(path):
+        """
+        Reads an .xy file written by write_xy.
+
+        Returns:
+            tuple: x and y, as float arrays.
+        """
+        data = np.loadtxt(path, ndmin=2)
+        return data[:, 0], data[:, 1]
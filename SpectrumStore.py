@@ -0,0 +1,178 @@
+# Append-only binary store of the spectra of an AISH experiment, one file per experiment next to its .xy files
+# Every scan is appended as a record: its metadata (temperature, time, scan parameters) as JSON, then its x and y
+# arrays as little-endian float64. Readers memory-map the file, so a single scan or the whole temperature series
+# is read without parsing text or loading the other scans. A record is only complete once its arrays are
+# written, a record cut short by a crash is ignored. export_xy converts the scans to the usual .xy files.
+#
+# Layout: FILE_MAGIC, then per scan: RECORD_MAGIC, metadata length (uint32), points (uint64), metadata padded to
+# 8 bytes, x (float64 x points), y (float64 x points)
+#
+#   store = SpectrumStore('AISH_results/test/spectra.aish')
+#   store.append(x, y, temperature=500, precision='Low')
+#   temperatures, x, y = store.read_series()
+#
+#   python SpectrumStore.py AISH_results/test/spectra.aish [out_dir]
+
+from datetime import datetime
+import threading
+import struct
+import json
+import sys
+import os
+import logging
+import numpy as np
+from SpectrumFiles import SpectrumFiles
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+class SpectrumStore:
+    FILE_MAGIC = b'AISHSPC1'
+    RECORD_MAGIC = b'SCAN'
+    RECORD_HEADER = struct.Struct('<4sIQ')
+    DTYPE = np.dtype('<f8')
+
+    def __init__(self, path):
+        """
+        Args:
+            path (str): File of the store, created by the first append.
+        """
+        self.path = path
+        self._records = []      # (metadata, offset of x) of each complete record
+        self._indexed_size = 0  # File size up to which the records are indexed
+        self._map = None
+        self._lock = threading.Lock()
+
+    def append(self, x, y, **metadata):
+        """
+        Appends a scan to the store.
+
+        Args:
+            x (array-like): 2theta angles.
+            y (array-like): Counts, as many as x.
+            **metadata: Stored with the scan, must be JSON serializable, e.g. temperature and precision.
+                        The time of the scan is added as 'timestamp' if not given.
+
+        Returns:
+            int: Index of the scan in the store.
+        """
+        x, y = np.asarray(x, dtype=self.DTYPE), np.asarray(y, dtype=self.DTYPE)
+        if x.shape != y.shape or x.ndim != 1:
+            raise ValueError(f"SpectrumStore - x and y must be 1D arrays of the same length, got {x.shape} and {y.shape}")
+        metadata.setdefault('timestamp', datetime.now().isoformat())
+
+        encoded = json.dumps(metadata).encode('utf-8')
+        encoded += b' ' * (-len(encoded) % 8)      # Keeps the arrays 8-byte aligned for the memory map
+        with self._lock:
+            self._index()
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self._indexed_size:
+                logging.warning(f"SpectrumStore - Dropping a record of {self.path} that was cut short")
+                # Windows does not truncate a mapped file, the map is released and only ever covers the
+                # complete records, so the arrays returned by read are not in the truncated part either
+                self._map = None
+                os.truncate(self.path, self._indexed_size)
+            with open(self.path, 'ab') as f:
+                if f.tell() == 0:
+                    f.write(self.FILE_MAGIC)
+                f.write(self.RECORD_HEADER.pack(self.RECORD_MAGIC, len(encoded), len(x)))
+                f.write(encoded)
+                f.write(x.tobytes())
+                f.write(y.tobytes())
+            return len(self.scans()) - 1
+
+    def scans(self):
+        """
+        Returns the metadata of every scan in the store, in the order they were appended.
+        """
+        self._index()
+        return [metadata for metadata, _ in self._records]
+
+    def read(self, index):
+        """
+        Returns a scan as read-only arrays mapped from the file, only the pages that are accessed are read.
+
+        Returns:
+            tuple: x and y of the scan.
+        """
+        self._index()
+        metadata, offset = self._records[index]
+        points = metadata['points']
+        data = self._map[offset:offset + 2*points*self.DTYPE.itemsize].view(self.DTYPE)
+        return data[:points], data[points:]
+
+    def read_series(self, key='temperature'):
+        """
+        Returns the whole series of scans, e.g. over the temperatures of an experiment.
+
+        Args:
+            key (str): Metadata of the scans to return with them.
+
+        Returns:
+            tuple: Array of the key of each scan, and lists of the x and y arrays of each scan (mapped, see read).
+        """
+        self._index()
+        x, y = zip(*(self.read(index) for index in range(len(self._records)))) if self._records else ((), ())
+        return np.array([metadata.get(key) for metadata, _ in self._records]), list(x), list(y)
+
+    def export_xy(self, directory=None):
+        """
+        Writes every scan as an .xy file, named after its 'xy_name' metadata, or its time and temperature.
+
+        Args:
+            directory (str): Where to write the files, the directory of the store if None.
+
+        Returns:
+            list of str: Paths of the written files.
+        """
+        directory = directory or os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for index, metadata in enumerate(self.scans()):
+            name = metadata.get('xy_name') or f"{index:03d}_temp_{metadata.get('temperature')}.xy"
+            paths.append(os.path.join(directory, name))
+            SpectrumFiles.write_xy(paths[-1], *self.read(index))
+        return paths
+
+    def _index(self):
+        # Indexes the records appended since the last call, each record is only read once
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        if size == self._indexed_size:
+            self._map_records()
+            return
+        with open(self.path, 'rb') as f:
+            if self._indexed_size == 0:
+                if f.read(len(self.FILE_MAGIC)) != self.FILE_MAGIC:
+                    raise ValueError(f"SpectrumStore - {self.path} is not a spectrum store")
+                self._indexed_size = len(self.FILE_MAGIC)
+
+            position = self._indexed_size
+            while position + self.RECORD_HEADER.size <= size:
+                f.seek(position)
+                magic, metadata_length, points = self.RECORD_HEADER.unpack(f.read(self.RECORD_HEADER.size))
+                if magic != self.RECORD_MAGIC:
+                    raise ValueError(f"SpectrumStore - Corrupt record at byte {position} of {self.path}")
+                offset = position + self.RECORD_HEADER.size + metadata_length
+                end = offset + 2*points*self.DTYPE.itemsize
+                if end > size:
+                    break       # Still being written, or cut short
+                metadata = json.loads(f.read(metadata_length))
+                metadata['points'] = points
+                self._records.append((metadata, offset))
+                position = end
+        self._indexed_size = position
+        self._map_records()
+
+    def _map_records(self):
+        # Maps the complete records only, not a record still being written or cut short
+        if self._indexed_size and (self._map is None or len(self._map) != self._indexed_size):
+            self._map = np.memmap(self.path, dtype=np.uint8, mode='r', shape=(self._indexed_size,))
+
+
+if __name__ == "__main__":
+    # Converts a store to .xy files
+    store = SpectrumStore(sys.argv[1])
+    paths = store.export_xy(sys.argv[2] if len(sys.argv) > 2 else None)
+    logging.info(f"SpectrumStore - Wrote {len(paths)} .xy files")
@@ -1,16 +1,102 @@
+from collections import deque
+from bisect import bisect_left
+import time
+
+class StateRecord:
+    # One tracked state: when it started and ended, and how it ended. end and outcome are None while it runs.
+    # Outcomes: 'ok', 'failed', 'elided' (nothing had to be done), 'superseded' (the next state started first)
+    __slots__ = ('state', 'start', 'end', 'outcome')
+
+    def __init__(self, state, start):
+        self.state = state
+        self.start = start
+        self.end = None
+        self.outcome = None
+
+    def to_dict(self):
+        return {'state': self.state, 'start': self.start, 'end': self.end, 'outcome': self.outcome,
+                'duration': self.end - self.start if self.end is not None else None}
+
+class DurationHistogram:
+    # Streaming histogram of durations in log-spaced bins, 10 per decade from 1ms to 10000s, so percentiles
+    # are within one bin (~26%) of the exact value without storing the durations
+    BIN_EDGES = [1e-3 * 10**(i/10) for i in range(71)]
+    __slots__ = ('counts', 'count', 'max')
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BIN_EDGES) + 1)
+        self.count = 0
+        self.max = 0
+
+    def add(self, duration):
+        self.counts[bisect_left(self.BIN_EDGES, duration)] += 1
+        self.count += 1
+        self.max = max(self.max, duration)
+
+    def percentile(self, q):
+        """
+        Returns the upper edge of the bin holding the q-th percentile (0-100), at most the max duration.
+        """
+        if self.count == 0:
+            return None
+        rank = q / 100 * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return min(self.BIN_EDGES[i], self.max) if i < len(self.BIN_EDGES) else self.max
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'p50': self.percentile(50), 'p95': self.percentile(95), 'max': self.max}
 
 class StateTracker:
+    HISTORY_LENGTH = 100        # Number of state records kept
+
     def __init__(self):
-        self.state_history = []
+        self.state_history = deque(maxlen=self.HISTORY_LENGTH)     # StateRecords, the last one may still be running
+        self.state_durations = {}       # DurationHistogram of the 'ok' records of each state
+        self.state_failures = {}        # Number of 'failed' records of each state
 
     def get_state(self):
         if len(self.state_history) == 0:
             return None
-        return self.state_history[-1]
-    
+        return self.state_history[-1].state
+
+    def get_state_timings(self):
+        """
+        Returns the duration statistics (s) of each state: count, p50, p95 and max of the completed ones,
+        and how many failed.
+        """
+        return {state: {**self.state_durations.get(state, DurationHistogram()).summary(), 'failed': self.state_failures.get(state, 0)}
+                for state in self.state_durations.keys() | self.state_failures.keys()}
+
+    def get_state_history(self):
+        return [record.to_dict() for record in list(self.state_history)]
+
     def _track_state(self, state):
-        self.state_history.append(state)
+        # A state still running when the next one starts is superseded, it says nothing about its duration
+        self._finish_state('superseded')
+        self.state_history.append(StateRecord(state, time.time()))
+
+    def _last_record(self):
+        return self.state_history[-1] if self.state_history else None
+
+    def _finish_state(self, outcome='ok', since=None):
+        """
+        Ends the running state and adds its duration to the statistics if it completed.
 
-        #Limit history to 100 states
-        if len(self.state_history) > 100:
-            self.state_history.pop(0)
\ No newline at end of file
+        Args:
+            outcome (str): How the state ended, see StateRecord.
+            since (StateRecord): Only end the running state if it started after this record, so a
+                                 caller only ends the state it started itself.
+        """
+        record = self._last_record()
+        if record is None or record is since or record.end is not None:
+            return
+        record.end = time.time()
+        record.outcome = outcome
+        if outcome == 'ok':
+            self.state_durations.setdefault(record.state, DurationHistogram()).add(record.end - record.start)
+        elif outcome == 'failed':
+            self.state_failures[record.state] = self.state_failures.get(record.state, 0) + 1
@@ -0,0 +1,193 @@
+# Span tracer to profile where the time of a sample cycle goes
+# Spans are timed sections of code (an AISHLoader procedure, a serial wait, an XRD scan), nested by the thread
+# that runs them, so a sample cycle shows as a tree: the cycle, its load and unload, their gantry and gripper
+# moves, and the waits for the Ender3 'ok' or the Arduino replies under those. Tracing is off by default, then
+# every span is a single flag check. The spans can be exported as Chrome trace JSON (chrome://tracing or
+# https://ui.perfetto.dev) or summarized as a flat table of the time spent in each kind of span.
+#
+#   Tracer.start()
+#   with Tracer.span("cycle", sample=3):
+#       aish_loader.load_sample(3)
+#   Tracer.export_chrome_trace("trace.json")
+#   print(Tracer.format_summary())
+
+from functools import wraps
+import threading
+import time
+import json
+import os
+import logging
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+class _Span:
+    # A span being recorded: child_time is the time of its completed child spans, for its self time
+    __slots__ = ('name', 'category', 'args', 'start', 'child_time')
+
+    def __init__(self, name, category, args):
+        self.name = name
+        self.category = category
+        self.args = args
+        self.child_time = 0
+
+    def __enter__(self):
+        Tracer._local.__dict__.setdefault('stack', []).append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        stack = Tracer._local.stack
+        stack.pop()
+        if stack:
+            stack[-1].child_time += duration
+        if exc_type is not None:
+            self.args = {**self.args, 'error': exc_type.__name__}
+        Tracer._record(self, duration)
+        return False
+
+class _NullSpan:
+    # Returned by Tracer.span while tracing is off, so a disabled span costs no allocation
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class Tracer:
+    enabled = False
+    MAX_SPANS = 200000      # Spans kept per trace, later ones are counted as dropped
+
+    spans = []              # Completed spans: (name, category, start, duration, self time, thread id, args)
+    dropped_spans = 0
+    thread_names = {}       # Thread id -> name, for the trace viewer
+    _origin = time.perf_counter()
+    _local = threading.local()
+    _null_span = _NullSpan()
+
+    @staticmethod
+    def start():
+        """
+        Clears the recorded spans and turns tracing on.
+        """
+        Tracer.clear()
+        Tracer.enabled = True
+        logging.info("Tracer - Tracing started")
+
+    @staticmethod
+    def stop():
+        Tracer.enabled = False
+        logging.info(f"Tracer - Tracing stopped, {len(Tracer.spans)} spans recorded, {Tracer.dropped_spans} dropped")
+
+    @staticmethod
+    def clear():
+        Tracer.spans = []
+        Tracer.dropped_spans = 0
+        Tracer.thread_names = {}
+        Tracer._origin = time.perf_counter()
+
+    @staticmethod
+    def span(name, category="aish", **args):
+        """
+        Returns a context manager that records the code it wraps as a span, nested under the span the
+        current thread is in. Spans that raise are recorded with the exception name in their args.
+
+        Args:
+            name (str): Name of the span, spans with the same name are summed up in the summary.
+            category (str): Category of the span, e.g. 'procedure', 'serial' or 'xrd'.
+            **args: Shown with the span in the trace viewer, must be JSON serializable.
+        """
+        if not Tracer.enabled:
+            return Tracer._null_span
+        return _Span(name, category, args)
+
+    @staticmethod
+    def traced(name=None, category="aish"):
+        """
+        A decorator that records every call of a function as a span, named after its qualified name
+        unless a name is given.
+        """
+        def decorator(func):
+            span_name = name or func.__qualname__
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if not Tracer.enabled:
+                    return func(*args, **kwargs)
+                with _Span(span_name, category, {}):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    def _record(span, duration):
+        # list.append is atomic, so spans ending at the same time on different threads need no lock
+        if len(Tracer.spans) >= Tracer.MAX_SPANS:
+            Tracer.dropped_spans += 1
+            return
+        thread = threading.current_thread()
+        Tracer.thread_names.setdefault(thread.ident, thread.name)
+        Tracer.spans.append((span.name, span.category, span.start, duration, duration - span.child_time, thread.ident, span.args))
+
+    @staticmethod
+    def export_chrome_trace(path=None):
+        """
+        Builds the recorded spans as a Chrome trace, as complete ('X') events on one row per thread.
+
+        Args:
+            path (str): File to write the trace JSON to, None to only return it.
+
+        Returns:
+            dict: The trace, in the Trace Event Format read by chrome://tracing and Perfetto.
+        """
+        pid = os.getpid()
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': thread_name}}
+                  for tid, thread_name in list(Tracer.thread_names.items())]
+        for name, category, start, duration, _, tid, args in list(Tracer.spans):
+            events.append({'name': name, 'cat': category, 'ph': 'X', 'pid': pid, 'tid': tid,
+                           'ts': round((start - Tracer._origin) * 1e6, 1), 'dur': round(duration * 1e6, 1), 'args': args})
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+        if path is not None:
+            with open(path, 'w') as f:
+                json.dump(trace, f)
+            logging.info(f"Tracer - Wrote {len(events)} trace events to {path}")
+        return trace
+
+    @staticmethod
+    def summary():
+        """
+        Sums up the recorded spans by name, sorted by total time.
+
+        Returns:
+            list of dict: name, category, count, total, self (total minus the time of child spans), mean and max (s).
+        """
+        rows = {}
+        for name, category, _, duration, self_time, _, _ in list(Tracer.spans):
+            row = rows.setdefault(name, {'name': name, 'category': category, 'count': 0, 'total': 0, 'self': 0, 'max': 0})
+            row['count'] += 1
+            row['total'] += duration
+            row['self'] += self_time
+            row['max'] = max(row['max'], duration)
+        for row in rows.values():
+            row['mean'] = row['total'] / row['count']
+        return sorted(rows.values(), key=lambda row: row['total'], reverse=True)
+
+    @staticmethod
+    def format_summary():
+        """
+        Returns the summary as a text table.
+        """
+        lines = [f"{'span':<48} {'category':<10} {'count':>6} {'total':>9} {'self':>9} {'mean':>9} {'max':>9}"]
+        for row in Tracer.summary():
+            lines.append(f"{row['name'][:48]:<48} {row['category']:<10} {row['count']:>6} {row['total']:>8.3f}s "
+                         f"{row['self']:>8.3f}s {row['mean']:>8.3f}s {row['max']:>8.3f}s")
+        if Tracer.dropped_spans:
+            lines.append(f"{Tracer.dropped_spans} spans dropped, MAX_SPANS reached")
+        return "\n".join(lines)
@@ -1,7 +1,10 @@
-from flask import Flask, jsonify, render_template, request
-from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, jsonify, render_template, request
 from AISHLoader import AISHLoader
 from AISHExperiment import AISHExperiment
+from ExperimentScheduler import ExperimentScheduler
+from AISH_utils import HardwareState, StateError
+from Tracer import Tracer
+from Metrics import Metrics
 import logging
 import os
 import time
@@ -37,9 +40,16 @@ else:
     aish_loader = None
 logging.info("AISHLoader initialized")
 
-#Variable to store the XRD experiment, starts with no experiment
-aish_experiment = None
-experiment_thread = ThreadPoolExecutor(max_workers=1)
+# Stands in for the XRD in WEBSITE_TEST_MODE, every scan just takes a few seconds
+class TestExperiment(AISHExperiment):
+    def _single_scan(self, temp):
+        time.sleep(10 / len(self.temperatures))
+
+    def _wait_for_job_finished(self):
+        pass
+
+# Runs the queued XRD experiments, the frontend keeps it one experiment ahead so it can pipeline the sample handling
+scheduler = ExperimentScheduler(aish_loader)
 
 ############################################################################################################
 # API ENDPOINTS
@@ -52,11 +62,32 @@ def get_state():
     '''
     Returns the state of the automated In-situ heating XRD loader
     '''
+    aish_experiment = scheduler.current
     state = {'aish_loader': aish_loader.get_state() if aish_loader is not None else None,
-             'aish_experiment': aish_experiment.get_progress() if aish_experiment is not None else None}
+             'aish_experiment': aish_experiment.get_progress() if aish_experiment is not None else None,
+             'scheduler': scheduler.get_state()}
 
     return jsonify(state)
 
+# Endpoint to get how long each state of the hardware took, and the last states with their durations
+@app.route('/api/state_timings', methods=['GET'])
+def state_timings():
+    '''
+    Returns the duration statistics (count, p50, p95, max in seconds) of each state of each tracker,
+    and the history of its last states
+    '''
+    trackers = aish_loader.get_trackers() if aish_loader is not None else {}
+    return jsonify({'timings': {name: tracker.get_state_timings() for name, tracker in trackers.items()},
+                    'history': {name: tracker.get_state_history() for name, tracker in trackers.items()}})
+
+# Endpoint for Prometheus to scrape the latencies, procedure durations, errors and throughput
+@app.route('/api/metrics', methods=['GET'])
+def metrics():
+    '''
+    Returns the counters and histograms of Metrics in the Prometheus text exposition format, for scraping
+    '''
+    return Response(Metrics.render(), mimetype='text/plain; version=0.0.4; charset=utf-8')
+
 # Endpoints to eject/load sample buffer 
 @app.route('/api/loading_sample_buffer', methods=['POST'])
 def loading_sample_buffer():
@@ -78,74 +109,79 @@ def command():
     '''
     Command package to load sample, run XRD, and unload sample
     This is the HTTP endpoint that the frontend will call to run the XRD
-    Frontend pushes the latest item in its queue to this endpoint, also is endpoint
-    intended for ALabOS to use.
+    Frontend pushes the next item in its queue to this endpoint while the current one runs, 
+    also is endpoint intended for ALabOS to use. Items are queued on the scheduler and run in order,
+    under the item_id of the client so it can follow them through /api/get_state.
     '''
-    global aish_experiment  #Ensure we are using the global variable to store the experiment
-
     data = request.get_json()  # Parse incoming JSON data
 
     sample_num = int(data.get('sample_num'))  # Extract sample number
     xrd_params = data.get('xrd_params')  # Extract XRD parameters
     sample_name = data.get('sample_name')  # Extract sample name
+    item_id = data.get('item_id')  # Extract the id of the queue item, optional
 
     # Create a new XRD experiment, and loading routine
     min_angle = float(xrd_params['min_angle'])
     max_angle = float(xrd_params['max_angle'])
     precision = xrd_params['precision']
     temperatures = xrd_params['temperatures']
-    print(f"min_angle {min_angle}, type: {type(min_angle)}")
-    print(f"max_angle {max_angle}, type: {type(max_angle)}")
 
     logging.info(f"Received command to run XRD on sample {sample_num} \n\t{xrd_params}")
 
-    if WEBSITE_TEST_MODE:
-        aish_experiment = {'sample_num': sample_num, 'xrd_params': xrd_params}
-        print("OUT OF TEST", aish_experiment)
-        def run_xrd(sample_num):
-            global aish_experiment  #Ensure we are using the global aish_experiment
-            print(f"IN TEST {aish_experiment}\n\n")
-
-            logging.info("Starting experiment")
-            time.sleep(10)
-
-            print(f"IN TEST3 {aish_experiment}\n\n")
-            aish_experiment = None
-    else: 
-        aish_experiment = AISHExperiment(sample_name, sample_num, min_angle, max_angle, precision, temperatures)
-        def run_xrd(sample_num):
-            global aish_experiment
-            global aish_loader
-
-            # Load the sample and run
-            logging.info("Loading sample")
-            aish_loader.load_sample(sample_num)
-            
-            logging.info("Running XRD")
-            aish_experiment.run_sequence()
-            
-            logging.info("Unloading sample")
-            aish_loader.unload_sample()
-
-            # Home all the hardware
-            aish_loader.home_all()
-
-            #Reset the experiment
-            aish_experiment = None
-
-    # Submit the full routine to the executor
-    experiment_thread.submit(run_xrd, sample_num)
+    experiment_class = TestExperiment if WEBSITE_TEST_MODE else AISHExperiment
+    try:
+        item_id = scheduler.submit(experiment_class(sample_name, sample_num, min_angle, max_angle, precision, temperatures), item_id)
+    except StateError as e:
+        # A failed experiment dropped the queue, nothing runs until the operator clears it
+        return jsonify({"success": False, "error": str(e)}), 409
 
+    return jsonify({"success": True, "item_id": item_id})
+
+@app.route('/api/withdraw', methods=['POST'])
+def withdraw():
+    '''
+    Takes back the queued items that have not started, so pausing the frontend queue stops after the current item
+    '''
+    return jsonify({"success": True, "item_ids": scheduler.withdraw()})
+
+@app.route('/api/clear_failure', methods=['POST'])
+def clear_failure():
+    '''
+    Accepts experiments again after one failed, once the operator has checked the loader and the samples
+    '''
+    scheduler.clear_failure()
     return jsonify({"success": True})
 
+@app.route('/api/estimate_time', methods=['POST'])
+def estimate_time():
+    '''
+    Predicts the duration (in minutes) of a queue item: XRD scans, furnace ramps, and the 
+    sample handling from the Ender3 motion model and the Arduino firmware timings.
+    '''
+    data = request.get_json(silent=True)  # Parse incoming JSON data
+
+    # The form is estimated while it is being filled in, so incomplete items are a bad request, not an error
+    try:
+        sample_num = int(data.get('sample_num', 0))
+        min_angle, max_angle = float(data['min_angle']), float(data['max_angle'])
+        precision = data['precision']
+        temperatures = [float(temp) for temp in data.get('temperatures') or [25]]
+        if precision not in ('Low', 'High', 'Adaptive'):
+            raise ValueError(f"unknown precision {precision}")
+        handling_time = AISHLoader.estimate_cycle_time(sample_num)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        return jsonify({"success": False, "error": f"Invalid estimate request: {e!r}"}), 400
+
+    estimate = AISHExperiment.estimate_time(min_angle, max_angle, precision, temperatures, handling_time)
+
+    return jsonify(estimate)
+
 @app.route('/api/abort', methods=['POST'])
 def abort():
-    #Stop XRD acquisition
-    aish_experiment.abort()
+    #Stop XRD acquisition and withdraw the queued items, the scheduler still unloads the sample
+    item_ids = scheduler.abort()
 
-    # Unload the sample
-    
-    aish_experiment = None
+    return jsonify({"success": True, "item_ids": item_ids})
 
 ############################################################################################################
 # MANUAL OPERATION ENDPOINTS
@@ -220,6 +256,49 @@ def ender3_move_eject_bed():
         
     return jsonify({"success": True})
 
+@app.route('/api/hardware_state/invalidate', methods=['POST'])
+def hardware_state_invalidate():
+    # Call after touching the hardware by hand, so no command is skipped based on the old state
+    logging.debug("Received request to invalidate the hardware state")
+
+    HardwareState.invalidate()
+    
+    return jsonify({"success": True})
+
+@app.route('/api/homing/request', methods=['POST'])
+def homing_request():
+    # Homes all the hardware before the next sample, instead of waiting for the homing policy
+    logging.debug("Received request to home before the next sample")
+
+    if not WEBSITE_TEST_MODE:
+        aish_loader.homing_policy.request()
+    
+    return jsonify({"success": True})
+
+@app.route('/api/trace/start', methods=['POST'])
+def trace_start():
+    # Starts recording spans of the sample cycles, clearing the previous trace
+    logging.debug("Received request to start tracing")
+
+    Tracer.start()
+
+    return jsonify({"success": True})
+
+@app.route('/api/trace/stop', methods=['POST'])
+def trace_stop():
+    logging.debug("Received request to stop tracing")
+
+    Tracer.stop()
+
+    return jsonify({"success": True, "summary": Tracer.summary()})
+
+@app.route('/api/trace', methods=['GET'])
+def trace():
+    '''
+    Returns the recorded spans as a Chrome trace, save it and open it in chrome://tracing or https://ui.perfetto.dev
+    '''
+    return jsonify(Tracer.export_chrome_trace())
+
 @app.route('/api/ender3/home', methods=['POST'])
 def ender3_home():
     logging.debug("Received request to home Ender3")
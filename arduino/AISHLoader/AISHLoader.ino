@@ -25,8 +25,50 @@ Servo gripperServo;  // create Servo object to control a servo
 #define RAIL_STEPS_PER_REV 400
 #define RAIL_PULSEWIDTH 300  // Controls the speed, longer = slower
 #define RAIL_TRAVELREVS 63
+#define RAIL_COUNT_MARGIN RAIL_STEPS_PER_REV  // Moves may end at most this far (steps) past the bottom (0) or the top
 int RAIL_stepCount = -1;     // Tracks the current number of steps of the stepper motor rail.  75*400 = 30 000, which is storable in signed int
 
+// Non-blocking rail moves (up/down) follow a trapezoidal speed profile: they start at RAIL_START_SPEED, accelerate
+// to RAIL_MAX_SPEED and decelerate back at the end of the move. RAIL_MAX_SPEED is the speed of the blocking moves
+// (1 / (2*RAIL_PULSEWIDTH)), the only speed the rail has run at. Count-based progress can not detect missed steps,
+// so it must not be raised without testing the rail for missed steps against the limit switch.
+// Progress (the step count) is reported every RAIL_PROGRESS_INTERVAL while the board keeps processing commands.
+#define RAIL_START_SPEED 800.0       // Steps/s
+#define RAIL_MAX_SPEED (1000000.0 / (2 * RAIL_PULSEWIDTH))  // Steps/s, 1666
+#define RAIL_ACCELERATION 5000.0     // Steps/s^2
+#define RAIL_STEP_HIGH_TIME 10       // Width (us) of the step pulse
+#define RAIL_ENABLE_DELAY 500        // Delay (ms) between enabling the motor and the first step
+#define RAIL_PROGRESS_INTERVAL 100   // Interval (ms) between progress reports
+#define RAIL_PROGRESS 0x24           // Sysex command of the progress reports
+
+bool RAIL_moving = false;            // A non-blocking move is running
+byte RAIL_moveCommand;               // Command of the running move, acknowledged when it ends
+int RAIL_moveDir;                    // 1 up, -1 down
+long RAIL_moveSteps;                 // Total steps of the running move
+long RAIL_moveStepsDone;             // Steps done so far
+unsigned long RAIL_moveStartMillis;  // Time the motor was enabled
+unsigned long RAIL_lastStepMicros;
+unsigned long RAIL_stepInterval;     // Time (us) until the next step
+unsigned long RAIL_lastProgressMillis;
+bool RAIL_moveAck;                   // Acknowledge the move when it ends (false for moves run by a macro)
+
+// Macros run a short list of gripper/rail commands (0x10, 0x11, 0x20, 0x21, 0x23) in one round trip. Each step
+// runs when the previous one has ended, and the macro is acknowledged once with the status of every step
+// (STEP_OK, STEP_FAILED, or STEP_SKIPPED after a failure) followed by the rail count.
+#define MACRO 0x30
+#define MACRO_MAX_STEPS 8
+#define STEP_OK 0xFF
+#define STEP_FAILED 0x00
+#define STEP_SKIPPED 0x01
+
+bool MACRO_running = false;
+bool MACRO_failed;                   // A step failed, the remaining steps are skipped
+bool MACRO_waitingForRail;           // The current step is a rail move, it ends when the rail stops
+byte MACRO_length;
+byte MACRO_index;                    // Next step to run
+byte MACRO_steps[MACRO_MAX_STEPS];
+byte MACRO_status[MACRO_MAX_STEPS + 2];  // Status of each step, then the rail count
+
 void setup() {
   Firmata.setFirmwareVersion(FIRMATA_FIRMWARE_MAJOR_VERSION, FIRMATA_FIRMWARE_MINOR_VERSION);
   Firmata.begin(57600);
@@ -55,24 +97,24 @@ void loop() {
   while (Firmata.available()) {
     Firmata.processInput();
   }
+  updateRail();
+  updateMacro();
 }
 
 void sysexCallback(byte command, byte argc, byte* argv) {
   // Echo back the received SysEx message
   switch (command) {
     //LINEAR RAIL CALLBACKS
-    case 0x20:  //Linear rail go up
+    case 0x20:  //Linear rail go up, acknowledged by updateRail() when the move ends
       {
-        rotateMotor(RAIL_TRAVELREVS * RAIL_STEPS_PER_REV);
-        byte data = 0xFF;
-        Firmata.sendSysex(command, 1, &data);  //Send a 0xFF byte to indicate it is finished and successful
+        if (MACRO_running || !startRailMove(command, RAIL_TRAVELREVS * RAIL_STEPS_PER_REV, true))
+          sendRailAck(command, 0x00);  //Send a 0x00 byte to indicate the rail is busy (or the move refused), with the count
         break;
       }
-    case 0x21:  //Linear rail go down
+    case 0x21:  //Linear rail go down, acknowledged by updateRail() when the move ends
       {
-        rotateMotor(-RAIL_TRAVELREVS * RAIL_STEPS_PER_REV);
-        byte data = 0xFF;
-        Firmata.sendSysex(command, 1, &data);  //Send a 0xFF byte to indicate it is finished and successful
+        if (MACRO_running || !startRailMove(command, -RAIL_TRAVELREVS * RAIL_STEPS_PER_REV, true))
+          sendRailAck(command, 0x00);  //Send a 0x00 byte to indicate the rail is busy (or the move refused), with the count
         break;
       }
     case 0x22:  //Get the stepper motor count of the linear rail
@@ -89,13 +131,15 @@ void sysexCallback(byte command, byte argc, byte* argv) {
       }
     case 0x23:  //Home the rail
       {
+        if (RAIL_moving || MACRO_running) {
+          sendRailAck(command, 0x00);  //Cannot home during a move
+          break;
+        }
         bool homeSuccess = homeRail();
         if (homeSuccess) {
-          byte data = 0xFF;
-          Firmata.sendSysex(command, 1, &data);  //Send a 0xFF byte to indicate it is finished and successful
+          sendRailAck(command, 0xFF);  //Send a 0xFF byte to indicate it is finished and successful, with the count
         } else {
-          byte data = 0x00;
-          Firmata.sendSysex(command, 1, &data);  //Send a 0xFF byte to indicate it is finished and successful
+          sendRailAck(command, 0x00);  //Send a 0x00 byte to indicate it failed, with the count
         }
         break;
       }
@@ -131,6 +175,24 @@ void sysexCallback(byte command, byte argc, byte* argv) {
         break;
       }
 
+    //MACRO, run the steps in argv, acknowledged by updateMacro() when the last step ends
+    case MACRO:
+      {
+        if (MACRO_running || RAIL_moving || argc == 0 || argc > MACRO_MAX_STEPS) {
+          byte data = STEP_FAILED;
+          Firmata.sendSysex(command, 1, &data);  //Send a single 0x00 byte to indicate the macro was refused
+          break;
+        }
+        for (byte i = 0; i < argc; i++)
+          MACRO_steps[i] = argv[i];
+        MACRO_length = argc;
+        MACRO_index = 0;
+        MACRO_failed = false;
+        MACRO_waitingForRail = false;
+        MACRO_running = true;
+        break;
+      }
+
     //Test, echo back the command
     case 0x01:
       {
@@ -153,6 +215,160 @@ void sysexCallback(byte command, byte argc, byte* argv) {
 }
 
 
+/**
+ * Acknowledges a rail command with its status and the step count after it.
+ *
+ * The count is sent as 2 bytes (MSB first) after the status, the same encoding as the 0x22 count command,
+ * so the host does not need a separate count request after every move.
+ *
+ * @param command The command being acknowledged.
+ * @param status  0xFF if the command was successful, 0x00 otherwise.
+ */
+void sendRailAck(byte command, byte status) {
+  byte data[3];
+  data[0] = status;
+  data[1] = (RAIL_stepCount >> 8) & 0xFF;
+  data[2] = RAIL_stepCount & 0xFF;
+  Firmata.sendSysex(command, 3, data);
+}
+
+
+/**
+ * Starts a non-blocking rail move, stepped by updateRail() from loop().
+ *
+ * @param command     The command of the move, reported with the progress and acknowledged when the move ends.
+ * @param pulseCount  Number of steps, positive to go up and negative to go down.
+ * @param ack         Acknowledge the move when it ends.
+ * @return bool - false if a move is already running (or the move is too long, or refused by the count guards),
+ *                true if it started.
+ */
+bool startRailMove(byte command, long pulseCount, bool ack) {
+  if (RAIL_moving || abs(pulseCount) > 75 * RAIL_STEPS_PER_REV)
+    return false;
+
+  // Count guards, the same as LinearRail._refuse_move on the host, so no command or macro step can drive the rail
+  // into an end stop: the move must end within RAIL_COUNT_MARGIN of the bottom (count 0) or the top
+  long endCount = RAIL_stepCount + pulseCount;
+  if (endCount < -RAIL_COUNT_MARGIN || endCount > (long)RAIL_TRAVELREVS * RAIL_STEPS_PER_REV + RAIL_COUNT_MARGIN)
+    return false;
+
+  RAIL_moveCommand = command;
+  RAIL_moveAck = ack;
+  RAIL_moveDir = (pulseCount > 0) ? 1 : -1;
+  RAIL_moveSteps = abs(pulseCount);
+  RAIL_moveStepsDone = 0;
+  RAIL_stepInterval = 1000000.0 / RAIL_START_SPEED;
+
+  digitalWrite(RAIL_dirPin, (RAIL_moveDir > 0) ? HIGH : LOW);
+  digitalWrite(RAIL_enPin, HIGH);
+  RAIL_moveStartMillis = millis();
+  RAIL_lastProgressMillis = RAIL_moveStartMillis;
+  RAIL_moving = true;
+  return true;
+}
+
+/**
+ * Steps the running rail move when the next step is due, reports progress and acknowledges the end of the move.
+ *
+ * The speed after n steps (counted from the nearest end of the move) is sqrt(v0^2 + 2*a*n), capped at
+ * RAIL_MAX_SPEED, which gives the acceleration ramp at the start and the deceleration ramp at the end.
+ */
+void updateRail() {
+  if (!RAIL_moving)
+    return;
+
+  unsigned long now = millis();
+  if (now - RAIL_lastProgressMillis >= RAIL_PROGRESS_INTERVAL) {
+    RAIL_lastProgressMillis = now;
+    sendRailProgress(true);
+  }
+
+  if (now - RAIL_moveStartMillis < RAIL_ENABLE_DELAY)
+    return;
+
+  if (RAIL_moveStepsDone == 0 || micros() - RAIL_lastStepMicros >= RAIL_stepInterval) {
+    RAIL_lastStepMicros = micros();
+    digitalWrite(RAIL_stepPin, HIGH);
+    delayMicroseconds(RAIL_STEP_HIGH_TIME);
+    digitalWrite(RAIL_stepPin, LOW);
+    RAIL_moveStepsDone++;
+    RAIL_stepCount += RAIL_moveDir;
+
+    long rampSteps = min(RAIL_moveStepsDone, RAIL_moveSteps - RAIL_moveStepsDone);
+    float speed = min(sqrt(RAIL_START_SPEED * RAIL_START_SPEED + 2.0 * RAIL_ACCELERATION * rampSteps), RAIL_MAX_SPEED);
+    RAIL_stepInterval = 1000000.0 / speed;
+  }
+
+  if (RAIL_moveStepsDone >= RAIL_moveSteps) {
+    digitalWrite(RAIL_enPin, LOW);  //Cut current to motor (no locking)
+    RAIL_moving = false;
+    if (RAIL_moveAck)
+      sendRailAck(RAIL_moveCommand, 0xFF);  //Send a 0xFF byte to indicate it is finished and successful, with the count
+    else
+      sendRailProgress(false);  //Moves without an ack (macro steps) report that they ended
+  }
+}
+
+/**
+ * Reports the progress of the running rail move: [command of the move, count MSB, count LSB, moving].
+ *
+ * @param moving 1 while the move runs, 0 for the last report of a move that is not acknowledged.
+ */
+void sendRailProgress(bool moving) {
+  byte data[4];
+  data[0] = RAIL_moveCommand;
+  data[1] = (RAIL_stepCount >> 8) & 0xFF;
+  data[2] = RAIL_stepCount & 0xFF;
+  data[3] = moving ? 1 : 0;
+  Firmata.sendSysex(RAIL_PROGRESS, 4, data);
+}
+
+/**
+ * Runs the next step of the running macro once the previous one has ended, and acknowledges the macro
+ * with the status of every step and the rail count after the last one.
+ */
+void updateMacro() {
+  if (!MACRO_running || RAIL_moving)
+    return;
+
+  if (MACRO_waitingForRail) {
+    MACRO_status[MACRO_index - 1] = STEP_OK;  // The rail move has ended
+    MACRO_waitingForRail = false;
+  }
+
+  if (MACRO_index >= MACRO_length) {
+    MACRO_status[MACRO_length] = (RAIL_stepCount >> 8) & 0xFF;
+    MACRO_status[MACRO_length + 1] = RAIL_stepCount & 0xFF;
+    MACRO_running = false;
+    Firmata.sendSysex(MACRO, MACRO_length + 2, MACRO_status);
+    return;
+  }
+
+  byte step = MACRO_steps[MACRO_index++];
+  byte status = STEP_OK;
+  if (MACRO_failed) {
+    status = STEP_SKIPPED;
+  } else {
+    switch (step) {
+      case 0x10: gripper_grab(false); break;
+      case 0x11: gripper_grab(true); break;
+      case 0x20:
+      case 0x21:
+        if (startRailMove(step, (step == 0x20 ? 1 : -1) * RAIL_TRAVELREVS * RAIL_STEPS_PER_REV, false))
+          MACRO_waitingForRail = true;
+        else
+          status = STEP_FAILED;
+        break;
+      case 0x23: status = homeRail() ? STEP_OK : STEP_FAILED; break;
+      default: status = STEP_FAILED;  // Not a macro step
+    }
+  }
+  if (status == STEP_FAILED)
+    MACRO_failed = true;
+  MACRO_status[MACRO_index - 1] = status;
+}
+
+
 /**
  * @brief Performs the homing procedure for the rail by moving towards a limit switch.
  *
@@ -284,13 +500,22 @@ void moveServo(int targetPos) {
     if (currentPos < targetPos) {
       for (int pos = currentPos; pos <= targetPos; pos++) {
         gripperServo.write(pos);   // move the servo to the next position
-        delay(SERVO_SPEED_DELAY);  // control the speed
+        servoDelay();              // control the speed
       }
     } else {
       for (int pos = currentPos; pos >= targetPos; pos--) {
         gripperServo.write(pos);   // move the servo to the next position
-        delay(SERVO_SPEED_DELAY);  // control the speed
+        servoDelay();              // control the speed
       }
     }
   }
 }
+
+/**
+ * Waits SERVO_SPEED_DELAY ms between servo steps, keeping a running rail move stepping meanwhile.
+ */
+void servoDelay() {
+  unsigned long start = millis();
+  while (millis() - start < SERVO_SPEED_DELAY)
+    updateRail();
+}
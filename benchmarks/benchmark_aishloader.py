@@ -0,0 +1,91 @@
+# Benchmarks full AISHLoader sample cycles offline, against the virtual Ender3 and virtual Arduino
+# Reports the wall time of each load and unload, next to the predicted cycle time, and how many commands
+# of each kind were sent to both devices. Faults can be injected to exercise the error handling.
+# --homing always homes after every cycle like the old run_xrd, to compare against the homing policy.
+# --trace writes the spans of every cycle as a Chrome trace (open in https://ui.perfetto.dev) and prints
+# where the time went.
+#
+#   python benchmarks/benchmark_aishloader.py --cycles 3 --time-scale 0.1
+#   python benchmarks/benchmark_aishloader.py --cycles 3 --time-scale 0.1 --homing always
+#   python benchmarks/benchmark_aishloader.py --cycles 3 --time-scale 0.1 --trace trace.json
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'simulation')))
+
+import argparse
+import time
+import logging
+from AISHLoader import AISHLoader
+from VirtualEnder3 import VirtualEnder3
+from VirtualArduino import VirtualArduino
+from AISH_utils import HardwareState
+from Tracer import Tracer
+
+parser = argparse.ArgumentParser(description="Benchmark AISHLoader load/unload cycles against the virtual hardware")
+parser.add_argument('--cycles', type=int, default=3, help="Number of load/unload cycles")
+parser.add_argument('--samples', type=int, nargs='+', default=[0], help="Sample positions, cycled through")
+parser.add_argument('--time-scale', type=float, default=1.0, help="Hardware time multiplier of both simulators")
+parser.add_argument('--response-delay', type=float, default=0.0, help="Delay (s) before every reply of both simulators")
+parser.add_argument('--drop-rate', type=float, default=0.0, help="Probability that a reply of either simulator is lost")
+parser.add_argument('--missed-step-rate', type=float, default=0.0, help="Fraction of rail steps the virtual motor misses")
+parser.add_argument('--homing', choices=['policy', 'always'], default='policy', help="Home when the homing policy asks, or after every cycle")
+parser.add_argument('--trace', default=None, help="Write a Chrome trace of the cycles to this file")
+parser.add_argument('--seed', type=int, default=None, help="Seed of the fault injection")
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.INFO)
+
+virtual_ender3 = VirtualEnder3(time_scale=args.time_scale, response_delay=args.response_delay,
+                               drop_rate=args.drop_rate, seed=args.seed).start()
+virtual_arduino = VirtualArduino(time_scale=args.time_scale, response_delay=args.response_delay,
+                                 drop_rate=args.drop_rate, missed_step_rate=args.missed_step_rate, seed=args.seed).start()
+aish_loader = AISHLoader(virtual_ender3.port, virtual_arduino.port)
+virtual_ender3.command_counts.clear()
+virtual_arduino.command_counts.clear()
+if args.trace:
+    Tracer.start()
+
+durations = {'load': [], 'unload': [], 'home': []}
+predicted = []
+for cycle in range(args.cycles):
+    sample_num = args.samples[cycle % len(args.samples)]
+    predicted.append(AISHLoader.estimate_cycle_time(sample_num) * args.time_scale)
+
+    with Tracer.span("cycle", 'cycle', cycle=cycle, sample=sample_num):
+        start_time = time.time()
+        aish_loader.load_sample(sample_num)
+        durations['load'].append(time.time() - start_time)
+
+        start_time = time.time()
+        aish_loader.unload_sample()
+        durations['unload'].append(time.time() - start_time)
+
+        start_time = time.time()
+        if args.homing == 'always':
+            aish_loader.home_all("every cycle")
+        else:
+            aish_loader.home_if_needed()
+        durations['home'].append(time.time() - start_time)
+
+if args.trace:
+    Tracer.stop()
+    Tracer.export_chrome_trace(args.trace)
+
+aish_loader.ender3.close()
+aish_loader.arduino.close()
+virtual_ender3.stop()
+virtual_arduino.stop()
+
+print(f"\n{args.cycles} cycles, samples {args.samples}, time scale {args.time_scale}, homing {args.homing}")
+for name, times in durations.items():
+    print(f"  {name:<8} mean {sum(times)/len(times):7.3f}s   min {min(times):7.3f}s   max {max(times):7.3f}s")
+cycle_times = [sum(times) for times in zip(*durations.values())]
+print(f"  cycle    mean {sum(cycle_times)/len(cycle_times):7.3f}s   predicted {sum(predicted)/len(predicted):7.3f}s (without homing)")
+print(f"  Homes: {[reason for _, reason in aish_loader.homing_policy.history]}")
+print("  Ender3 commands: " + ", ".join(f"{command} x{count}" for command, count in sorted(virtual_ender3.command_counts.items())))
+print("  Arduino commands: " + ", ".join(f"{command} x{count}" for command, count in sorted(virtual_arduino.command_counts.items())))
+print(f"  Elided commands: {HardwareState.elided_commands}")
+if args.trace:
+    print(f"\nTrace written to {args.trace}, time per span:")
+    print(Tracer.format_summary())
@@ -0,0 +1,49 @@
+# Benchmarks the Ender3 side of a sample load/unload cycle against the virtual Ender3
+# Reports the wall time of each procedure and how many G-code commands of each kind were sent.
+#
+#   python benchmarks/benchmark_ender3.py --cycles 3 --time-scale 0.1
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'simulation')))
+
+import argparse
+import time
+import logging
+from Ender3 import Ender3
+from VirtualEnder3 import VirtualEnder3
+
+parser = argparse.ArgumentParser(description="Benchmark Ender3 load/unload motion against the virtual Ender3")
+parser.add_argument('--cycles', type=int, default=3, help="Number of load/unload cycles")
+parser.add_argument('--sample', type=int, default=0, help="Sample position to load and unload")
+parser.add_argument('--time-scale', type=float, default=1.0, help="Motion time multiplier of the simulator")
+parser.add_argument('--response-delay', type=float, default=0.0, help="Delay (s) before every 'ok'")
+args = parser.parse_args()
+
+logging.getLogger().setLevel(logging.INFO)
+
+virtual_ender3 = VirtualEnder3(time_scale=args.time_scale, response_delay=args.response_delay).start()
+ender = Ender3(virtual_ender3.port)
+virtual_ender3.command_counts.clear()
+
+# The Ender3 moves of AISHLoader.load_sample and unload_sample
+procedures = {
+    'load':   [[('move_to_sample', args.sample)], ['move_to_stage'], ['move_to_rest']],
+    'unload': [['move_to_stage'], ['move_to_rest', ('move_to_sample', args.sample)]],
+}
+
+durations = {name: [] for name in procedures}
+for cycle in range(args.cycles):
+    for name, steps in procedures.items():
+        start_time = time.time()
+        for step in steps:
+            ender.run_procedures(*step)
+        durations[name].append(time.time() - start_time)
+
+ender.close()
+virtual_ender3.stop()
+
+print(f"\n{args.cycles} cycles, sample {args.sample}, time scale {args.time_scale}")
+for name, times in durations.items():
+    print(f"  {name:<8} mean {sum(times)/len(times):7.3f}s   min {min(times):7.3f}s   max {max(times):7.3f}s")
+print("  Commands sent: " + ", ".join(f"{command} x{count}" for command, count in sorted(virtual_ender3.command_counts.items())))
@@ -0,0 +1,70 @@
+# Benchmarks reading XRD.ascii results and writing .xy spectra, SpectrumFiles against the line by line loops
+# it replaced in AISHExperiment, on synthetic files of the given numbers of points. Checks that both read
+# the same values and write the same bytes.
+#
+#   python benchmarks/benchmark_spectrum_files.py --points 10000 100000 1000000
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import tempfile
+import time
+import numpy as np
+from SpectrumFiles import SpectrumFiles
+
+parser = argparse.ArgumentParser(description="Benchmark SpectrumFiles against the line by line XRD.ascii reader and .xy writer")
+parser.add_argument('--points', type=int, nargs='+', default=[10**4, 10**5, 10**6], help="Points of the synthetic spectra")
+parser.add_argument('--repeats', type=int, default=3, help="Runs of each, the fastest is reported")
+args = parser.parse_args()
+
+def read_results_loop(path):
+    # The reader of Diffractometer.execute_scan before SpectrumFiles
+    x, y = [], []
+    with open(path) as f:
+        for line in f.readlines()[3:]:
+            x.append(float(line.split(';')[2]))
+            y.append(float(line.split(';')[-1]))
+    return np.array(x), np.array(y)
+
+def write_xy_loop(path, x, y):
+    # The writer of AISHExperiment._single_scan before SpectrumFiles
+    with open(path, 'w+') as f:
+        for (xval, yval) in zip(x, y):
+            f.write('%s %s\n' % (xval, yval))
+
+def write_results(path, points):
+    # Synthetic XRD.ascii: 3 header lines, then index;step time;2theta;time;counts
+    x = np.round(np.linspace(10, 80, points), 5)
+    y = np.round(1000*np.exp(-((x[:, None] - np.linspace(15, 75, 20))/0.1)**2).sum(axis=1) + np.random.default_rng(0).poisson(50, points), 1)
+    with open(path, 'w') as f:
+        f.write("Bruker XRD\nScan\nIndex;Time;Angle;StepTime;Counts\n")
+        f.writelines(f"{i};0.1;{xval};0.2;{yval}\n" for i, (xval, yval) in enumerate(zip(x, y)))
+
+def best_time(function, *function_args):
+    times = []
+    for _ in range(args.repeats):
+        start_time = time.perf_counter()
+        result = function(*function_args)
+        times.append(time.perf_counter() - start_time)
+    return min(times), result
+
+with tempfile.TemporaryDirectory() as directory:
+    results_path = os.path.join(directory, 'XRD.ascii')
+    xy_loop_path, xy_path = os.path.join(directory, 'loop.xy'), os.path.join(directory, 'bulk.xy')
+
+    print(f"{'points':>9} {'read loop':>10} {'read':>9} {'speedup':>8} {'write loop':>11} {'write':>9} {'speedup':>8}")
+    for points in args.points:
+        write_results(results_path, points)
+
+        read_loop_time, (x_loop, y_loop) = best_time(read_results_loop, results_path)
+        read_time, (x, y) = best_time(SpectrumFiles.read_results, results_path)
+        assert np.array_equal(x, x_loop) and np.array_equal(y, y_loop), "Read values differ"
+
+        write_loop_time, _ = best_time(write_xy_loop, xy_loop_path, x_loop, y_loop)
+        write_time, _ = best_time(SpectrumFiles.write_xy, xy_path, x, y)
+        with open(xy_loop_path) as f_loop, open(xy_path) as f:
+            assert f_loop.read() == f.read(), "Written .xy files differ"
+
+        print(f"{points:>9} {read_loop_time:>9.3f}s {read_time:>8.3f}s {read_loop_time/read_time:>7.1f}x "
+              f"{write_loop_time:>10.3f}s {write_time:>8.3f}s {write_loop_time/write_time:>7.1f}x")
@@ -10,23 +10,22 @@ PORT_ARDUINO = '/dev/tty.usbmodem141201'
 aish_loader = AISHLoader(PORT_ENDER, PORT_ARDUINO)
 
 pos = (80.7,17.45,16)
-ender = aish_loader.ender3
-
-# Move to a position above the sample
-ender._move_to(ender.current_position[0]  , ender.current_position[1]  , ender.SAMPLE_MIN_Z, 1200) #Move only Z first
-ender._move_to(pos[0]             , pos[1]             , ender.SAMPLE_MIN_Z, 4000) #Move above the sample position
 
 # Now loop through: move down and grab sample, move up, then back down and release sample and ask for user input
+# The grip_test procedure approaches from above the position. Each position is checked against the Ender3 limits
+# and the collision boxes when its plan is compiled, before anything moves, see Procedures.py
 stop = False
 dx, dy, dz = 0, 0, 0
+last_pos = pos
 while not stop:
     pos = (pos[0] + dx, pos[1] + dy, pos[2] + dz)
     print('New position:', pos)
-    ender._move_to(pos[0], pos[1], pos[2]) #Move down to the sample position
-    aish_loader.arduino.gripper.close() #Close the gripper
-    ender._move_to(pos[0], pos[1], pos[2]+10) #Move up
-    ender._move_to(pos[0], pos[1], pos[2]) #Move down to the sample position
-    aish_loader.arduino.gripper.open() #Open the gripper
+    try:
+        aish_loader.run_procedure('grip_test', x=pos[0], y=pos[1], z=pos[2])
+        last_pos = pos
+    except ValueError as e:
+        print('Position rejected:', e)
+        pos = last_pos
 
     # Ask for user input, the dx, dy, dz values to move the sample holder
     dx = input('dx: ') or 0
@@ -45,4 +44,3 @@ while not stop:
     
 
 print('Calibration routine finished, final position:', pos)
-    
\ No newline at end of file
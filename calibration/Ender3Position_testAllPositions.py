@@ -12,13 +12,11 @@ aish_loader = AISHLoader(PORT_ENDER, PORT_ARDUINO)
 
 
 # Grab a sample at position 0, then move to next position and release, repeat for all positions
+# The shuffle procedure is compiled and validated like the load and unload, see Procedures.py
 num_samps = len(aish_loader.ender3.SAMPLE_POSITIONS)
 success_pos = np.ones(num_samps)
 for i in range(2):
-    aish_loader.ender3.move_to_sample(i)
-    aish_loader.arduino.gripper.close()
-    aish_loader.ender3.move_to_sample((i + 1) % num_samps)
-    aish_loader.arduino.gripper.open()
+    aish_loader.run_procedure('shuffle', from_sample=i, to_sample=(i + 1) % num_samps)
 
     # Ask for user input to continue
     user_in = input(f"Was sample {i} successful? (y/n): ")
@@ -0,0 +1,389 @@
+# Virtual AISHLoader Arduino for offline testing and benchmarking
+# Opens a pseudo-terminal and speaks the Firmata sysex protocol of arduino/AISHLoader/AISHLoader.ino, so
+# ArduinoHardware(PORT) can connect to it unchanged on Linux. Like the firmware, commands run one at a time
+# and take as long as the hardware would (scaled by time_scale): servo sweeps take SERVO_SPEED_DELAY per degree,
+# homing pulses at RAIL_PULSEWIDTH, and rail moves run in the background with the trapezoidal speed profile of the
+# firmware, reporting progress every RAIL_PROGRESS_INTERVAL. Faults seen on the real hardware can be injected:
+# lost replies, slow responses, missed rail steps, stalled rail moves and a dead limit switch. Macros (0x30) run
+# their steps in the background the same way and are acknowledged once.
+#
+# Run standalone to get a port for manual testing:
+#   python simulation/VirtualArduino.py
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import time
+import random
+import threading
+import queue
+import tty
+import logging
+from collections import Counter
+from FirmataClient import FirmataClient, START_SYSEX, END_SYSEX, REPORT_VERSION, REPORT_FIRMWARE
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+class VirtualArduino:
+    # Firmware constants, from AISHLoader.ino
+    FIRMATA_VERSION = (2, 5)
+    FIRMWARE_NAME = "AISHLoader.ino"
+    SERVO_SPEED_DELAY = 15e-3       # Delay (s) per degree of servo travel
+    SERVO_BOOT_ANGLE = 90           # Servo.read() before the first write
+    GRIPPER_CLOSED_ANGLE = 45
+    GRIPPER_OPEN_ANGLE = 0
+    RAIL_STEPS_PER_REV = 400
+    RAIL_PULSEWIDTH = 300e-6        # Step pulse low and high time (s)
+    RAIL_TRAVELREVS = 63
+    RAIL_COUNT_MARGIN = RAIL_STEPS_PER_REV          # Moves may end at most this far (steps) past the bottom (0) or the top
+    RAIL_ENABLE_DELAY = 0.5         # Delay (s) after enabling the motor, before the first step
+    RAIL_MAX_PULSES = 75*RAIL_STEPS_PER_REV     # rotateMotor ignores longer moves
+    RAIL_HOMING_MAX_STEPS = 20*RAIL_STEPS_PER_REV
+    RAIL_START_SPEED = 800.0        # Speed profile of the non-blocking moves (steps/s and steps/s^2)
+    RAIL_MAX_SPEED = 1e6/(2*300)    # The speed of the blocking moves, RAIL_PULSEWIDTH is 300 us
+    RAIL_ACCELERATION = 5000.0
+    RAIL_PROGRESS_INTERVAL = 0.1    # Interval (s) between progress reports
+    RAIL_PROGRESS = 0x24
+    MIN_REPORT_INTERVAL = 0.01      # Progress is not reported faster than this (s) when time_scale is small
+    MACRO = 0x30
+    MACRO_MAX_STEPS = 8
+    STEP_OK, STEP_FAILED, STEP_SKIPPED = 0xFF, 0x00, 0x01
+
+    COMMAND_NAMES = {0x10: "GRIPPER_OPEN", 0x11: "GRIPPER_CLOSE", 0x12: "GRIPPER_STATE", 0x14: "GRIPPER_STATE_ANGLE",
+                     0x20: "LINRAIL_UP", 0x21: "LINRAIL_DOWN", 0x22: "LINRAIL_COUNT", 0x23: "LINRAIL_HOME",
+                     0x24: "LINRAIL_PROGRESS", 0x30: "MACRO", 0x01: "TEST_ECHO", 0x02: "TEST_RESPONSE"}
+
+    def __init__(self, time_scale=1.0, drop_rate=0.0, response_delay=0.0, missed_step_rate=0.0, stall_rate=0.0,
+                 limit_switch_fault=False, rail_start_position=RAIL_STEPS_PER_REV, seed=None):
+        """
+        Args:
+            time_scale (float): Multiplier on all hardware times, e.g. 0.01 to run 100x faster than the hardware.
+            drop_rate (float): Probability that a reply is lost.
+            response_delay (float): Delay (s) before every reply, to emulate a slow connection.
+            missed_step_rate (float): Fraction of rail steps the motor misses, so the step count drifts from
+                                      the physical position.
+            stall_rate (float): Probability that a rail move stops stepping halfway and is never acknowledged,
+                                progress keeps being reported with the same count.
+            limit_switch_fault (bool): The limit switch never triggers, so homing times out.
+            rail_start_position (int): Physical position of the rail (steps above the limit switch) at power on.
+            seed (int): Seed of the fault injection, for reproducible runs.
+        """
+        self.time_scale = time_scale
+        self.drop_rate = drop_rate
+        self.response_delay = response_delay
+        self.missed_step_rate = missed_step_rate
+        self.stall_rate = stall_rate
+        self.limit_switch_fault = limit_switch_fault
+        self._random = random.Random(seed)
+
+        # Hardware state, as the firmware sees it
+        self.servo_angle = self.SERVO_BOOT_ANGLE
+        self.rail_count = -1                        # RAIL_stepCount, -1 until the rail is homed
+        self.rail_position = rail_start_position    # Physical position (steps above the limit switch)
+        self.command_counts = Counter()             # Number of sysex commands received per command name
+        self._busy_thread = None                    # Runs the non-blocking rail move or macro
+
+        self._handlers = {
+            0x10: lambda data: self._gripper_grab(False),
+            0x11: lambda data: self._gripper_grab(True),
+            0x12: lambda data: [1 if self.servo_angle == 30 else 0],   # Same check as the firmware
+            0x14: lambda data: [self.servo_angle],
+            0x20: lambda data: self._start_rail_move(0x20, self.RAIL_TRAVELREVS*self.RAIL_STEPS_PER_REV),
+            0x21: lambda data: self._start_rail_move(0x21, -self.RAIL_TRAVELREVS*self.RAIL_STEPS_PER_REV),
+            0x22: lambda data: list(self.rail_count.to_bytes(2, byteorder='big', signed=True)),
+            0x23: lambda data: self._rail_ack(not self._busy() and self._rail_home()),
+            0x30: self._start_macro,
+            0x01: lambda data: list(data),
+            0x02: lambda data: [23, 14, 22, 14],
+        }
+        self._command_buffer = queue.Queue()
+
+        # ArduinoHardware connects to the slave end, the simulator reads and writes the master end
+        self._master_fd, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        self.port = os.ttyname(slave_fd)
+        self._slave_fd = slave_fd
+
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._receive_loop, name="VirtualArduino-rx", daemon=True),
+                         threading.Thread(target=self._process_loop, name="VirtualArduino-cmd", daemon=True)]
+
+    def start(self):
+        """
+        Boots the firmware: reports the Firmata and firmware versions, then opens the gripper like setup().
+        """
+        for thread in self._threads:
+            thread.start()
+        self._report_version()
+        self._report_firmware()
+        self._move_servo(self.GRIPPER_OPEN_ANGLE)
+        logging.info(f"VirtualArduino - Listening on {self.port}")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._command_buffer.put(None)      # Wake up the command processor
+        os.close(self._master_fd)
+        os.close(self._slave_fd)
+
+    def _receive_loop(self):
+        """
+        Frames the serial input into Firmata messages and queues them for the command processor.
+        """
+        sysex = None
+        while not self._stop.is_set():
+            try:
+                chunk = os.read(self._master_fd, 1024)
+            except OSError:
+                return
+            for byte in chunk:
+                if byte == START_SYSEX:
+                    sysex = bytearray()
+                elif byte == END_SYSEX and sysex is not None:
+                    self._command_buffer.put(bytes(sysex))
+                    sysex = None
+                elif sysex is not None:
+                    sysex.append(byte)
+                elif byte == REPORT_VERSION:
+                    self._command_buffer.put(bytes([REPORT_VERSION]))
+
+    def _process_loop(self):
+        while not self._stop.is_set():
+            message = self._command_buffer.get()
+            if message is None:
+                return
+            self._process(message)
+
+    def _process(self, message):
+        if message == bytes([REPORT_VERSION]):
+            self._report_version()
+            return
+        if len(message) == 0:
+            return
+
+        command, data = message[0], list(message[1:])     # Like the firmware, data is passed on as received
+        if command == REPORT_FIRMWARE:
+            self._report_firmware()
+            return
+
+        handler = self._handlers.get(command)
+        if handler is None:
+            return      # The firmware ignores unknown commands
+        self.command_counts[self.COMMAND_NAMES.get(command, hex(command))] += 1
+        reply = handler(data)
+        if reply is not None:       # Non-blocking commands reply when they end
+            self._send_sysex(command, reply)
+
+    def _send_sysex(self, command, data):
+        if self._random.random() < self.drop_rate:
+            logging.debug(f"VirtualArduino - Dropped reply to {self.COMMAND_NAMES.get(command, hex(command))}")
+            return
+        if self.response_delay:
+            time.sleep(self.response_delay)
+        self._write(bytes([START_SYSEX, command, *FirmataClient.pack_7bit(data), END_SYSEX]))
+
+    def _report_version(self):
+        self._write(bytes([REPORT_VERSION, *self.FIRMATA_VERSION]))
+
+    def _report_firmware(self):
+        name = FirmataClient.pack_7bit(self.FIRMWARE_NAME.encode())
+        self._write(bytes([START_SYSEX, REPORT_FIRMWARE, *self.FIRMATA_VERSION, *name, END_SYSEX]))
+
+    def _gripper_grab(self, is_grab_on):
+        self._move_servo(self.GRIPPER_CLOSED_ANGLE if is_grab_on else self.GRIPPER_OPEN_ANGLE)
+        return [0xFF]
+
+    def _move_servo(self, target_angle):
+        # The firmware writes every angle from the current to the target one, both included
+        self._sleep((abs(target_angle - self.servo_angle) + 1) * self.SERVO_SPEED_DELAY)
+        self.servo_angle = target_angle
+
+    def _start_rail_move(self, command, pulse_count):
+        """
+        Starts a non-blocking rail move like startRailMove, or refuses it if a move is already running or
+        the count guards do not allow it.
+        """
+        if self._busy() or not self._rail_move_allowed(pulse_count):
+            return self._rail_ack(False)
+        self._busy_thread = threading.Thread(target=self._run_rail_move, args=(command, pulse_count),
+                                                  name="VirtualArduino-rail", daemon=True)
+        self._busy_thread.start()
+        return None
+
+    def _rail_move_allowed(self, pulse_count):
+        # The checks of startRailMove: the length of the move, then the count guards
+        if abs(pulse_count) > self.RAIL_MAX_PULSES:
+            return False
+        end_count = self.rail_count + pulse_count
+        return -self.RAIL_COUNT_MARGIN <= end_count <= self.RAIL_TRAVELREVS*self.RAIL_STEPS_PER_REV + self.RAIL_COUNT_MARGIN
+
+    def _busy(self):
+        return self._busy_thread is not None and self._busy_thread.is_alive()
+
+    def _start_macro(self, steps):
+        """
+        Starts running the steps of a macro in the background, or refuses it with a single 0x00 byte.
+        """
+        if self._busy() or not 0 < len(steps) <= self.MACRO_MAX_STEPS:
+            return [self.STEP_FAILED]
+        self._busy_thread = threading.Thread(target=self._run_macro, args=(list(steps),), name="VirtualArduino-macro", daemon=True)
+        self._busy_thread.start()
+        return None
+
+    def _run_macro(self, steps):
+        statuses = []
+        for step in steps:
+            if self.STEP_FAILED in statuses:
+                statuses.append(self.STEP_SKIPPED)
+            elif step in (0x10, 0x11):
+                self._gripper_grab(step == 0x11)
+                statuses.append(self.STEP_OK)
+            elif step in (0x20, 0x21):
+                pulse_count = (1 if step == 0x20 else -1) * self.RAIL_TRAVELREVS*self.RAIL_STEPS_PER_REV
+                if self._rail_move_allowed(pulse_count):
+                    self._run_rail_move(step, pulse_count, ack=False)
+                    statuses.append(self.STEP_OK)
+                else:
+                    statuses.append(self.STEP_FAILED)
+            elif step == 0x23:
+                statuses.append(self.STEP_OK if self._rail_home() else self.STEP_FAILED)
+            else:
+                statuses.append(self.STEP_FAILED)
+            if self._stop.is_set():
+                return
+        self._send_sysex(self.MACRO, statuses + list(self.rail_count.to_bytes(2, byteorder='big', signed=True)))
+
+    def _run_rail_move(self, command, pulse_count, ack=True):
+        """
+        Steps the rail along the trapezoidal profile, reporting progress, then acknowledges the move (or reports
+        that it ended, for macro steps).
+        """
+        direction = 1 if pulse_count > 0 else -1
+        total_steps = abs(pulse_count)
+        duration = self._trapezoid_time(total_steps)
+        stall_steps = total_steps // 2 if self._random.random() < self.stall_rate else None
+
+        report_interval = max(self.RAIL_PROGRESS_INTERVAL * self.time_scale, self.MIN_REPORT_INTERVAL)
+        start_time = time.time()
+        steps_done = 0
+        while not self._stop.is_set():
+            time.sleep(report_interval)
+            elapsed = (time.time() - start_time) / self.time_scale - self.RAIL_ENABLE_DELAY
+            steps = self._trapezoid_steps(elapsed, total_steps) if elapsed > 0 else 0
+            if elapsed >= duration:
+                steps = total_steps
+            if stall_steps is not None:
+                steps = min(steps, stall_steps)
+            self._step_rail(direction*(steps - steps_done))
+            steps_done = steps
+
+            if steps_done >= total_steps:
+                if ack:
+                    self._send_sysex(command, self._rail_ack(True))
+                else:
+                    self._send_progress(command, moving=False)
+                return
+            self._send_progress(command, moving=True)
+
+    def _send_progress(self, command, moving):
+        self._send_sysex(self.RAIL_PROGRESS, [command] + list(self.rail_count.to_bytes(2, byteorder='big', signed=True)) + [int(moving)])
+
+    def _trapezoid_time(self, total_steps):
+        ramp_steps, peak_speed = self._trapezoid_ramp(total_steps)
+        return 2*(peak_speed - self.RAIL_START_SPEED)/self.RAIL_ACCELERATION + (total_steps - 2*ramp_steps)/peak_speed
+
+    def _trapezoid_steps(self, elapsed, total_steps):
+        """
+        Steps done after `elapsed` seconds of a move: accelerate, cruise at the peak speed, decelerate.
+        """
+        v0, a = self.RAIL_START_SPEED, self.RAIL_ACCELERATION
+        ramp_steps, peak_speed = self._trapezoid_ramp(total_steps)
+        ramp_time = (peak_speed - v0)/a
+        cruise_time = (total_steps - 2*ramp_steps)/peak_speed
+
+        if elapsed < ramp_time:
+            steps = v0*elapsed + a*elapsed**2/2
+        elif elapsed < ramp_time + cruise_time:
+            steps = ramp_steps + peak_speed*(elapsed - ramp_time)
+        else:
+            decelerating = min(elapsed - ramp_time - cruise_time, ramp_time)
+            steps = total_steps - ramp_steps + peak_speed*decelerating - a*decelerating**2/2
+        return min(int(steps), total_steps)
+
+    def _trapezoid_ramp(self, total_steps):
+        # Steps of each ramp and the peak speed, moves too short to reach RAIL_MAX_SPEED have a triangular profile
+        v0, a = self.RAIL_START_SPEED, self.RAIL_ACCELERATION
+        ramp_steps = (self.RAIL_MAX_SPEED**2 - v0**2)/(2*a)
+        if 2*ramp_steps <= total_steps:
+            return ramp_steps, self.RAIL_MAX_SPEED
+        return total_steps/2, (v0**2 + a*total_steps)**0.5
+
+    def _rail_ack(self, success):
+        # Status, then the step count like sendRailAck
+        return [0xFF if success else 0x00] + list(self.rail_count.to_bytes(2, byteorder='big', signed=True))
+
+    def _rotate_motor(self, pulse_count):
+        if abs(pulse_count) > self.RAIL_MAX_PULSES:
+            return
+        self._sleep(self.RAIL_ENABLE_DELAY + abs(pulse_count) * 2*self.RAIL_PULSEWIDTH)
+        self._step_rail(pulse_count)
+
+    def _rail_home(self):
+        """
+        Steps down until the limit switch triggers, backing off 4 revolutions first if it already is.
+
+        Returns:
+            bool: True if the limit switch triggered, False if homing timed out.
+        """
+        if self._limit_switch_pressed():
+            self._rotate_motor(4*self.RAIL_STEPS_PER_REV)
+
+        if self.limit_switch_fault:
+            steps = self.RAIL_HOMING_MAX_STEPS
+        else:
+            steps = min(max(self.rail_position, 0), self.RAIL_HOMING_MAX_STEPS)
+        self._sleep(steps * 2*self.RAIL_PULSEWIDTH)
+        self._step_rail(-steps)
+
+        if steps >= self.RAIL_HOMING_MAX_STEPS:
+            return False
+        self.rail_count = 0
+        return True
+
+    def _step_rail(self, steps):
+        # The count always follows the pulses, missed steps only affect the physical position
+        missed = sum(self._random.random() < self.missed_step_rate for _ in range(abs(steps))) if self.missed_step_rate else 0
+        self.rail_count = self._to_int16(self.rail_count + steps)
+        self.rail_position += steps - missed*(1 if steps > 0 else -1)
+
+    def _limit_switch_pressed(self):
+        return not self.limit_switch_fault and self.rail_position <= 0
+
+    @staticmethod
+    def _to_int16(value):
+        # RAIL_stepCount is an Arduino int
+        return (value + 2**15) % 2**16 - 2**15
+
+    def _sleep(self, duration):
+        time.sleep(duration * self.time_scale)
+
+    def _write(self, message):
+        try:
+            os.write(self._master_fd, message)
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    virtual_arduino = VirtualArduino().start()
+    print(f"Virtual Arduino running, connect with ArduinoHardware(PORT='{virtual_arduino.port}'). Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        virtual_arduino.stop()
@@ -0,0 +1,176 @@
+# Virtual Ender3 for offline testing and benchmarking
+# Opens a pseudo-terminal and speaks the subset of Marlin G-code used by Ender3.py, so Ender3(PORT) can connect
+# to it unchanged on Linux. Motion takes as long as the trapezoidal motion model predicts (scaled by time_scale),
+# and faults seen on the real printer can be injected: dropped lines, slow responses and the unit-scale bug.
+#
+# Run standalone to get a port for manual testing:
+#   python simulation/VirtualEnder3.py
+
+import sys
+import os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import re
+import time
+import random
+import threading
+import queue
+import tty
+import logging
+from collections import Counter
+from MotionTimeEstimator import MotionTimeEstimator
+
+logging.basicConfig(
+    level=logging.DEBUG,
+    format="%(asctime)s.%(msecs)03d %(levelname)-8s: %(message)s",
+    datefmt='%y-%m-%d %H:%M:%S'
+)
+
+class VirtualEnder3:
+    BUFSIZE = 4                 # Marlin command buffer, lines received but not processed yet
+    BLOCK_BUFFER_SIZE = 16      # Marlin planner buffer, moves processed but not executed yet
+    HOMING_FEEDRATE = 3000      # Feedrate (mm/min) of the homing moves
+
+    def __init__(self, time_scale=1.0, drop_rate=0.0, response_delay=0.0, unit_scale=1.0, seed=None):
+        """
+        Args:
+            time_scale (float): Multiplier on all motion times, e.g. 0.01 to run 100x faster than the hardware.
+            drop_rate (float): Probability that a received line is lost (no 'ok' is sent for it).
+            response_delay (float): Delay (s) before every 'ok', to emulate a slow connection.
+            unit_scale (float): Scale of the executed moves and reported position, 0.5 reproduces the
+                                bug where the Ender moves half the commanded distance.
+            seed (int): Seed of the fault injection, for reproducible runs.
+        """
+        self.time_scale = time_scale
+        self.drop_rate = drop_rate
+        self.response_delay = response_delay
+        self.unit_scale = unit_scale
+        self._random = random.Random(seed)
+        self._estimator = MotionTimeEstimator()
+
+        self.position = [0.0, 0.0, 0.0]     # Position after the last planned move (what M114 reports)
+        self.feedrate = 2000                # Last commanded feedrate (mm/min), G-code feedrates are modal
+        self.command_counts = Counter()     # Number of lines received per G-code command
+        self._planner = []                  # End times of the moves in the planner buffer
+        self._command_buffer = queue.Queue(maxsize=self.BUFSIZE)
+
+        # The Ender3 connects to the slave end, the simulator reads and writes the master end
+        self._master_fd, slave_fd = os.openpty()
+        tty.setraw(slave_fd)
+        self.port = os.ttyname(slave_fd)
+        self._slave_fd = slave_fd
+
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._receive_loop, name="VirtualEnder3-rx", daemon=True),
+                         threading.Thread(target=self._process_loop, name="VirtualEnder3-cmd", daemon=True)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        logging.info(f"VirtualEnder3 - Listening on {self.port}")
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._command_buffer.put(None)      # Wake up the command processor
+        os.close(self._master_fd)
+        os.close(self._slave_fd)
+
+    def _receive_loop(self):
+        """
+        Frames the serial input into lines and queues them, blocking when the command buffer is full.
+        """
+        buffer = b""
+        while not self._stop.is_set():
+            try:
+                chunk = os.read(self._master_fd, 1024)
+            except OSError:
+                return
+            buffer += chunk
+            while b"\n" in buffer:
+                raw_line, buffer = buffer.split(b"\n", 1)
+                line = raw_line.decode('utf-8', errors='ignore').strip()
+                if not line:
+                    continue
+                if self._random.random() < self.drop_rate:
+                    logging.debug(f"VirtualEnder3 - Dropped line: {line}")
+                    continue
+                self._command_buffer.put(line)
+
+    def _process_loop(self):
+        while not self._stop.is_set():
+            line = self._command_buffer.get()
+            if line is None:
+                return
+            self._process(line)
+
+    def _process(self, line):
+        words = line.split()
+        for command in [word for word in words if re.fullmatch(r"[GM]\d+", word)] or words[:1]:
+            self.command_counts[command] += 1
+
+        if words[0] in ("G0", "G1", "G00", "G01"):
+            self._plan_move(dict(re.findall(r"([XYZF])(-?\d+\.?\d*)", line)))
+        elif words[0] == "G28":
+            self._wait_for_planner(0)
+            self._plan_move({'X': 0, 'Y': 0, 'Z': 0, 'F': self.HOMING_FEEDRATE}, scale=1)
+            self._wait_for_planner(0)
+            self.position = [0.0, 0.0, 0.0]
+            self._write(self._position_report())
+        elif words[0] == "M400":
+            self._wait_for_planner(0)
+        elif words[0] == "M114":
+            self._write(self._position_report())
+        elif words[0] == "M118":
+            self._write(line.split(" ", 1)[1] if len(words) > 1 else "")
+        elif words[0] not in ("G21", "G90"):
+            self._write(f"echo:Unknown command: \"{line}\"")
+
+        if self.response_delay:
+            time.sleep(self.response_delay)
+        self._write("ok")
+
+    def _plan_move(self, params, scale=None):
+        """
+        Adds a move to the planner, blocking while the planner buffer is full like Marlin does.
+        """
+        scale = self.unit_scale if scale is None else scale
+        target = [float(params[axis])*scale if axis in params else self.position[i] for i, axis in enumerate("XYZ")]
+        self.feedrate = float(params.get('F', self.feedrate))
+
+        duration = self._estimator.path_time(self.position, [(*target, self.feedrate)]) * self.time_scale
+        self._wait_for_planner(self.BLOCK_BUFFER_SIZE - 1)
+        start = max([time.time()] + self._planner[-1:])
+        self._planner.append(start + duration)
+        self.position = target
+
+    def _wait_for_planner(self, max_blocks):
+        """
+        Waits until at most max_blocks moves are left in the planner (0 waits until all moves are executed).
+        """
+        while True:
+            now = time.time()
+            self._planner = [end for end in self._planner if end > now]
+            if len(self._planner) <= max_blocks:
+                return
+            time.sleep(min(self._planner[len(self._planner) - max_blocks - 1] - now, 0.05))
+
+    def _position_report(self):
+        x, y, z = self.position
+        return f"X:{x:.2f} Y:{y:.2f} Z:{z:.2f} E:0.00 Count X:{int(x*80)} Y:{int(y*80)} Z:{int(z*400)}"
+
+    def _write(self, line):
+        try:
+            os.write(self._master_fd, f"{line}\n".encode())
+        except OSError:
+            pass
+
+
+if __name__ == "__main__":
+    virtual_ender3 = VirtualEnder3().start()
+    print(f"Virtual Ender3 running, connect with Ender3(PORT='{virtual_ender3.port}'). Ctrl+C to stop.")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        virtual_ender3.stop()
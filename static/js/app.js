@@ -7,7 +7,10 @@ const startButton = document.getElementById('queue-start-button');
 // Queue variables
 let queueItems_array = [];      // Array to store the queue items
 let queueRunningItem = null;    // Variable to store the currently running item
+let queueSentItems = [];        // Items sent to the server that have not completed, matched to the server by itemId
+let queueItemCount = 0;         // Number of items added, makes the itemId unique
 let queue_paused = true;       // Flag to indicate if the queue is paused
+let schedulerFailure = null;    // Item that failed on the server and its error, nothing is sent until the failure is cleared
 
 
 const MAX_TEMP = 1100; // Maximum temperature for the furnace
@@ -38,9 +41,27 @@ setInterval(() => {
     console.log(systemState);
     console.log(`SysState Null: ${systemState.aish_experiment == null}, Queue Paused: ${queue_paused}`);
 
-    // Check if the queue is paused, and if the system is ready to run the next item
-    // If the queue is not paused and the system is ready, send the next item in the queue
-    if (!queue_paused && systemState.aish_experiment == null) {
+    // Drop the sent items the server has completed, the rest are running, waiting on the server, or still being sent
+    const scheduler = systemState.scheduler;
+    if (scheduler != null) {
+        if (scheduler.failed != null) {
+            // The server dropped its queue, take back the items it had not started and pause the queue
+            if (schedulerFailure == null) {
+                console.error(`Item ${scheduler.failed} failed: ${scheduler.last_error}`);
+                queue_paused = true;
+            }
+            takeBackSentItems(scheduler.dropped_ids);
+        }
+        schedulerFailure = scheduler.failed != null ? { itemName: scheduler.failed, error: scheduler.last_error } : null;
+
+        queueSentItems = queueSentItems.filter(item => item.pending || item.itemId === scheduler.running_id || scheduler.queued_ids.includes(item.itemId));
+        queueRunningItem = queueSentItems.find(item => item.itemId === scheduler.running_id) || null;
+    }
+
+    // Check if the queue is paused, and if the server is ready for the next item
+    // The server is kept one item ahead, so it can stage the next sample while the current one runs,
+    // pausing withdraws that item again so the queue stops after the current one
+    if (!queue_paused && scheduler != null && scheduler.failed == null && scheduler.queued.length == 0) {
         console.log('Sending next item in queue.');
         sendNextQueueItem();
     }
@@ -169,7 +190,14 @@ function renderQueue() {
 
     //Update the queue status badge (Paused or running)
     const queueStatusBadge = document.getElementById('queue-status');
-    if (queue_paused && queueRunningItem != null) {
+    queueStatusBadge.classList.remove('bg-danger');
+    if (schedulerFailure != null) {
+        queueStatusBadge.textContent = 'Failed';  // Paused until the failure is cleared
+        queueStatusBadge.classList.remove('bg-success');
+        queueStatusBadge.classList.remove('bg-warning');
+        queueStatusBadge.classList.remove('bg-info');
+        queueStatusBadge.classList.add('bg-danger');
+    } else if (queue_paused && queueRunningItem != null) {
         queueStatusBadge.textContent = 'Will Stop After Current';  // Will pause after current item
         queueStatusBadge.classList.remove('bg-success');
         queueStatusBadge.classList.remove('bg-warning');
@@ -190,9 +218,7 @@ function renderQueue() {
     queueItems_array.forEach((item, index) => {
 
         // Construct the text for the temperatures
-        const estTime_min = calculateProcedureTime(Math.min(...item.temperatures), Math.max(...item.temperatures), 
-                                                    item.minAngle, item.maxAngle, item.precision, 
-                                                    item.temperatures.length).totalTime;
+        const estTime_min = item.estTime_min;
         const temperaturesText = item.temperatures.length ? 
                 `${Math.min(...item.temperatures)}°C - ${Math.max(...item.temperatures)}°C, ${item.temperatures.length} Scans (approx. ${(estTime_min/60).toFixed(2)} hrs)` 
                 : 'No heating';
@@ -227,16 +253,24 @@ function renderQueue() {
 function renderCurrentlyRunning(systemStateData) {
     const runningItemDiv = document.getElementById('running-item');
 
-    if (queue_paused && systemStateData.aish_experiment == null) {
+    if (queueRunningItem == null && schedulerFailure != null) {
+        runningItemDiv.innerHTML = `
+            <div class="flex-grow-1">
+                <span class="item-name" style="display: block;">${schedulerFailure.itemName} failed</span>
+                <span class="item-details" style="display: block;">${schedulerFailure.error}</span>
+                <span class="item-details" style="display: block;">Check the loader and the samples, then start the queue to resume</span>
+            </div>
+        `;
+        return;
+    }
+
+    if (queueRunningItem == null) {
         runningItemDiv.innerHTML = ''; // Clear the currently running box
-        queueRunningItem = null;    // Clear the running item
         return;
     }
 
     // Construct the text for the temperatures
-    const estTime_min = calculateProcedureTime(Math.min(...queueRunningItem.temperatures), Math.max(...queueRunningItem.temperatures), 
-                        queueRunningItem.minAngle, queueRunningItem.maxAngle, queueRunningItem.precision, 
-                        queueRunningItem.temperatures.length).totalTime;
+    const estTime_min = queueRunningItem.estTime_min;
     const temperaturesText = queueRunningItem.temperatures.length ? 
         `${Math.min(...queueRunningItem.temperatures)}°C - ${Math.max(...queueRunningItem.temperatures)}°C, ${queueRunningItem.temperatures.length} Scans (approx. ${(estTime_min/60).toFixed(2)} hrs)` 
         : 'No heating';
@@ -247,10 +281,19 @@ function renderCurrentlyRunning(systemStateData) {
                 <span class="item-details" style="display: block;">Sample Number: ${queueRunningItem.sampleNumber} </span>
                 <span class="item-details" style="display: block;">2θ = ${queueRunningItem.minAngle}° - ${queueRunningItem.maxAngle}°, Precision: ${queueRunningItem.precision}</span>
                 <span class="item-details" style="display: block;">Temperature: ${temperaturesText} </span>
+                ${renderSchedulerDetails(systemStateData.scheduler)}
             </div>
     `;// Display in Currently Running box
 }
 
+// Stage of the running item, the item staged next on the server, and the throughput of the queue
+function renderSchedulerDetails(scheduler) {
+    const nextText = scheduler.queued.length ? `, next: ${scheduler.queued[0]}` : '';
+    const throughputText = scheduler.samples_per_hour != null ? `${scheduler.samples_per_hour.toFixed(2)} samples/hour` : 'n/a';
+    return `<span class="item-details" style="display: block;">Stage: ${scheduler.stage}${nextText}</span>
+                <span class="item-details" style="display: block;">Throughput: ${throughputText} (${scheduler.completed} completed)</span>`;
+}
+
 
 // Function to handle adding a new item to the queue
 function handle_button_queueAdd(event) {
@@ -284,24 +327,28 @@ function handle_button_queueAdd(event) {
         }
 
         // Linear interpolation of temperatures (rounded to integers)
-        const tempStep = (maxTemp - minTemp) / (numScans - 1);
-        temperatures = Array.from({ length: numScans }, (_, i) => Math.round(minTemp + i * tempStep));
+        temperatures = interpolateTemperatures(minTemp, maxTemp, numScans);
 
     }
 
     // Construct the new item object
     const newItem = {
+        itemId: `${Date.now()}-${queueItemCount++}`,   // Follows the item on the server, names can repeat
         itemName: itemName,
         sampleNumber: sampleNumber.val(),
         minAngle: minAngle,
         maxAngle: maxAngle,
         precision: precision,
-        temperatures: temperatures
+        temperatures: temperatures,
+        estTime_min: NaN    // Estimated once from the server below, the queue is re-rendered every poll
     };
 
     // Add new item to the queue
     queueItems_array.push(newItem);
     renderQueue(); // Render the updated queue
+    calculateProcedureTime(newItem.sampleNumber, temperatures.length ? temperatures : [25], minAngle, maxAngle, precision, function (estimate) {
+        newItem.estTime_min = estimate.totalTime;
+    });
 
     // Clear the input fields
     itemNameInput.value = '';
@@ -333,22 +380,23 @@ function sendNextQueueItem() {
     if (queueItems_array.length === 0) {
         console.log('Queue is empty.');
         queue_paused = true;
-        queueRunningItem = null;    // Clear the running item
         return;
     }
 
-    queueRunningItem = queueItems_array.shift(); // Remove the first item from the queue
+    const nextItem = queueItems_array.shift(); // Remove the first item from the queue
+    nextItem.pending = true;    // Kept as sent until the server has it, the poll may not list it yet
+    queueSentItems.push(nextItem);
     renderQueue(); // Re-render the queue to reflect changes
-    renderCurrentlyRunning(); // Render the currently running item
 
     const command_package = {
-        sample_name: queueRunningItem.itemName,
-        sample_num: queueRunningItem.sampleNumber,
+        item_id: nextItem.itemId,
+        sample_name: nextItem.itemName,
+        sample_num: nextItem.sampleNumber,
         xrd_params: {
-            min_angle: queueRunningItem.minAngle,
-            max_angle: queueRunningItem.maxAngle,
-            precision: queueRunningItem.precision,
-            temperatures: queueRunningItem.temperatures.length ? queueRunningItem.temperatures : [25]
+            min_angle: nextItem.minAngle,
+            max_angle: nextItem.maxAngle,
+            precision: nextItem.precision,
+            temperatures: nextItem.temperatures.length ? nextItem.temperatures : [25]
         }
     }
     console.log('Sending Command: ', command_package);
@@ -361,24 +409,78 @@ function sendNextQueueItem() {
         data: JSON.stringify(command_package),
         success: function (data) {
             console.log('Command Response: ', data);
+            nextItem.pending = false;
+            // Paused or aborted while the item was being sent, take it back from the server
+            if (queue_paused) {
+                withdrawQueuedItems();
+            }
+        },
+        error: function (xhr) {
+            // Refused, e.g. an item failed in the meantime, put it back at the front of the queue
+            console.error('Command Refused: ', xhr.responseJSON);
+            nextItem.pending = false;
+            takeBackSentItems([nextItem.itemId]);
+            renderQueue();
+        }
+    });
+}
+
+// Function to move the sent items the server has not started back to the front of the queue, in server order
+function takeBackSentItems(itemIds) {
+    const items = itemIds.map(itemId => queueSentItems.find(item => item.itemId === itemId)).filter(item => item != null);
+    queueSentItems = queueSentItems.filter(item => !items.includes(item));
+    queueItems_array.unshift(...items);
+}
+
+// Function to take back the items queued on the server, so it stops after the current one
+function withdrawQueuedItems() {
+    $.ajax({
+        url: '/api/withdraw',
+        method: 'POST',
+        contentType: 'application/json',
+        success: function (data) {
+            console.log('Withdraw Response: ', data);
+            takeBackSentItems(data.item_ids);
+            renderQueue();
         }
     });
 }
 
 function handle_button_queueStart() {
 
-    if (queueItems_array.length > 0) {
+    if (queueItems_array.length == 0) {
+        alert('No items in the queue to start.');
+        return;
+    }
+
+    if (schedulerFailure == null) {
         queue_paused = false;   // Set the queue to running
         renderQueue();
-    } else {
-        alert('No items in the queue to start.');
+        return;
     }
+
+    // The server refuses new items after a failure, until the operator has checked the hardware and clears it
+    if (!confirm(`${schedulerFailure.itemName} failed: ${schedulerFailure.error}\nHave the loader and the samples been checked? The queue resumes with the next item.`)) {
+        return;
+    }
+    $.ajax({
+        url: '/api/clear_failure',
+        method: 'POST',
+        contentType: 'application/json',
+        success: function (data) {
+            console.log('Clear Failure Response: ', data);
+            schedulerFailure = null;
+            queue_paused = false;   // Set the queue to running
+            renderQueue();
+        }
+    });
 }
 
 function handle_button_queuePause() {
     console.log('Queue Paused');
     queue_paused = true;    // Set the queue to paused, so it doesn't send the next item
     renderQueue(); // Re-render the queue to reflect changes
+    withdrawQueuedItems();  // Take back the item sent ahead, so it stops after the current one
 }
 
 function handle_button_queueAbort() {
@@ -393,6 +495,8 @@ function handle_button_queueAbort() {
         contentType: 'application/json',
         success: function (data) {
             console.log('Abort Response: ', data);
+            takeBackSentItems(data.item_ids);   // The queued items were not run, keep them in the queue
+            renderQueue();
         }
     });
 }
@@ -1,47 +1,80 @@
 console.log("UTILS LOADED");
 
-function calculateProcedureTime(minTemp, maxTemp, minAngle, maxAngle, precision, numScans) {
-    const XRD_SCAN_TIME = 2; // Base time for each XRD scan in minutes
-    const RAMP_RATE = 60;    // Ramp rate is 60°C/min
-
-    const rampTime = (maxTemp - minTemp) / RAMP_RATE;
-    const precisionFactor = (precision == "High") ? 1.5 : 1;
-    const scanRange = maxAngle - minAngle;
-    const scanTime = XRD_SCAN_TIME * (scanRange / 100) * precisionFactor;
-    const totalScanTime = scanTime * numScans;
-    const totalTime = totalScanTime + rampTime;
-
-    return { totalTime, scanTime, totalScanTime, rampTime };
+// Linear interpolation of temperatures (rounded to integers)
+function interpolateTemperatures(minTemp, maxTemp, numScans) {
+    const tempStep = (maxTemp - minTemp) / (numScans - 1);
+    return Array.from({ length: numScans }, (_, i) => Math.round(minTemp + i * tempStep));
 }
 
+const ESTIMATE_DEBOUNCE_MS = 300;  // Delay after the last edit of the form before the time is estimated
+let estimateTimer = null;          // Pending estimate of displayProcedureTime
+let estimateRequest = 0;           // Number of the latest estimate request, older responses are dropped
+
+// Get the estimated procedure time (in minutes) from the server, which uses the XRD scan parameters
+// and the motion models of the AISH Loader hardware. The estimate is passed to callback, with NaN times
+// if the request failed.
+function calculateProcedureTime(sampleNumber, temperatures, minAngle, maxAngle, precision, callback) {
+    const failed = { totalTime: NaN, scanTime: NaN, totalScanTime: NaN, rampTime: NaN, handlingTime: NaN };
+    $.ajax({
+        url: '/api/estimate_time',
+        method: 'POST',
+        contentType: 'application/json',
+        data: JSON.stringify({
+            sample_num: sampleNumber,
+            min_angle: minAngle,
+            max_angle: maxAngle,
+            precision: precision,
+            temperatures: temperatures
+        }),
+        success: function (data) {
+            callback(data);
+        },
+        error: function (xhr) {
+            console.error('Estimate Time Error: ', xhr.responseJSON);
+            callback(failed);
+        }
+    });
+}
+
+// Estimates the time once the form has not changed for ESTIMATE_DEBOUNCE_MS, not on every keystroke
 function displayProcedureTime() {
-    const XRD_SCAN_TIME = 2; // Base time for each XRD scan in minutes
-    const RAMP_RATE = 60;    // Ramp rate is 60°C/min
+    clearTimeout(estimateTimer);
+    estimateTimer = setTimeout(updateProcedureTime, ESTIMATE_DEBOUNCE_MS);
+}
 
+function updateProcedureTime() {
     const minTemp = parseFloat($('#min-temperature').val());
     const maxTemp = parseFloat($('#max-temperature').val());
     const numScans = parseInt($('#number-of-scans').val());
     const minAngle = parseFloat($('#min-angle').val());
     const maxAngle = parseFloat($('#max-angle').val());
-    const precision = $('#precision-select').val();  // Low or High precision
+    const precision = $('#precision-select').val();  // Low, High or Adaptive precision
+    const sampleNumber = $('input[name="sample-number"]:checked').val() || 0;
 
     if (!isNaN(minTemp) && !isNaN(maxTemp) && !isNaN(numScans) && !isNaN(minAngle) && !isNaN(maxAngle)) {
-        const { totalTime, scanTime, totalScanTime, rampTime } = calculateProcedureTime(minTemp, maxTemp, minAngle, maxAngle, precision, numScans);
+        const temperatures = interpolateTemperatures(minTemp, maxTemp, numScans);
+        const request = ++estimateRequest;
+        calculateProcedureTime(sampleNumber, temperatures, minAngle, maxAngle, precision, function ({ totalTime, scanTime, totalScanTime, rampTime, handlingTime }) {
+            if (request != estimateRequest) {
+                return;     // The form changed since, a newer estimate is on its way
+            }
 
-        // Breakdown of contributions
-        const scanBreakdown = `${scanTime.toFixed(2)} min/scan * ${numScans} scans = ${totalScanTime.toFixed(2)} min`;
-        const rampBreakdown = `${(rampTime).toFixed(2)} min ramping (60°C/min)`;
+            // Breakdown of contributions
+            const scanBreakdown = `${scanTime.toFixed(2)} min/scan * ${numScans + 1} scans (incl. cool-down) = ${totalScanTime.toFixed(2)} min`;
+            const rampBreakdown = `${(rampTime).toFixed(2)} min ramping (60°C/min), ${(handlingTime).toFixed(2)} min loading/unloading`;
 
-        // Display the estimated time sentence
-        $('#estimated-time').text(`Estimated Procedure Time: ${(totalTime).toFixed(2)} min = ${(totalTime / 60).toFixed(2)} hr`);
-        
-        // Display the breakdown with proper alignment
-        $('#scan-breakdown').text(scanBreakdown);
-        $('#ramp-breakdown').text(rampBreakdown);
+            // Display the estimated time sentence
+            $('#estimated-time').text(`Estimated Procedure Time: ${(totalTime).toFixed(2)} min = ${(totalTime / 60).toFixed(2)} hr`);
+            
+            // Display the breakdown with proper alignment
+            $('#scan-breakdown').text(scanBreakdown);
+            $('#ramp-breakdown').text(rampBreakdown);
 
-        // Show the breakdown section
-        $('#time-breakdown').show(); // Hide estimated time
+            // Show the breakdown section
+            $('#time-breakdown').show(); // Hide estimated time
+        });
     } else {
+        ++estimateRequest;  // Drops the estimate still on its way
         $('#estimated-time').text('');
         $('#time-breakdown').hide();
     }